@@ -8,16 +8,40 @@
 #    ║    minimum.                                                        ║
 #    ║                                                                    ║
 #    ╚════════════════════════════════════════════════════════════════════╝
-from flask import Flask, render_template, request, redirect, jsonify
+from flask import Flask, Response, render_template, request, redirect, jsonify, abort, session
 import socket
+import hmac
 import os
-import cnnlite
+import json
+import queue
+import archive
+import canonical
+import pagecache
+import snapshot
 from tags import Tags
-from threading import Thread
+from profiles import Profiles, user_id_for
+from threading import Thread, Lock
 from datamodel import DataModel
 import utilities
+import logs
+import metrics
+import tracing
+import time
+
+#   Note that cnnlite is imported inside the functions that use it.  It drags in requests,
+#   BeautifulSoup and the LLM code, and a cold start serving the saved snapshot needs none of them.
 
 app = Flask(__name__)
+# Signs the session cookie that remembers who is reading.  Without SECRET_KEY, one is made up and kept
+# in the database, so every worker signs cookies the same way and readers stay who they are.
+app.secret_key = os.getenv('SECRET_KEY') or DataModel().shared_secret('session')
+log = logs.get_logger('app')
+
+request_seconds = metrics.histogram('http_request_seconds', 'Time to handle a request, by route and status')
+feedback_count = metrics.counter('feedback_events_total', 'Likes, dislikes and reads sent to /api/feedback, by kind')
+
+feedback_kinds = ('like', 'dislike', 'read')
+max_feedback_events = 200      # per request
 
 
 #    ┌──────────────────────────────────────────────────────────┐
@@ -29,39 +53,132 @@ llama_message = "Just a moment while our trained Llamas read the headlines for y
 @app.route('/')
 def index():
     global llama_message
+    # If we have last time's headlines, the reader can start on those right away
+    if not warm and current_user() is None and snapshot.load() is not None:
+        return redirect('/home')
     return render_template('startup.html', message=llama_message, links=False)
 
 
 @app.route('/home')
 def home():
     global llama_message
+
+    user_id = current_user()
+
+    # /home?tag=ukraine&tag=economy narrows it down to stories with those tags
+    tags = request.args.getlist('tag')
+    if tags:
+        return render_search('', tags, user_id)
+
+    # Until the first refresh of this run is done, serve what we saved last time (which is
+    # the default reader's ranking, so named readers wait for their own)
+    if not warm and user_id is None:
+        saved = snapshot.load()
+        if saved is not None:
+            warm_up()
+            return render_template('home.html', stories=saved['stories'][:25], links=True, user=user_id)
+
+    import cnnlite
     cnn = cnnlite.CNNLite()
     # If we're going to fetch and tag more articles, back to the llama page
     if cnn.time_for_refresh():
         llama_message = "Our llamas are looking for news updates, just a moment"
         return redirect('/')
 
-    stories = cnn.get_top_stories()
-    return render_template('home.html', stories=stories, links=True)
+    # Only re-render when the stories, tag scores or this reader's profile have changed since the last time
+    page = pagecache.PageCache().get_or_render(('home', user_id) + cnn.get_versions(user_id),
+                                               lambda: render_home(cnn, user_id))
+    return cached_response(page)
+
+
+@tracing.traced
+def render_home(cnn, user_id=None):
+    return render_template('home.html', stories=cnn.get_top_stories(refresh=False, user_id=user_id), links=True,
+                           user=user_id)
+
+
+#   Stories whose headlines have these words: /search?q=ukraine+talks (add &tag=... to narrow it down)
+@app.route('/search')
+def search():
+    query = request.args.get('q', '').strip()[:200]
+    tags = request.args.getlist('tag')
+    if not query and not tags:
+        return redirect('/home')
+    return render_search(query, tags, current_user())
+
+
+@tracing.traced
+def render_search(query, tags, user_id=None):
+    import cnnlite
+    cnn = cnnlite.CNNLite()
+    tags = canonical.canonicalize_all(tags)
+    title = ' and '.join([f'"{query}"'] * bool(query) + tags)
+    return render_template('home.html', stories=cnn.search(query, tags, user_id=user_id), links=True,
+                           user=user_id, title=f'Stories about {title}', query=query, searching=True)
+
+
+#   Pick who's reading: /user?name=alice, or no name to go back to the default profile
+@app.route('/user', methods=['GET', 'POST'])
+def choose_user():
+    name = request.values.get('name', '')
+    if name.strip() == '':
+        session.pop('user', None)
+        return redirect('/home')
+    user_id = user_id_for(name)
+    if user_id is None:
+        return jsonify({"status": "error", "message": "Names are letters, digits, '.', '-' and '_', "
+                                                     "up to 40 of them"}), 400
+    session['user'] = user_id
+    return redirect('/home')
+
+
+@app.before_request
+def start_timer():
+    request.start_time = time.perf_counter()
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    tracing.Tracer().begin(f'route {route}')
+    request.profile = tracing.Profiler().start('requests') if not route.startswith('/admin') else None
+
+
+@app.teardown_request
+def stop_tracing(exception):
+    tracing.Profiler().stop(getattr(request, 'profile', None))
+    tracing.Tracer().end()
+
+
+@app.after_request
+def record_request_time(response):
+    # Label by the route pattern, not the URL, so ?id=123 doesn't make a new series per story
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    if hasattr(request, 'start_time'):
+        request_seconds.observe(time.perf_counter() - request.start_time, route=route,
+                                method=request.method, status=response.status_code)
+    return response
 
 
 @app.route('/help')
 def help_page():
-    return render_template('help.html', links=True)
+    return render_template('help.html', links=True, user=current_user())
 
 
 @app.route('/open')
 def open_story():
-    cnn = cnnlite.CNNLite()
+    import cnnlite
+    # No need to wait for a CNNLite to be built (and maybe refresh) just to look up a story
+    cnn = cnnlite.CNNLite
 
     story_id = request.args.get('id')
-    cnn.mark_article_read(story_id)
+    user_id = current_user()
+    if user_id is None:
+        cnn.mark_article_read(story_id)
+    else:
+        Profiles().get(user_id).mark_read(story_id)
 
     like_dislike(story_id, 1)
 
     url = cnn.get_article_url(story_id)
 
-    print(f'Opening story {story_id} at {url}')
+    log.info(f'Opening story {story_id} at {url}')
 
     # Redirect to the actual story URL
     return redirect(url)
@@ -74,7 +191,7 @@ def open_story():
 #   This kicks off an initial fetch or refresh
 @app.route('/api/start', methods=['POST'])
 def start_task():
-    print('Starting fetch', flush=True)
+    log.info('Starting fetch')
 
     global status
     status = {"status": "started", "message": "The Llamas are working hard to fetch the articles. Please wait..."}
@@ -89,6 +206,149 @@ def get_status():
     return jsonify(status)
 
 
+#   Push progress to the browser with Server-Sent Events instead of making it poll /api/status
+@app.route('/api/events')
+def event_stream():
+    u = utilities.Utilities()
+    q = u.subscribe()
+
+    def generate():
+        try:
+            # Let the new listener know where things stand right now
+            yield sse_message("status", status)
+            while True:
+                try:
+                    event, data = q.get(timeout=15)
+                except queue.Empty:
+                    # A comment line keeps proxies from closing an idle connection
+                    yield ": keep-alive\n\n"
+                    continue
+                yield sse_message(event, data)
+        finally:
+            u.unsubscribe(q)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+#   The ranked feed as JSON, a page at a time.  Pass the version from a previous
+#   response as ?since= to get only what has been added or re-ranked after it (and
+#   what was removed).  If this process can't vouch for the removals back that far
+#   (it restarted, or a different worker answered), it sends everything with
+#   "resync": true, and the client should start over from that.
+@app.route('/api/stories')
+def api_stories():
+    import cnnlite
+    cnn = cnnlite.CNNLite()
+    # An API call shouldn't wait for CNN and the LLM; it gets the ranking as it stands
+    if cnn.time_for_refresh():
+        refresh_in_background(cnn)
+
+    try:
+        limit = min(max(int(request.args.get('limit', 25)), 1), 100)
+        since = request.args.get('since')
+        since = int(since) if since is not None else None
+        page = cnn.get_stories_page(limit=limit, cursor=request.args.get('cursor'),
+                                    tags=request.args.getlist('tag'), since=since, user_id=current_user())
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    return jsonify(page)
+
+
+#   How often tags have come up over time, archive included: ?tag=economy&tag=usa&days=90&bucket=7
+@app.route('/api/trends')
+def api_trends():
+    tags = canonical.canonicalize_all(request.args.getlist('tag'))
+    if not tags:
+        return jsonify({"status": "error", "message": "Ask for at least one tag"}), 400
+    try:
+        days = min(max(int(request.args.get('days', 30)), 1), 3650)
+        bucket = min(max(int(request.args.get('bucket', 1)), 1), days)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    db = DataModel()
+    db.sync_stories()
+    trends = archive.Archive().tag_trends(tags, days=days, bucket_days=bucket, recent=db.stories)
+    return jsonify({"days": days, "bucket_days": bucket, "trends": trends})
+
+
+#   Prometheus scrapes this
+@app.route('/metrics')
+def metrics_page():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+#    ┌──────────────────────────────────────────────────────────┐
+#    │    Admin endpoints for tracking down slowness.  They     │
+#    │    want ADMIN_TOKEN in an X-Admin-Token header, and      │
+#    │    aren't there at all without one (behind a proxy,      │
+#    │    every request looks like it's from localhost).        │
+#    └──────────────────────────────────────────────────────────┘
+def check_admin():
+    token = os.getenv('ADMIN_TOKEN')
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', '').encode('utf-8'), token.encode('utf-8')):
+        abort(403)
+
+
+#   POST ?mode=cprofile|tracemalloc and either &requests=N or &refresh=1 to arm the profiler
+@app.route('/admin/profile', methods=['GET', 'POST'])
+def admin_profile():
+    check_admin()
+    profiler = tracing.Profiler()
+    if request.method == 'POST':
+        try:
+            profiler.arm(request.args.get('mode', 'cprofile'), requests=int(request.args.get('requests', 0)),
+                         refresh=request.args.get('refresh') == '1')
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify(profiler.status())
+
+
+#   The cProfile results: pstats format by default (for snakeviz, flameprof, etc.) or ?format=text
+@app.route('/admin/profile/download')
+def admin_profile_download():
+    check_admin()
+    profiler = tracing.Profiler()
+    if request.args.get('format') == 'text':
+        text = profiler.profile_text()
+        if text is None:
+            abort(404)
+        return Response(text, mimetype='text/plain')
+    data = profiler.profile_bytes()
+    if data is None:
+        abort(404)
+    return Response(data, mimetype='application/octet-stream',
+                    headers={'Content-Disposition': 'attachment; filename=newsreader.prof'})
+
+
+@app.route('/admin/profile/memory')
+def admin_profile_memory():
+    check_admin()
+    report = tracing.Profiler().memory_report
+    if report is None:
+        abort(404)
+    return Response(report, mimetype='text/plain')
+
+
+#   GET the collapsed stacks (feed them to flamegraph.pl or speedscope); POST ?enable=1|0&reset=1
+@app.route('/admin/trace', methods=['GET', 'POST'])
+def admin_trace():
+    check_admin()
+    tracer = tracing.Tracer()
+    if request.method == 'POST':
+        if 'enable' in request.args:
+            tracer.enabled = request.args.get('enable') == '1'
+        if request.args.get('reset') == '1':
+            tracer.reset()
+        return jsonify({"enabled": tracer.enabled})
+    return Response(tracer.collapsed(), mimetype='text/plain',
+                    headers={'Content-Disposition': 'attachment; filename=newsreader.folded'})
+
+
 #   User likes a story
 @app.route('/api/like')
 def like_story():
@@ -105,20 +365,95 @@ def dislike_story():
     return jsonify({"status": "success", "story_id": story_id})
 
 
+#   A batch of likes, dislikes and reads, as queued up by the browser:
+#   {"events": [{"id": "...", "kind": "like", "story": 12, "at": 1718000000000}, ...]}
+#   Every event has an id the browser made up, so sending the same batch again does no harm.
+@app.route('/api/feedback', methods=['POST'])
+def api_feedback():
+    body = request.get_json(force=True, silent=True)
+    events = body.get('events') if isinstance(body, dict) else None
+    if not isinstance(events, list) or len(events) > max_feedback_events:
+        return jsonify({"status": "error", "message": f"Send a list of up to {max_feedback_events} events"}), 400
+    try:
+        events = [{'id': str(event['id'])[:64], 'kind': event['kind'], 'story': int(event['story']),
+                   'at': float(event.get('at') or 0) / 1000 or None} for event in events]
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"status": "error", "message": f"Bad event: {e}"}), 400
+    if any(event['kind'] not in feedback_kinds for event in events):
+        return jsonify({"status": "error", "message": f"Events must be one of {', '.join(feedback_kinds)}"}), 400
+    if not events:
+        return jsonify({"status": "success", "applied": 0})
+
+    # In the order they happened, which matters when a score is averaged in
+    events.sort(key=lambda event: event['at'] or 0)
+    user_id = current_user()
+    applied = DataModel().apply_feedback(user_id, events, Tags().rescore)
+    for event in events:
+        feedback_count.inc(kind=event['kind'])
+    log.info(f'{user_id or "default"} sent {len(events)} feedback events, {applied} new')
+
+    # Pick up the new scores here straight away; other workers notice through the version counters
+    if user_id is None:
+        Tags().refresh()
+    else:
+        Profiles().get(user_id)
+    return jsonify({"status": "success", "applied": applied})
+
+
 #    ┌──────────────────────────────────────────────────────────┐
 #    │          Supporting Functions for Pages & APIs           │
 #    └──────────────────────────────────────────────────────────┘
 
+#   Who's reading, or None for the default profile
+def current_user():
+    return session.get('user')
+
+
 #   Update tags based on the user liking/disliking a story
 def like_dislike(story_id, increment):
     tags = get_article_tags(story_id)
+    user_id = current_user()
+    if user_id is not None:
+        profile = Profiles().get(user_id)
+        if increment == 1:
+            profile.like_tags(tags)
+        else:
+            profile.dislike_tags(tags)
+        log.info(f'{user_id} {"liked" if increment == 1 else "disliked"} story {story_id} with tags {tags}')
+        return
+
     tag_hist = Tags()
+    tag_hist.refresh()
     if increment == 1:
         tag_hist.like_tags(tags)
-        print(f'Liked story {story_id} with tags {tags}')
+        log.info(f'Liked story {story_id} with tags {tags}')
     else:
         tag_hist.dislike_tags(tags)
-        print(f'Disliked story {story_id} with tags {tags}')
+        log.info(f'Disliked story {story_id} with tags {tags}')
+
+
+#   Send a cached page, or just a 304 if the browser already has this version of it
+def cached_response(page):
+    gzipped = bool(request.accept_encodings['gzip'])
+    etag = page.gzip_etag if gzipped else page.etag
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif gzipped:
+        response = Response(page.gzipped, mimetype='text/html')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(page.body, mimetype='text/html')
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    # The same URL is a different page for each reader
+    response.headers['Vary'] = 'Accept-Encoding, Cookie'
+    return response
+
+
+#   Format one Server-Sent Event
+def sse_message(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
 
 #   Get the tags for a story
@@ -147,23 +482,53 @@ def status_callback(state, message):
 #   Fetch new articles.  It is in a separate function so that we can run this in a thread
 #   without locking up the browser waiting for some that may be very time-consuming
 def first_fetch():
-    global status
+    global warm, warm_up_thread
+    import cnnlite
     u = utilities.Utilities()
     u.set_callback(status_callback)
     try:
-        status["status"] = "working"
-        status["message"] = "Starting to fetch articles"
+        u.update_status("working", "Starting to fetch articles")
         cnn = cnnlite.CNNLite()
         cnn.refresh_list()
 
-        status["status"] = "done"
-        status["message"] = "Task completed successfully"
+        warm = True
+        u.update_status("done", "Task completed successfully")
     except Exception as e:
-        status["status"] = "error"
-        status["message"] = str(e)
+        u.update_status("error", str(e))
+        # Let the next request have another go (the scheduler's backoff keeps that from hammering CNN)
+        with warm_up_lock:
+            warm_up_thread = None
         raise
 
 
+#   Run a refresh without holding up the request that noticed it was due, one at a time
+refresh_thread = None
+refresh_thread_lock = Lock()
+
+
+def refresh_in_background(cnn):
+    global refresh_thread
+    with refresh_thread_lock:
+        if refresh_thread is None or not refresh_thread.is_alive():
+            refresh_thread = Thread(target=cnn.refresh_list, daemon=True)
+            refresh_thread.start()
+
+
+#   Has this process finished its first refresh?  Until it has, /home serves the snapshot.
+warm = False
+warm_up_thread = None
+warm_up_lock = Lock()
+
+
+#   Start the first refresh in the background, just once
+def warm_up():
+    global warm_up_thread
+    with warm_up_lock:
+        if warm_up_thread is None:
+            warm_up_thread = Thread(target=first_fetch, daemon=True)
+            warm_up_thread.start()
+
+
 #    ┌──────────────────────────────────────────────────────────┐
 #    │                       Startup Code                       │
 #    └──────────────────────────────────────────────────────────┘
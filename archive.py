@@ -0,0 +1,264 @@
+#    ┌────────────────────────────────────────────────────────────────────┐
+#    │                                                                    │
+#    │                          Story Archive                             │
+#    │                                                                    │
+#    │    Stories only stay in the database for two days, which keeps     │
+#    │    ranking fast.  Rather than throw them away after that, they     │
+#    │    are moved here: each batch of expired stories becomes one       │
+#    │    segment file, written once and never changed, holding the       │
+#    │    stories column by column (ids, dates, headlines, urls, and      │
+#    │    the tags as indexes into the segment's own tag list).  Once a   │
+#    │    day, each finished day's segments are folded into one, which    │
+#    │    lists the files it replaces: if the old ones are still there    │
+#    │    (the process died before removing them), they are ignored.      │
+#    │                                                                    │
+#    │    With NumPy installed the segments are compressed .npz files;    │
+#    │    without it they are gzipped JSON with the same columns.         │
+#    │    Either way they can be read back for questions like "how        │
+#    │    often has this tag come up, week by week?"                      │
+#    │                                                                    │
+#    └────────────────────────────────────────────────────────────────────┘
+import datetime
+import gzip
+import json
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+archive_dir = os.path.join('temp', 'archive')
+
+
+#   Turn a list of story dicts into the columns stored in a segment
+def to_columns(stories):
+    vocabulary = {}
+    offsets = [0]
+    tag_indexes = []
+    for story in stories:
+        for tag in story['tags']:
+            tag_indexes.append(vocabulary.setdefault(tag, len(vocabulary)))
+        offsets.append(len(tag_indexes))
+
+    return {
+        'ids': [int(story['id']) for story in stories],
+        'dates': [story['date'] for story in stories],
+        'read': [int(story['read'] or 0) for story in stories],
+        'headlines': [story['headline'] or '' for story in stories],
+        'urls': [story['url'] or '' for story in stories],
+        'tag_offsets': offsets,
+        'tag_indexes': tag_indexes,
+        'vocabulary': list(vocabulary),
+    }
+
+
+class Segment:
+    def __init__(self, path):
+        self.path = path
+        if path.endswith('.npz'):
+            with numpy.load(path) as data:
+                self.columns = {name: data[name] for name in data.files}
+        else:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                self.columns = json.load(f)
+        self.vocabulary = [str(tag) for tag in self.columns['vocabulary']]
+        self.lookup = {tag: i for i, tag in enumerate(self.vocabulary)}
+        # File names of the segments this one was merged from
+        self.replaces = {str(name) for name in self.columns.get('replaces', ())}
+
+    def __len__(self):
+        return len(self.columns['ids'])
+
+    # Yields (date, tag) for every tag on every story in the segment, limited to the wanted tags
+    def tag_dates(self, wanted):
+        indexes = {self.lookup[tag]: tag for tag in wanted if tag in self.lookup}
+        if not indexes:
+            return
+        offsets = self.columns['tag_offsets']
+        tag_indexes = self.columns['tag_indexes']
+        dates = self.columns['dates']
+        if numpy is not None and isinstance(tag_indexes, numpy.ndarray):
+            # Find the wanted tags in one pass over the column, then each one's story from the offsets
+            hits = numpy.flatnonzero(numpy.isin(tag_indexes, list(indexes)))
+            rows = numpy.searchsorted(offsets, hits, side='right') - 1
+            for date, index in zip(dates[rows].tolist(), tag_indexes[hits].tolist()):
+                yield date, indexes[index]
+            return
+        for row in range(len(self)):
+            for i in range(int(offsets[row]), int(offsets[row + 1])):
+                tag = indexes.get(int(tag_indexes[i]))
+                if tag is not None:
+                    yield float(dates[row]), tag
+
+    def stories(self):
+        offsets = self.columns['tag_offsets']
+        for row in range(len(self)):
+            yield {'id': int(self.columns['ids'][row]), 'date': float(self.columns['dates'][row]),
+                   'read': int(self.columns['read'][row]), 'headline': str(self.columns['headlines'][row]),
+                   'url': str(self.columns['urls'][row]),
+                   'tags': [self.vocabulary[int(i)] for i in
+                            self.columns['tag_indexes'][int(offsets[row]):int(offsets[row + 1])]]}
+
+
+class Archive:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if "segments" not in self.__dict__:
+            self.lock = threading.Lock()
+            self.segments = OrderedDict()       # path -> Segment, the most recently read ones
+            self.max_segments = 64
+
+    # Dates in the stories table are datetime strings; the archive keeps seconds since the epoch
+    @staticmethod
+    def timestamp(date):
+        if isinstance(date, (int, float)):
+            return float(date)
+        if isinstance(date, datetime.datetime):
+            return date.timestamp()
+        return datetime.datetime.fromisoformat(str(date)).timestamp()
+
+    # Write a new segment holding these stories (merged from the `replaces` segments, if given).
+    # Raises OSError if it can't.
+    def append(self, stories, replaces=()):
+        if not stories:
+            return None
+        stories = [dict(story, date=self.timestamp(story['date'])) for story in stories]
+        columns = to_columns(stories)
+
+        if not os.path.exists(archive_dir):
+            os.makedirs(archive_dir)
+
+        # Named by the time span they cover, so they list in order
+        first = min(columns['dates'])
+        last = max(columns['dates'])
+        name = f'segment-{int(first)}-{int(last)}-{os.getpid()}'
+        if replaces:
+            name += '-merged'
+            # It may be taking the name of one it replaces
+            columns['replaces'] = [os.path.basename(path) for path in replaces
+                                   if not os.path.basename(path).startswith(name + '.')]
+
+        # Write to the side and swap it in, so a crash never leaves half a segment behind
+        if numpy is not None:
+            path = os.path.join(archive_dir, name + '.npz')
+            temp_file = path + '.tmp'
+            with open(temp_file, 'wb') as f:
+                numpy.savez_compressed(f,
+                                       ids=numpy.array(columns['ids'], dtype=numpy.int64),
+                                       dates=numpy.array(columns['dates'], dtype=numpy.float64),
+                                       read=numpy.array(columns['read'], dtype=numpy.int8),
+                                       headlines=numpy.array(columns['headlines'], dtype=str),
+                                       urls=numpy.array(columns['urls'], dtype=str),
+                                       tag_offsets=numpy.array(columns['tag_offsets'], dtype=numpy.int32),
+                                       tag_indexes=numpy.array(columns['tag_indexes'], dtype=numpy.int32),
+                                       vocabulary=numpy.array(columns['vocabulary'], dtype=str),
+                                       replaces=numpy.array(columns.get('replaces', []), dtype=str))
+        else:
+            path = os.path.join(archive_dir, name + '.json.gz')
+            temp_file = path + '.tmp'
+            with gzip.open(temp_file, 'wt', encoding='utf-8', compresslevel=6) as f:
+                json.dump(columns, f, separators=(',', ':'))
+        os.replace(temp_file, path)
+        return path
+
+    # Fold each finished day's segments (by the day of their oldest story) into one, so a long trend
+    # query reads a file a day instead of one for every time stories were archived.  Returns how
+    # many files went.  Only one process should do this at a time; DataModel sees to that.
+    def compact(self, now=None):
+        today = int((now or time.time()) // 86400)
+        live = self.live_paths()
+        # Left over from a compaction that didn't finish
+        leftovers = [path for path in self.segment_paths() if path not in live]
+        by_day = {}
+        for path in live:
+            day = int(os.path.basename(path).split('-')[1]) // 86400
+            if day < today:
+                by_day.setdefault(day, []).append(path)
+
+        removed = []
+        for paths in by_day.values():
+            if len(paths) < 2:
+                continue
+            merged = self.append([story for path in paths for story in Segment(path).stories()], replaces=paths)
+            removed.extend(path for path in paths if path != merged)
+        for path in leftovers + removed:
+            os.remove(path)
+        with self.lock:
+            self.segments.clear()
+        return len(leftovers) + len(removed)
+
+    # The segment files, oldest first, optionally only those that might hold stories after `since`
+    @staticmethod
+    def segment_paths(since=None):
+        if not os.path.exists(archive_dir):
+            return []
+        paths = []
+        for name in sorted(os.listdir(archive_dir)):
+            if not name.startswith('segment-') or name.endswith('.tmp'):
+                continue
+            if name.endswith('.npz') and numpy is None:
+                continue
+            last = int(name.split('-')[2])
+            if since is None or last >= since:
+                paths.append(os.path.join(archive_dir, name))
+        return paths
+
+    # The segment files to read, leaving out any that a merged segment has replaced.  A merged
+    # segment ends after everything it replaced, so `since` never leaves it out while keeping them.
+    def live_paths(self, since=None):
+        paths = self.segment_paths(since)
+        replaced = set()
+        for path in paths:
+            if '-merged.' in os.path.basename(path):
+                replaced.update(self.segment(path).replaces)
+        return [path for path in paths if os.path.basename(path) not in replaced]
+
+    def segment(self, path):
+        with self.lock:
+            segment = self.segments.get(path)
+            if segment is not None:
+                self.segments.move_to_end(path)
+                return segment
+        segment = Segment(path)
+        with self.lock:
+            self.segments[path] = segment
+            while len(self.segments) > self.max_segments:
+                self.segments.popitem(last=False)
+        return segment
+
+    # How many stories carried each tag, per bucket of `bucket_days` days, over the last `days` days:
+    # {tag: [[bucket start (epoch seconds), count], ...]}.  `recent` can add stories not archived yet.
+    def tag_trends(self, tags, days=30, bucket_days=1, recent=()):
+        bucket = bucket_days * 86400
+        since = time.time() - days * 86400
+        counts = Counter()
+        for path in self.live_paths(since):
+            for date, tag in self.segment(path).tag_dates(tags):
+                if date >= since:
+                    counts[tag, int(date // bucket) * bucket] += 1
+        for story in recent:
+            date = self.timestamp(story['date'])
+            if date >= since:
+                for tag in tags:
+                    if tag in story['tags']:
+                        counts[tag, int(date // bucket) * bucket] += 1
+
+        trends = {tag: [] for tag in tags}
+        for (tag, start), count in sorted(counts.items(), key=lambda item: item[0][1]):
+            trends[tag].append([start, count])
+        return trends
+
+    # Every archived story, oldest segment first (for exports and the like)
+    def stories(self, since=None):
+        for path in self.live_paths(since):
+            yield from self.segment(path).stories()
@@ -0,0 +1,373 @@
+#    ┌────────────────────────────────────────────────────────────────────┐
+#    │                                                                    │
+#    │                             Backfill                               │
+#    │                                                                    │
+#    │    Re-tagging everything after a prompt change, or tagging a       │
+#    │    pile of imported stories, doesn't need answers in seconds.      │
+#    │    The providers' batch APIs take thousands of requests at once,   │
+#    │    work through them within a day, and charge half price.  So      │
+#    │    this submits the whole lot as one batch job, waits for it,      │
+#    │    and writes all the tags back in one transaction, without        │
+#    │    going near the live refresh.                                    │
+#    │                                                                    │
+#    │        python backfill.py --service anthropic    (untagged ones)   │
+#    │        python backfill.py --service groq --retag (everything)      │
+#    │        python backfill.py --resume    (after an interruption)      │
+#    │                                                                    │
+#    │    For trying it out without spending money, run a stand-in for    │
+#    │    both APIs (it tags with the local pre-tagger):                  │
+#    │                                                                    │
+#    │        python backfill.py --serve 8089                             │
+#    │        ANTHROPIC_BASE_URL=http://localhost:8089 \                  │
+#    │            python backfill.py --service anthropic                  │
+#    │                                                                    │
+#    └────────────────────────────────────────────────────────────────────┘
+import argparse
+import email.parser
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import llm
+import logs
+
+log = logs.get_logger('backfill')
+
+job_file = os.path.join('temp', 'backfill-job.json')
+
+
+#    ┌──────────────────────────────────────────────────────────┐
+#    │                 Anthropic Message Batches                │
+#    └──────────────────────────────────────────────────────────┘
+class AnthropicBatch:
+    def __init__(self):
+        self.backend = llm.Anthropic()
+
+    def build(self, prompt):
+        return self.backend.build_request(None, prompt, [], False, llm.tagging_schema if llm.structured_output else None)
+
+    def submit(self, requests_by_id):
+        body = {"requests": [{"custom_id": custom_id, "params": params}
+                             for custom_id, params in requests_by_id.items()]}
+        response = requests.post(f'{self.backend.base_url}/v1/messages/batches', headers=self.backend.headers(),
+                                 data=json.dumps(body), timeout=llm.request_timeout)
+        response.raise_for_status()
+        return response.json()['id']
+
+    # True once the batch has finished, one way or another
+    def done(self, batch_id):
+        response = requests.get(f'{self.backend.base_url}/v1/messages/batches/{batch_id}',
+                                headers=self.backend.headers(), timeout=llm.request_timeout)
+        response.raise_for_status()
+        batch = response.json()
+        log.info(f'Batch {batch_id}: {batch["processing_status"]} {batch.get("request_counts", "")}')
+        return batch['processing_status'] == 'ended'
+
+    # Yields (custom_id, results or None if that request failed)
+    def results(self, batch_id):
+        response = requests.get(f'{self.backend.base_url}/v1/messages/batches/{batch_id}/results',
+                                headers=self.backend.headers(), timeout=llm.request_timeout)
+        response.raise_for_status()
+        for line in response.text.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if entry['result']['type'] != 'succeeded':
+                yield entry['custom_id'], None
+                continue
+            try:
+                yield entry['custom_id'], self.backend.parse_response(entry['result']['message'])
+            except Exception as e:
+                log.warning(f'Could not parse the result for {entry["custom_id"]}: {e}')
+                yield entry['custom_id'], None
+
+
+#    ┌──────────────────────────────────────────────────────────┐
+#    │      OpenAI-style batch files (which Groq also takes)    │
+#    └──────────────────────────────────────────────────────────┘
+class OpenAIBatch:
+    def __init__(self):
+        self.backend = llm.Groq()
+        self.output_file_id = None
+
+    def build(self, prompt):
+        schema = llm.tagging_schema if llm.structured_output and self.backend.schema_supported else None
+        return self.backend.build_request(None, prompt, [], False, schema)
+
+    def auth(self):
+        return {"Authorization": self.backend.headers()["Authorization"]}
+
+    def submit(self, requests_by_id):
+        lines = [json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+                             "body": body}) for custom_id, body in requests_by_id.items()]
+        response = requests.post(f'{self.backend.base_url}/v1/files', headers=self.auth(),
+                                 data={"purpose": "batch"},
+                                 files={"file": ("backfill.jsonl", '\n'.join(lines).encode('utf-8'))},
+                                 timeout=llm.request_timeout)
+        response.raise_for_status()
+        file_id = response.json()['id']
+
+        response = requests.post(f'{self.backend.base_url}/v1/batches', headers=self.backend.headers(),
+                                 data=json.dumps({"input_file_id": file_id, "endpoint": "/v1/chat/completions",
+                                                  "completion_window": "24h"}), timeout=llm.request_timeout)
+        response.raise_for_status()
+        return response.json()['id']
+
+    def done(self, batch_id):
+        response = requests.get(f'{self.backend.base_url}/v1/batches/{batch_id}', headers=self.auth(),
+                                timeout=llm.request_timeout)
+        response.raise_for_status()
+        batch = response.json()
+        log.info(f'Batch {batch_id}: {batch["status"]} {batch.get("request_counts", "")}')
+        if batch['status'] in ('failed', 'expired', 'cancelled'):
+            raise RuntimeError(f'Batch {batch_id} {batch["status"]}')
+        if batch['status'] == 'completed':
+            self.output_file_id = batch.get('output_file_id')
+            return True
+        return False
+
+    def results(self, batch_id):
+        if self.output_file_id is None:
+            return
+        response = requests.get(f'{self.backend.base_url}/v1/files/{self.output_file_id}/content',
+                                headers=self.auth(), timeout=llm.request_timeout)
+        response.raise_for_status()
+        use_schema = llm.structured_output and self.backend.schema_supported
+        for line in response.text.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            answer = entry.get('response') or {}
+            if answer.get('status_code') != 200:
+                yield entry['custom_id'], None
+                continue
+            try:
+                yield entry['custom_id'], self.backend.parse_response(answer['body'], use_schema)
+            except Exception as e:
+                log.warning(f'Could not parse the result for {entry["custom_id"]}: {e}')
+                yield entry['custom_id'], None
+
+
+services = {'anthropic': AnthropicBatch, 'groq': OpenAIBatch}
+
+
+#    ┌──────────────────────────────────────────────────────────┐
+#    │                    Running a backfill                    │
+#    └──────────────────────────────────────────────────────────┘
+def select_stories(retag):
+    from datamodel import DataModel
+    stories = DataModel().get_stories()
+    return list(stories) if retag else [story for story in stories if len(story['tags']) == 0]
+
+
+# Split the stories into requests, each packed to the model's token budgets: {custom_id: ([ids], body)}
+def build_requests(service, name, stories):
+    engine = llm.LLM(name)
+    requests_by_id = {}
+    remaining = list(stories)
+    while remaining:
+        size = engine.pack_batch(remaining)
+        batch, remaining = remaining[:size], remaining[size:]
+        prompt = json.dumps([{"id": story['id'], "headline": story['headline']} for story in batch])
+        requests_by_id[f'tags-{len(requests_by_id)}'] = ([story['id'] for story in batch], service.build(prompt))
+    return requests_by_id
+
+
+def save_job(job):
+    if not os.path.exists(os.path.dirname(job_file)):
+        os.mkdir(os.path.dirname(job_file))
+    with open(job_file, 'w') as f:
+        json.dump(job, f)
+
+
+def wait_and_apply(service, job, poll_seconds):
+    from datamodel import DataModel
+    from tags import Tags
+
+    while True:
+        try:
+            if service.done(job['batch_id']):
+                break
+        except requests.RequestException as e:
+            # The batch carries on without us; just ask again next time
+            log.warning(f'Could not check on batch {job["batch_id"]}: {e}')
+        time.sleep(poll_seconds)
+
+    stories = {story['id']: story for story in DataModel().get_stories()}
+    tags_by_id = {}
+    failed = 0
+    for custom_id, results in service.results(job['batch_id']):
+        batch = [stories[story_id] for story_id in job['requests'].get(custom_id, []) if story_id in stories]
+        if results is None:
+            failed += len(batch)
+            continue
+        for story in llm.match_results(batch, results):
+            tags_by_id[story['id']] = story['tags']
+
+    # All of it in one go, so readers never see a half-applied backfill
+    DataModel().apply_story_tags(tags_by_id)
+    Tags().touch_tags([tag for tags in tags_by_id.values() for tag in tags])
+    logs.audit('backfill', batch_id=job['batch_id'], service=job['service'], tagged=len(tags_by_id), failed=failed)
+    log.info(f'Tagged {len(tags_by_id)} stories; {failed} were in requests that failed')
+    os.remove(job_file)
+
+
+def run(name, retag, poll_seconds):
+    service = services[name]()
+    stories = select_stories(retag)
+    if not stories:
+        log.info('Nothing to tag')
+        return
+
+    requests_by_id = build_requests(service, name, stories)
+    batch_id = service.submit({custom_id: body for custom_id, (_, body) in requests_by_id.items()})
+    log.info(f'Submitted {len(stories)} headlines in {len(requests_by_id)} requests as batch {batch_id}')
+
+    # Remember the job, so a restart can pick up where this left off (--resume)
+    job = {'service': name, 'batch_id': batch_id,
+           'requests': {custom_id: ids for custom_id, (ids, _) in requests_by_id.items()}}
+    save_job(job)
+    wait_and_apply(service, job, poll_seconds)
+
+
+def resume(poll_seconds):
+    with open(job_file) as f:
+        job = json.load(f)
+    log.info(f'Resuming batch {job["batch_id"]} on {job["service"]}')
+    wait_and_apply(services[job['service']](), job, poll_seconds)
+
+
+#    ┌──────────────────────────────────────────────────────────┐
+#    │    A stand-in for both batch APIs, for testing.  It      │
+#    │    keeps everything in memory, finishes each batch the   │
+#    │    moment it's submitted, and tags with the pre-tagger.  │
+#    └──────────────────────────────────────────────────────────┘
+class StandInHandler(BaseHTTPRequestHandler):
+    batches = {}
+    files = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def tag(prompt):
+        from pretagger import Pretagger
+        headlines = json.loads(prompt)
+        pretagger = Pretagger()
+        with StandInHandler.lock:
+            pretagger.refresh([], [h['headline'] for h in headlines])
+            return {"results": [{"id": h.get('id'), "tags": pretagger.tag(h['headline'])[0]} for h in headlines]}
+
+    def anthropic_message(self, params):
+        results = self.tag(params['messages'][-1]['content'])
+        if params.get('tools'):
+            content = [{"type": "tool_use", "id": f'toolu_{uuid.uuid4().hex[:12]}', "name": "record_tags",
+                        "input": results}]
+        else:
+            content = [{"type": "text", "text": json.dumps(results['results'])}]
+        return {"type": "message", "role": "assistant", "content": content, "stop_reason": "end_turn"}
+
+    def openai_completion(self, body):
+        results = self.tag(body['messages'][-1]['content'])
+        text = json.dumps(results if 'response_format' in body else results['results'])
+        return {"choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                             "finish_reason": "stop"}]}
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_text(self, text):
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/jsonl')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.path == '/v1/messages/batches':
+            lines = [json.dumps({"custom_id": r['custom_id'],
+                                 "result": {"type": "succeeded", "message": self.anthropic_message(r['params'])}})
+                     for r in json.loads(body)['requests']]
+            batch_id = f'msgbatch_{uuid.uuid4().hex[:12]}'
+            self.batches[batch_id] = '\n'.join(lines)
+            return self.send_json({"id": batch_id, "type": "message_batch", "processing_status": "in_progress"})
+
+        if self.path == '/v1/files':
+            # Just enough multipart parsing to find the file
+            message = email.parser.BytesParser().parsebytes(
+                b'Content-Type: ' + self.headers['Content-Type'].encode('latin-1') + b'\r\n\r\n' + body)
+            content = next(part.get_payload(decode=True) for part in message.get_payload()
+                           if part.get_filename())
+            file_id = f'file_{uuid.uuid4().hex[:12]}'
+            self.files[file_id] = content.decode('utf-8')
+            return self.send_json({"id": file_id, "object": "file", "purpose": "batch"})
+
+        if self.path == '/v1/batches':
+            request = json.loads(body)
+            lines = []
+            for line in self.files[request['input_file_id']].splitlines():
+                entry = json.loads(line)
+                lines.append(json.dumps({"custom_id": entry['custom_id'],
+                                         "response": {"status_code": 200,
+                                                      "body": self.openai_completion(entry['body'])}}))
+            output_id = f'file_{uuid.uuid4().hex[:12]}'
+            self.files[output_id] = '\n'.join(lines)
+            batch_id = f'batch_{uuid.uuid4().hex[:12]}'
+            self.batches[batch_id] = output_id
+            return self.send_json({"id": batch_id, "object": "batch", "status": "validating"})
+
+        self.send_json({"error": {"message": f'No such endpoint: {self.path}'}}, 404)
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts[:3] == ['v1', 'messages', 'batches'] and len(parts) == 4 and parts[3] in self.batches:
+            return self.send_json({"id": parts[3], "type": "message_batch", "processing_status": "ended"})
+        if parts[:3] == ['v1', 'messages', 'batches'] and len(parts) == 5 and parts[3] in self.batches:
+            return self.send_text(self.batches[parts[3]])
+        if parts[:2] == ['v1', 'batches'] and len(parts) == 3 and parts[2] in self.batches:
+            return self.send_json({"id": parts[2], "object": "batch", "status": "completed",
+                                   "output_file_id": self.batches[parts[2]]})
+        if parts[:2] == ['v1', 'files'] and len(parts) == 4 and parts[2] in self.files:
+            return self.send_text(self.files[parts[2]])
+        self.send_json({"error": {"message": f'No such endpoint: {self.path}'}}, 404)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def serve(port):
+    server = ThreadingHTTPServer(('127.0.0.1', port), StandInHandler)
+    log.info(f'Stand-in batch API on http://127.0.0.1:{port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tag stories through a provider batch API')
+    default_service = os.getenv('LLM_MODEL', 'anthropic').lower()
+    parser.add_argument('--service', choices=sorted(services),
+                        default=default_service if default_service in services else 'anthropic')
+    parser.add_argument('--retag', action='store_true', help='re-tag every story, not just untagged ones')
+    parser.add_argument('--resume', action='store_true', help='wait for the batch a previous run submitted')
+    parser.add_argument('--poll', type=int, default=60, help='seconds between status checks')
+    parser.add_argument('--serve', type=int, metavar='PORT', help='run the stand-in batch API instead')
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+    elif args.resume:
+        resume(args.poll)
+    else:
+        run(args.service, args.retag, args.poll)
@@ -19,6 +19,12 @@
 #    └────────────────────────────────────────────────────────────────────┘
 import json
 from enum import Enum, auto
+import logs
+import metrics
+from tracing import traced
+
+log = logs.get_logger('badjson')
+outcomes = metrics.counter('badjson_loads_total', 'LLM responses parsed, by outcome (clean, repaired, failed)')
 
 
 #    ┌──────────────────────────────────────────────────────────┐
@@ -45,6 +51,7 @@ class JsonState(Enum):
 #    │    If not, we let the exception bubble up to our         │
 #    │    callers.                                              │
 #    └──────────────────────────────────────────────────────────┘
+@traced
 def loads(bad_json_string: str) -> dict | list:
 
     good_json = ''
@@ -161,7 +168,7 @@ def loads(bad_json_string: str) -> dict | list:
             continue
 
         # Should never happen, if it does, bug in the code
-        print('Illegal state in bad_json_loads')
+        log.error('Illegal state in bad_json_loads')
 
 
     good_json = good_json.strip()
@@ -178,7 +185,7 @@ def loads(bad_json_string: str) -> dict | list:
         good_json += '}'
 
     # This is optimistic
-    print(f"Supposedly Good JSON:\n{good_json}", flush=True)
+    log.debug(f"Supposedly Good JSON: {good_json}")
 
     try:
         # Here's where the rubber meets the road
@@ -206,10 +213,13 @@ def loads(bad_json_string: str) -> dict | list:
     except json.JSONDecodeError as e:
         # Still not legal JSON, so we need to see what we got, and why it failed
         # And then we'll either fix this code, or try to fix the LLM interface
-        print(f"Error parsing JSON: {e}", flush=True)
-        print(f"JSON: {good_json}", flush=True)
+        log.warning(f"Error parsing JSON: {e}")
+        log.debug(f"JSON: {good_json}")
+        outcomes.inc(outcome='failed')
         raise
 
+    outcomes.inc(outcome='clean' if good_json == bad_json_string.strip() else 'repaired')
+
     return parsed_response
 
 # This is a quick test of the loads function
@@ -0,0 +1,281 @@
+#    ┌────────────────────────────────────────────────────────────────────┐
+#    │                                                                    │
+#    │                            Benchmarks                              │
+#    │                                                                    │
+#    │    CNN Lite has a few hundred headlines at a time, so that's all   │
+#    │    DataModel, Tags and the ranking have ever had to cope with.     │
+#    │    This finds out what happens with far more: it makes up          │
+#    │    databases of 1k, 10k, 100k and 1M stories, with tags drawn      │
+#    │    from a Zipf distribution (a few tags on lots of stories, lots   │
+#    │    of tags on a few, like the real thing) and a history of likes   │
+#    │    and dislikes, then times each hot path at each size:            │
+#    │                                                                    │
+#    │        ingest          write_stories, a batch of new headlines     │
+#    │        story_exists    the in-memory duplicate check               │
+#    │        fetch_stories   fetch_all_stories, the whole table          │
+#    │        tag_weights     reading the tags and working out scores     │
+#    │        story_matrix    build_story_matrix, stories to tag ids      │
+#    │        rank            get_scored_articles, top 25                 │
+#    │        rank_reader     the same for a named reader                 │
+#    │        feedback        apply_feedback, a batch of 20 events        │
+#    │        search          search_stories, a rare word                 │
+#    │        tag_search      stories_with_tags, one popular tag          │
+#    │                                                                    │
+#    │        python benchmark.py --sizes 1000,10000                      │
+#    │        python benchmark.py --compare temp/benchmark/<old>.json     │
+#    │                                                                    │
+#    └────────────────────────────────────────────────────────────────────┘
+import argparse
+import bisect
+import datetime
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+
+try:
+    import resource     # not on Windows
+except ImportError:
+    resource = None
+
+import datamodel
+import logs
+from profiles import Profiles
+from records import Story
+from tags import Tags
+
+log = logs.get_logger('benchmark')
+
+benchmark_dir = os.path.join('temp', 'benchmark')
+default_sizes = '1000,10000,100000,1000000'
+
+
+#    ┌──────────────────────────────────────────────────────────┐
+#    │                    Synthetic News Data                   │
+#    └──────────────────────────────────────────────────────────┘
+class Synthetic:
+    def __init__(self, stories, seed=1, exponent=1.1, tags_per_story=(1, 5), span_hours=36):
+        self.rng = random.Random(seed)
+        self.story_count = stories
+        # Real vocabularies grow more slowly than the number of stories
+        self.vocabulary = [f'topic {i}' for i in range(max(50, int(20 * stories ** 0.5)))]
+        weights = [1 / (rank + 1) ** exponent for rank in range(len(self.vocabulary))]
+        self.cum_weights = []
+        total = 0.0
+        for weight in weights:
+            total += weight
+            self.cum_weights.append(total)
+        self.tags_per_story = tags_per_story
+        # Inside the database's retention, so nothing gets archived in the middle of a benchmark
+        self.span = span_hours * 3600
+
+    def zipf_tag(self):
+        return self.vocabulary[bisect.bisect(self.cum_weights, self.rng.random() * self.cum_weights[-1])]
+
+    def story_tags(self):
+        tags = []
+        for _ in range(self.rng.randint(*self.tags_per_story)):
+            tag = self.zipf_tag()
+            if tag not in tags:
+                tags.append(tag)
+        return tags
+
+    def headline(self, i):
+        return f'Synthetic headline number {i} about {self.zipf_tag()}'
+
+    @staticmethod
+    def url(i):
+        return f'/2026/01/01/synthetic/story-{i}/index.html'
+
+    # (id, headline, url, read, date, tags) rows, ready for the stories table
+    def stories(self):
+        now = datetime.datetime.now()
+        for i in range(1, self.story_count + 1):
+            date = now - datetime.timedelta(seconds=self.rng.random() * self.span)
+            yield i, self.headline(i), self.url(i), int(self.rng.random() < 0.1), date, ','.join(self.story_tags())
+
+    # Opinions are Zipf too: the common tags are the ones people have feelings about
+    def tag_scores(self, liked=0.2):
+        scored = set(self.zipf_tag() for _ in range(int(len(self.vocabulary) * liked)))
+        return {tag: (self.rng.uniform(-1, 1), self.rng.randint(1, 20)) for tag in scored}
+
+    def feedback_events(self, count, prefix):
+        return [{'id': f'{prefix}-{i}', 'kind': self.rng.choice(('like', 'like', 'dislike', 'read')),
+                 'story': self.rng.randint(1, self.story_count), 'at': time.time()} for i in range(count)]
+
+
+#   Point every singleton at a fresh database (and forget the last one)
+def open_database(path):
+    instance = datamodel.DataModel._instance.pop(threading.get_ident(), None)
+    if instance is not None:
+        instance.conn.close()
+    Tags._instance = None
+    Profiles._instance = None
+    datamodel.database_file = path
+    return datamodel.DataModel()
+
+
+#   Far quicker than upsert_story, which is one of the things being measured
+def populate(path, synthetic, reader):
+    if os.path.exists(path):
+        os.remove(path)
+    d = open_database(path)
+    d.cur.execute("BEGIN")
+    d.cur.executemany("INSERT INTO stories (id, headline, url, read, date, tags) VALUES (?, ?, ?, ?, ?, ?)",
+                      synthetic.stories())
+    now = time.time()
+    scores = synthetic.tag_scores()
+    tag_ids = {tag: i + 1 for i, tag in enumerate(synthetic.vocabulary)}
+    d.cur.executemany("INSERT INTO tags (text, score, count, id, updated, seen) VALUES (?, ?, ?, ?, ?, ?)",
+                      [(tag, *scores.get(tag, (0, 0)), tag_id, now - synthetic.rng.random() * 90 * 86400, now)
+                       for tag, tag_id in tag_ids.items()])
+    d.cur.executemany("INSERT INTO profiles (user_id, tag_id, score, count, updated) VALUES (?, ?, ?, ?, ?)",
+                      [(reader, tag_ids[tag], score, count, now)
+                       for tag, (score, count) in synthetic.tag_scores().items()])
+    d.bump_version('stories')
+    d.bump_version('tags')
+    d.conn.commit()
+    d.rebuild_search_indexes()
+    return open_database(path)
+
+
+#    ┌──────────────────────────────────────────────────────────┐
+#    │                         Timing                           │
+#    └──────────────────────────────────────────────────────────┘
+
+#   Runs `function` `repeat` times, each doing `operations` operations, and reports the best and the
+#   median, per operation
+def measure(function, repeat, operations=1):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) / operations)
+    return {'best_ms': round(min(times) * 1000, 4), 'median_ms': round(statistics.median(times) * 1000, 4)}
+
+
+def run_size(size, repeat, reader='benchmark'):
+    import cnnlite      # drags in the LLM code, so only when needed
+
+    os.makedirs(benchmark_dir, exist_ok=True)
+    path = os.path.join(benchmark_dir, f'bench-{size}.db')
+    synthetic = Synthetic(size)
+
+    start = time.perf_counter()
+    d = populate(path, synthetic, reader)
+    seed_seconds = time.perf_counter() - start
+    log.info(f'{size} stories seeded in {seed_seconds:.1f}s')
+
+    results = {'seed_s': round(seed_seconds, 2), 'vocabulary': len(synthetic.vocabulary)}
+    d.fetch_all_stories()
+
+    # Each round adds a few more headlines, as a refresh's writer would
+    next_id = [size + 1]
+
+    def ingest():
+        d.write_stories([Story(None, synthetic.headline(i), synthetic.url(i), 0, None, tuple(synthetic.story_tags()))
+                         for i in range(next_id[0], next_id[0] + 10)])
+        next_id[0] += 10
+    results['ingest'] = measure(ingest, repeat, 10)
+
+    lookups = [(synthetic.headline(i), synthetic.url(i)) for i in synthetic.rng.sample(range(1, size + 1), 10)]
+
+    def story_exists():
+        for headline, url in lookups:
+            d.story_exists(headline, url)
+    results['story_exists'] = measure(story_exists, repeat, len(lookups))
+
+    results['fetch_stories'] = measure(d.fetch_all_stories, repeat)
+
+    tag_hist = Tags()
+
+    def tag_weights():
+        tag_hist.read_tags()
+        tag_hist.weights()
+    results['tag_weights'] = measure(tag_weights, repeat)
+
+    results['story_matrix'] = measure(cnnlite.CNNLite.build_story_matrix, repeat)
+    rows = cnnlite.CNNLite.build_story_matrix()
+    results['rank'] = measure(lambda: cnnlite.CNNLite.get_scored_articles(rows=rows)[:25], repeat)
+    results['rank_reader'] = measure(lambda: cnnlite.CNNLite.get_scored_articles(reader, rows=rows)[:25], repeat)
+
+    batches = iter(range(repeat))
+    results['feedback'] = measure(lambda: d.apply_feedback(
+        reader, synthetic.feedback_events(20, f'bench-{next(batches)}'), tag_hist.rescore), repeat, 20)
+
+    queries = [str(synthetic.rng.randint(1, size)) for _ in range(10)]
+    results['search'] = measure(lambda: [d.search_stories(query) for query in queries], repeat, len(queries))
+    popular = [[synthetic.zipf_tag()] for _ in range(10)]
+    results['tag_search'] = measure(lambda: [d.stories_with_tags(tags) for tags in popular], repeat, len(popular))
+
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+#   ru_maxrss only ever goes up, so it's the peak for this size and those before it.  It's kilobytes on
+#   Linux but bytes on macOS, and Windows doesn't have it at all (None).
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (2 ** 20 if sys.platform == 'darwin' else 1024), 1)
+
+
+#    ┌──────────────────────────────────────────────────────────┐
+#    │                    Reports & Baselines                   │
+#    └──────────────────────────────────────────────────────────┘
+benchmarks = ('ingest', 'story_exists', 'fetch_stories', 'tag_weights', 'story_matrix', 'rank', 'rank_reader',
+              'feedback', 'search', 'tag_search')
+
+
+def print_report(result):
+    sizes = list(result['sizes'])
+    print(f'\nmedian milliseconds per operation{"":<4}' + ''.join(f'{size:>12}' for size in sizes))
+    for name in benchmarks:
+        print(f'{name:<37}' + ''.join(f'{result["sizes"][size][name]["median_ms"]:>12}' for size in sizes))
+    print(f'{"seeding (s)":<37}' + ''.join(f'{result["sizes"][size]["seed_s"]:>12}' for size in sizes))
+    print(f'{"peak RSS (MB)":<37}' + ''.join(f'{result["sizes"][size]["peak_rss_mb"] or "-":>12}' for size in sizes))
+
+
+def compare(result, baseline, tolerance):
+    regressed = False
+    for size, rows in result['sizes'].items():
+        before = baseline['sizes'].get(size)
+        if before is None:
+            continue
+        for name in benchmarks:
+            if name in before and rows[name]['median_ms'] > before[name]['median_ms'] * (1 + tolerance):
+                regressed = True
+                print(f'REGRESSION {name} at {size}: {before[name]["median_ms"]} -> {rows[name]["median_ms"]} ms')
+    if not regressed:
+        print(f'No regressions beyond {tolerance:.0%} of {baseline.get("commit") or "the baseline"}')
+    return regressed
+
+
+if __name__ == '__main__':
+    from loadtest import git_commit
+
+    parser = argparse.ArgumentParser(description='Time DataModel, Tags and ranking on synthetic data')
+    parser.add_argument('--sizes', default=default_sizes, help=f'story counts (default {default_sizes})')
+    parser.add_argument('--repeat', type=int, default=5, help='times to run each benchmark')
+    parser.add_argument('--save', help='write the results here (default temp/benchmark/<time>.json)')
+    parser.add_argument('--compare', help='a saved result to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='how much slower counts as a regression')
+    args = parser.parse_args()
+
+    result = {'commit': git_commit(), 'time': time.time(), 'repeat': args.repeat, 'sizes': {}}
+    for size in (int(size) for size in args.sizes.split(',')):
+        result['sizes'][str(size)] = run_size(size, args.repeat)
+    print_report(result)
+
+    save = args.save or os.path.join(benchmark_dir, f'{time.strftime("%Y%m%d-%H%M%S")}.json')
+    with open(save, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f'Saved to {save}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            sys.exit(1 if compare(result, json.load(f), args.tolerance) else 0)
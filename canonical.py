@@ -0,0 +1,99 @@
+#    ┌────────────────────────────────────────────────────────────────────┐
+#    │                                                                    │
+#    │                           Canonical Tags                           │
+#    │                                                                    │
+#    │    LLMs aren't consistent about what they call things: "Biden",    │
+#    │    "Joe Biden" and "President Biden" are all the same person,      │
+#    │    but as tags they'd each get their own score, and liking one     │
+#    │    would teach us nothing about the others.                        │
+#    │                                                                    │
+#    │    So every tag is run through the same rules before it's          │
+#    │    stored: lowercase, tidy up punctuation and spacing, drop        │
+#    │    titles like "President", and finally look it up in a table of   │
+#    │    aliases.  Extra aliases can be added to the tag_aliases table   │
+#    │    in the database without touching the code.                     │
+#    │                                                                    │
+#    │    The built-in aliases are only the ones that can't be wrong      │
+#    │    (spellings, abbreviations).  A bare surname could be anyone     │
+#    │    in the family, and the migration rewrites every stored story,   │
+#    │    so "biden" -> "joe biden" belongs in tag_aliases, where it's    │
+#    │    a choice someone made for their own database.                  │
+#    │                                                                    │
+#    │    If you change the rules here, bump rules_version and the        │
+#    │    existing tags and stories will be migrated on the next start.   │
+#    │                                                                    │
+#    └────────────────────────────────────────────────────────────────────┘
+import re
+import sys
+import unicodedata
+
+rules_version = 2
+
+# Only titles that are (nearly) always followed by a name; "justice department" is not a person
+titles = (
+    'former president', 'vice president', 'president', 'prime minister', 'senator', 'sen.', 'rep.', 'gov.',
+    'dr.', 'gen.', 'pope', 'mr.', 'mrs.', 'ms.',
+)
+
+# alias -> canonical form (both already normalized)
+aliases = {
+    'volodymyr zelenskyy': 'volodymyr zelensky',
+    'us': 'usa',
+    'u.s': 'usa',
+    'u.s.': 'usa',
+    'u.s.a': 'usa',
+    'u.s.a.': 'usa',
+    'america': 'usa',
+    'united states': 'usa',
+    'united states of america': 'usa',
+    'uk': 'united kingdom',
+    'u.k': 'united kingdom',
+    'u.k.': 'united kingdom',
+    'britain': 'united kingdom',
+    'great britain': 'united kingdom',
+    'economics': 'economy',
+    'sport': 'sports',
+    'politic': 'politics',
+    'political': 'politics',
+}
+
+# Extra aliases from the database, installed by DataModel
+custom_aliases = {}
+
+whitespace = re.compile(r'\s+')
+edge_punctuation = '"\'`“”‘’.,;:!?()[]{}#*'
+
+
+def normalize(tag: str) -> str:
+    tag = unicodedata.normalize('NFKC', tag).lower()
+    tag = tag.replace('’', "'")
+    tag = whitespace.sub(' ', tag).strip().strip(edge_punctuation).strip()
+
+    if tag.endswith("'s"):
+        tag = tag[:-2]
+    if tag.startswith('the '):
+        tag = tag[4:]
+
+    for title in titles:
+        if tag.startswith(title + ' ') and not tag.startswith(title + ' of '):
+            tag = tag[len(title) + 1:]
+            break
+
+    return tag.strip()
+
+
+def canonicalize(tag: str) -> str:
+    tag = normalize(tag)
+    tag = custom_aliases.get(tag, aliases.get(tag, tag))
+    # Lots of stories share the same tags, so keep just one copy of each string
+    return sys.intern(tag)
+
+
+# Canonicalize a list of tags, dropping empties and duplicates but keeping the order
+def canonicalize_all(tags):
+    result = []
+    for tag in tags:
+        tag = canonicalize(tag)
+        if tag and tag not in result:
+            result.append(tag)
+    return result
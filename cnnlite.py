@@ -9,23 +9,47 @@
 #    │                                                                   │
 #    └───────────────────────────────────────────────────────────────────┘
 
-from bs4 import BeautifulSoup
+import os
 import requests
 import time
 import llm
 import json
+import canonical
+import coordinator
 from tags import Tags
 from datamodel import DataModel
+from pretagger import Pretagger
+from profiles import Profiles
+from records import RankedStory, Story
+import pipeline
 import utilities
-import csv
-import os
+import scheduler
+import snapshot
+import logs
+import metrics
+from tracing import traced, Profiler
+import re
+import threading
+import base64
+import bisect
+import itertools
+from collections import OrderedDict
 
 
 u = utilities.Utilities()
+log = logs.get_logger('cnnlite')
+
+fetch_seconds = metrics.histogram('cnn_fetch_seconds', 'Time to download the CNN Lite page')
+parse_seconds = metrics.histogram('cnn_parse_seconds', 'Time to parse the CNN Lite page')
+tagging_backlog = metrics.gauge('tagging_backlog', 'Headlines waiting to be tagged')
+pretag_results = metrics.counter('pretagger_headlines_total',
+                                'Headlines by who tagged them (cache, local or llm)')
+snapshot_requests = metrics.counter('cache_requests_total', 'Cache lookups, by cache and result (hit or miss)')
 
 
 class CNNLite:
     _instance = None
+    init_lock = threading.Lock()
 
     def __new__(cls):
         if cls._instance is None:
@@ -33,27 +57,45 @@ class CNNLite:
         return cls._instance
 
     def __init__(self):
-        if "last_refresh" not in self.__dict__:
+        # Requests arrive together at start-up; none of them may see a half-built instance
+        with CNNLite.init_lock:
+            if "last_refresh" in self.__dict__:
+                return
 
             self.last_refresh = 0
-            self.refresh_time = 300     # seconds, CNN doesn't update headlines that fast
-
-            # This is a debugging log that will be used to store the headlines and tags in case
-            # something looks suspicious in the UI
-            if not os.path.exists('temp'):
-                os.mkdir('temp')
-
-            with open('temp/articles.csv', 'w', newline='') as f:
-                cw = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                cw.writerow(['headline', 'url', 'tags'])
+            # Seconds until we look at CNN again, which the scheduler adjusts to how busy the news is
+            self.scheduler = scheduler.RefreshScheduler()
+            self.refresh_time = self.scheduler.interval
+            # Somewhere else to read headlines from, like the stand-in loadtest.py runs
+            self.cnn_url = os.getenv('CNN_URL', 'https://lite.cnn.com')
 
             self.headline_size_cutoff = 10
             self.headline_suspicious_cutoff = 30
 
-            ol = llm.LLM()
-            self.batch_size = ol.get_batch_size()
             self.max_tags = 5
 
+            #    ┌──────────────────────────────────────────────────────────┐
+            #    │    Tagging is done most-interesting-first: headlines     │
+            #    │    near the top of the page, boosted by words we         │
+            #    │    already know the user likes.  Once the first page     │
+            #    │    worth is tagged, the UI is told it can show it.       │
+            #    └──────────────────────────────────────────────────────────┘
+            self.page_positions = {}
+            self.interest_boost = 20    # How many page positions one point of tag score is worth
+            self.first_page_count = 10
+            self.tagging_lock = threading.Lock()
+            self.progress = {'state': 'working', 'tagged': 0, 'remaining': 0}
+            self.batch_wait = 0.5       # Seconds a part-filled batch waits for company before going anyway
+            self.write_batch_size = 20
+
+            # The most recent ranking for each reader (None is the default reader), shared by the
+            # home page and the JSON API, and the story/tag matrix they are all ranked from
+            self.snapshots = OrderedDict()
+            self.max_snapshots = 100
+            self.matrix = None
+            self.snapshot_lock = threading.Lock()
+            self.max_removed = 1000     # How many dropped story ids we remember for syncing clients
+
             #    ┌──────────────────────────────────────────────────────────┐
             #    │        Since we want to be a responsible user, if        │
             #    │     debugging is set we will use a cached version of     │
@@ -61,19 +103,39 @@ class CNNLite:
             #    └──────────────────────────────────────────────────────────┘
             self.debugging = False
 
-            self.refresh_list()
+        self.refresh_list()
+
+    # Call this to see if there's anything new posted on CNN.  Under a multi-worker server,
+    # only the elected worker's background thread (the owner) does this
+    def refresh_list(self, owner=False):
+        if not coordinator.Coordinator().may_refresh(owner):
+            return
+
+        # If someone asked to profile the next refresh, this is it (but not the no-op calls in between)
+        due = time.time() - self.last_refresh >= self.refresh_time
+        profile = Profiler().start('refresh') if due else None
+        try:
+            ran = self.update_articles(profile)
+        finally:
+            Profiler().stop(profile)
+        if not ran:
+            return
+        u.publish("ranking", {"time": time.time()})
 
-    # Call this to see if there's anything new posted on CNN
-    def refresh_list(self):
-        self.fetch_new_articles()
-        self.score_articles()
+        # Keep a copy of the results around for a quick start next time
+        self.save_snapshot()
+        Tags().compact_if_due()
 
     # The UI wants to know if it's time to refresh when the user reloads the page
     def time_for_refresh(self):
+        # Somebody else is refreshing in the background, so never send the reader to the llamas
+        if coordinator.Coordinator().managed:
+            return False
+
         ttr = time.time() - self.last_refresh >= self.refresh_time
 
         if ttr:
-            print('*** Time to refresh CNN ***', flush=True)
+            log.info('*** Time to refresh CNN ***')
 
         return ttr
 
@@ -81,11 +143,11 @@ class CNNLite:
     # real headlines, so we can use a heuristic to cull them
     def skip_headline(self, headline: str, url: str) -> bool:
         if url.startswith('https://'):
-            print(f'Skipping non-article link {headline}: {url}')
+            log.debug(f'Skipping non-article link {headline}: {url}')
             return True
 
         if len(headline) <= self.headline_size_cutoff:
-            print(f'Skipping short headline {headline}: {url}')
+            log.debug(f'Skipping short headline {headline}: {url}')
             return True
 
         if headline == 'Go to the full CNN experience':
@@ -95,71 +157,82 @@ class CNNLite:
             return True
 
         if len(headline) < self.headline_suspicious_cutoff:
-            print(f'Suspicious headline: {headline}: {url}')
+            log.info(f'Suspicious headline: {headline}: {url}')
 
         return False
 
-    def fetch_new_articles(self):
+    # The new headlines on CNN Lite, each handed on (with an id of its own) as soon as it's found, so
+    # tagging can start while the rest of the page is still being read
+    def page_stories(self):
+        from bs4 import BeautifulSoup   # Only needed here, so don't make every startup pay for it
 
         database = DataModel()
 
-        # Only refresh the list every n minutes, we don't want to annoy CNN
-        if time.time() - self.last_refresh < self.refresh_time:
-            return
-
         if self.debugging:
-            print("\u250C" + ("\u2500"*38) + "\u2510")
-            print("\u2502              DEBUG MODE              \u2502")
-            print("\u2502                                      \u2502")
-            print("\u2502     We are reading from a cached     \u2502")
-            print("\u2502    file, not live data from CNN.     \u2502")
-            print("\u2514"+("\u2500"*38)+"\u2518")
+            log.warning("DEBUG MODE: We are reading from a cached file, not live data from CNN.")
 
         self.last_refresh = time.time()
 
         u.update_status("working", "Fetching articles from CNN Lite")
 
         # Pull down the latest list of stories
-        base_url = 'https://lite.cnn.com'
+        base_url = self.cnn_url
         if self.debugging:
             with open('cached_cnnlite_response.html', 'r') as f:
                 html_content = f.read()
         else:
             # Fetch the HTML content
-            print('*** Fetchihng from CNN ***')
-            response = requests.get(base_url)
-            html_content = response.text
+            log.info('*** Fetching from CNN ***')
+            try:
+                with fetch_seconds.time():
+                    response = requests.get(base_url, timeout=30)
+                    response.raise_for_status()
+                    html_content = response.text
+            except requests.RequestException:
+                self.refresh_time = self.scheduler.record_error()
+                raise
             # save it for use in debugging
             with open('cached_cnnlite_response.html', 'w') as f:
                 f.write(html_content)
 
         # Parse the HTML content using BeautifulSoup
-        soup = BeautifulSoup(html_content, 'html.parser')
+        with parse_seconds.time():
+            soup = BeautifulSoup(html_content, 'html.parser')
+            links = soup.find_all('a', href=True)
 
         u.update_status("working", "Parsing articles from CNN Lite.  Find 0 new articles.")
 
         new_count = 0
+        self.page_positions = {}
+        seen = set()
 
         # The CNN Lite page is basically a list of headlines as hyperlinks, so it's easy
         # to pull them out
-        for a_tag in soup.find_all('a', href=True):
+        for a_tag in links:
             headline = a_tag.get_text(strip=True)
 
             if self.skip_headline(headline, a_tag['href']):
                 continue
 
             url = base_url + a_tag['href']
+            self.page_positions.setdefault(url, len(self.page_positions))
 
-            story_id = database.story_exists(headline, url)
-
-            if story_id == -1:
-                database.upsert_story({"headline": headline, "url": url, "tags": [], "score": 0, "read": 0})
-                new_count += 1
+            if (headline, url) in seen or database.find_story(headline, url) is not None:
+                continue
+            seen.add((headline, url))
 
+            # No id until the writer stores it, when SQLite hands one out
+            story = Story(None, headline, url, 0, None, ())
+            new_count += 1
+            u.publish("story", {"headline": headline})
+            logs.audit('found', headline=headline, url=url)
             u.update_status("working", f"Parsing articles from CNN Lite.  Find {new_count} new articles.")
+            yield story
+
+        self.refresh_time = self.scheduler.record(new_count, self.last_refresh)
 
     @staticmethod
-    def llama_news(count):
+    def llama_news(count, state="working"):
 
         llamas = [
             "Larry doesn't want to tarry with headline",
@@ -170,66 +243,178 @@ class CNNLite:
         ]
         w = int(time.time() * 1000) % len(llamas)
 
-        u.update_status("working", llamas[w] + f" #{count+1}")
-
-    def score_articles(self):
-        chat_engine = llm.LLM()
-        database = DataModel()
-
-        u.update_status("working", "Tagging articles from CNN Lite.")
+        u.update_status(state, llamas[w] + f" #{count+1}")
+
+    # Lower numbers get tagged sooner
+    def tagging_priority(self, story, tag_scores):
+        position = self.page_positions.get(story['url'], len(self.page_positions))
+
+        words = re.findall(r"[\w'-]+", story['headline'].lower())
+        phrases = words + [' '.join(pair) for pair in zip(words, words[1:])]
+        interest = sum(max(tag_scores.get(canonical.canonicalize(phrase), 0), 0) for phrase in phrases)
+
+        return position - interest * self.interest_boost
+
+    #    ┌──────────────────────────────────────────────────────────┐
+    #    │    A refresh is a pipeline (see pipeline.py): this       │
+    #    │    thread reads the page and hands on each new           │
+    #    │    headline as it finds it.  Ones we can tag ourselves   │
+    #    │    go straight to the writer; the rest queue up for an   │
+    #    │    LLM thread, which sorts them once the page is read    │
+    #    │    and passes them on to the writer as they come back.   │
+    #    │    The writer saves them in batches.                     │
+    #    └──────────────────────────────────────────────────────────┘
+    # Returns True if it went to CNN, False if it wasn't time (or someone else was at it).
+    @traced
+    def update_articles(self, profile=None):
+        # If another thread is already tagging, let it finish the job
+        if not self.tagging_lock.acquire(blocking=False):
+            return False
+        try:
+            # Only refresh the list every n minutes, we don't want to annoy CNN
+            if time.time() - self.last_refresh < self.refresh_time:
+                return False
+            # Anything an earlier refresh didn't manage to tag gets another go
+            self.run_pipeline(DataModel().get_untagged_stories(), profile)
+            return True
+        finally:
+            self.tagging_lock.release()
+            logs.flush()
 
-        print('Tagging articles: 0', flush=True)
-        articles = database.get_stories()
+    def run_pipeline(self, backlog, profile=None):
+        chat_engine = llm.engine()
+        tag_hist = Tags()
+        tag_scores = {tag['text']: tag_hist.effective_score(tag) for tag in tag_hist.tags}
 
-        new_articles = []
-        for article in articles:
-            if len(article['tags']) == 0:
-                new_articles.append(article)
+        # The local pre-tagger goes first; only the headlines it isn't sure about go to an LLM
+        pretagger = Pretagger()
+        pretagger.refresh([tag['text'] for tag in tag_hist.tags], [story['headline'] for story in DataModel().stories])
 
+        u.update_status("working", "Tagging articles from CNN Lite.")
+        self.progress = {'state': 'working', 'tagged': 0, 'remaining': 0}
+
+        # If this refresh is being profiled, the stages are too
+        flow = pipeline.Pipeline('refresh', profile=profile)
+        to_llm = flow.queue()
+        to_store = flow.queue()
+        flow.stage('llm', lambda stories: self.llm_tagging(stories, chat_engine, tag_scores),
+                   pipeline.drain(to_llm), [to_store])
+        flow.stage('store', self.store_stories,
+                   pipeline.batches(to_store, self.write_batch_size, self.batch_wait, producers=2))
+
+        try:
+            for story in itertools.chain(self.page_stories(), backlog):
+                tags = self.quick_tags(story, pretagger)
+                if tags:
+                    to_store.put(story.replace(tags=tags, read=0))
+                else:
+                    self.progress['remaining'] += 1
+                    to_llm.put(story)
+        finally:
+            to_llm.put(pipeline.finished)
+            to_store.put(pipeline.finished)
+            flow.join()
+            tagging_backlog.set(0)
+
+    # Tags we can give a story without an LLM: the ones it already has under another URL, or the
+    # pre-tagger's if it's sure of them.  Empty if it's one for the LLM.
+    def quick_tags(self, story, pretagger):
+        tags = DataModel().known_tags(story['headline'])
+        if tags:
+            source, confidence = 'cache', 1.0
+        else:
+            tags, confidence = pretagger.tag(story['headline'])
+            tags = canonical.canonicalize_all(tags)
+            if confidence < pretagger.threshold or len(tags) == 0:
+                pretag_results.inc(result='llm')
+                return ()
+            source = 'local'
+        pretag_results.inc(result=source)
+        logs.audit('tagged', headline=story['headline'], url=story['url'], tags=list(tags), source=source,
+                   confidence=round(confidence, 2))
+        return tuple(tags)
+
+    # The LLM stage: untagged stories in, tagged ones out.  It waits for the whole page (reading it
+    # takes a moment; tagging it takes minutes) so the most interesting headlines go first, as the
+    # first page is what the reader is waiting for.  Whatever it can't tag (after a second try), or
+    # is still holding when the LLM gives up altogether, goes out untagged, so the writer still saves
+    # it for a later refresh.
+    def llm_tagging(self, stories, chat_engine, tag_scores):
+        pending = list(stories)
+        batch = []
         count = 0
-
-        while len(new_articles) > 0:
-            self.llama_news(count)
-            print(f"There are {len(new_articles)} articles left to tag", flush=True)
-
-            batch = new_articles[:self.batch_size]
-            del new_articles[:self.batch_size]
-
-            # We only want to send in the id and headline to the LLM
-            if len(batch) > 0:
-                headlines = []
-                for story in batch:
-                    headlines.append({"headline": story['headline']})
-                tags = chat_engine.chat(None, json.dumps(headlines), [])
-
-                # If there's just one article, it's likely to not be in an array
-                if type(tags) is dict:
-                    tags = [tags]
-
-                # Sometimes, an LLM will stick a "headline" in the mix
-                # or add extra keys.  This filters them out
-                new_tags = []
-                for tag in tags:
-                    if "tags" in tag:
-                        # Some LLMs will generate way too many tags.  This is a fail-safe to limit the # of tags
-                        new_tags.append({"tags": tag["tags"][:self.max_tags]})
-
-                tags = new_tags
-
-                for i in range(len(tags)):
-                    batch[i]['tags'] = tags[i]['tags']
-                    batch[i]['read'] = 0
-                    with open('temp/articles.csv', 'a', newline='') as f:
-                        cw = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                        cw.writerow([batch[i]['headline'], batch[i]['url'], ' '.join(batch[i]['tags'])])
-
-                    database.upsert_story(batch[i])
-
-            count += self.batch_size
-
-            # Save us the time in tagging all the articles
-            if self.debugging:
-                break
+        second_tries = set()
+        try:
+            pending.sort(key=lambda story: self.tagging_priority(story, tag_scores))
+            while pending:
+                if self.debugging and count > 0:
+                    # Save us the time in tagging all the articles
+                    yield from pending
+                    break
+
+                self.progress['remaining'] = len(pending)
+                tagging_backlog.set(len(pending))
+                self.llama_news(count, self.progress['state'])
+                log.info(f"There are {len(pending)} articles left to tag")
+
+                # As many as fit in the model's token budgets
+                size = chat_engine.pack_batch(pending)
+                batch, pending = pending[:size], pending[size:]
+                count += len(batch)
+
+                # We only want to send in the id and headline to the LLM.  New stories have no id
+                # yet, so each one goes by its place in the batch.
+                numbered = [story.replace(id=position) for position, story in enumerate(batch)]
+                headlines = [{"id": story['id'], "headline": story['headline']} for story in numbered]
+                results = chat_engine.chat(None, json.dumps(headlines), [], schema=llm.tagging_schema)
+
+                done = llm.match_results(numbered, results, self.max_tags)
+                done_positions = set()
+                for story in done:
+                    done_positions.add(story['id'])
+                    logs.audit('tagged', headline=story['headline'], url=story['url'], tags=story['tags'],
+                               source='llm')
+                    yield batch[story['id']].replace(tags=story['tags'], read=0)
+
+                # Anything the LLM skipped gets one more go, on its own terms, rather than redoing the batch
+                for position, story in enumerate(batch):
+                    if position in done_positions:
+                        continue
+                    key = (story['headline'], story['url'])
+                    if key in second_tries:
+                        yield story
+                    else:
+                        second_tries.add(key)
+                        pending.append(story)
+                self.progress['remaining'] = len(pending)
+                batch = []
+        except Exception:
+            # Whatever we were still holding is saved untagged, so the next refresh has another go at it
+            yield from batch + pending
+            raise
+
+    # The writer stage: saves each batch in one transaction and tells the UI
+    def store_stories(self, batches):
+        database = DataModel()
+        tag_hist = Tags()
+        for batch in batches:
+            tagged = [story for story in database.write_stories(batch) if story['tags']]
+            if not tagged:
+                continue
+            tag_hist.touch_tags([tag for story in tagged for tag in story['tags']])
+            self.progress['tagged'] += len(tagged)
+            u.publish("tagged", {"ids": sorted(story['id'] for story in tagged),
+                                 "remaining": self.progress['remaining']})
+            self.progress['state'] = self.first_page_state(self.progress['state'], self.progress['tagged'],
+                                                           self.progress['remaining'])
+        return ()
+
+    # Once enough is tagged to make a decent first page, let the reader in while we finish up
+    def first_page_state(self, state, tagged, remaining):
+        if state == "working" and tagged >= self.first_page_count and remaining > 0:
+            state = "ready"
+            u.update_status(state, f"The first {tagged} headlines are ready, the rest are on their way")
+        return state
 
     @staticmethod
     def get_article_url(article_id):
@@ -248,27 +433,219 @@ class CNNLite:
 
         database.mark_story_as_read(article_id)
 
+    # Every tagged story with its tag ids, which is all any reader's ranking needs
     @staticmethod
-    def get_scored_articles():
-
+    @traced
+    def build_story_matrix():
         database = DataModel()
         tag_hist = Tags()
-        articles = []
+        tag_hist.refresh()
         database.fetch_all_stories()
 
+        rows = []
         for story in database.stories:
-            if story['read'] == 0:
-                score = 0
-                story['score'] = score
-                for t in story['tags']:
-                    score += tag_hist.get_score(t)
-                    story['score'] = score
-                articles.append(story)
+            # Stories still waiting for the llamas show up once they are tagged
+            if len(story['tags']) == 0:
+                continue
+            tag_ids = []
+            for t in story['tags']:
+                tag_id = tag_hist.get_tag_id(t)
+                if tag_id is None:
+                    tag_hist.add_tag(t)
+                    tag_id = tag_hist.get_tag_id(t)
+                tag_ids.append(tag_id)
+            rows.append((story, tuple(tag_ids)))
+        return rows
+
+    @staticmethod
+    @traced
+    def get_scored_articles(user_id=None, rows=None):
+        if rows is None:
+            rows = CNNLite.build_story_matrix()
+
+        weights, read = CNNLite.reader_weights(user_id)
+        articles = []
+        for story, tag_ids in rows:
+            if story.read if read is None else story.id in read:
+                continue
+            # A view of the shared story, which every reader's ranking uses
+            articles.append(RankedStory(story, sum(weights.get(tag_id, 0) for tag_id in tag_ids)))
 
         articles.sort(key=lambda x: x['score'], reverse=True)
         return articles
 
-    def get_top_stories(self, count=25):
-        self.refresh_list()
-        top_stories = self.get_scored_articles()[:count]
+    # A reader's tag id -> score, and the ids of the stories they've read (None for the default
+    # reader, whose reads are marked on the stories themselves)
+    @staticmethod
+    def reader_weights(user_id=None):
+        # Scores fade slowly; working them out as of the hour keeps them from wobbling between
+        # rebuilds, which would make every story look changed to syncing clients
+        now = time.time() // 3600 * 3600
+        if user_id is None:
+            tag_hist = Tags()
+            tag_hist.refresh()
+            return tag_hist.weights(now), None
+        profile = Profiles().get(user_id)
+        return profile.weights(now), profile.read
+
+    # The ranking can only change if the stories, the tag scores or the reader's own profile have
+    @staticmethod
+    def get_versions(user_id=None):
+        database = DataModel()
+        database.delete_old_stories()
+        profile_version = 0 if user_id is None else database.get_version(f'profile_{user_id}')
+        return database.get_version('stories'), database.get_version('tags'), profile_version
+
+    @traced
+    def get_top_stories(self, count=25, refresh=True, user_id=None):
+        if refresh:
+            self.refresh_list()
+        top_stories = self.get_ranking_snapshot(user_id)['stories'][:count]
         return top_stories
+
+    #    ┌──────────────────────────────────────────────────────────┐
+    #    │                   The Ranking Snapshot                   │
+    #    │                                                          │
+    #    │    Ranking is redone only when the story, tag or         │
+    #    │    profile versions move.  Its version number is the     │
+    #    │    sum of them, so it only ever goes up, even across     │
+    #    │    worker processes.  Each story remembers the           │
+    #    │    version at which it last appeared or changed          │
+    #    │    score, which is what lets clients ask for "just       │
+    #    │    what's new since version n".                          │
+    #    └──────────────────────────────────────────────────────────┘
+    def get_ranking_snapshot(self, user_id=None):
+        versions = self.get_versions(user_id)
+        with self.snapshot_lock:
+            previous = self.snapshots.get(user_id)
+            if previous is None or previous['versions'] != versions:
+                snapshot_requests.inc(cache='ranking', result='miss')
+                self.snapshots[user_id] = self.build_snapshot(versions, previous, user_id)
+                while len(self.snapshots) > self.max_snapshots:
+                    self.snapshots.popitem(last=False)
+            else:
+                snapshot_requests.inc(cache='ranking', result='hit')
+            self.snapshots.move_to_end(user_id)
+            return self.snapshots[user_id]
+
+    # Called with the snapshot lock held.  The matrix only changes when the stories do.
+    def get_story_matrix(self, stories_version):
+        if self.matrix is None or self.matrix[0] != stories_version:
+            rows = self.build_story_matrix()
+            # ... and by story id, for search results
+            self.matrix = (stories_version, rows, {story.id: (story, tag_ids) for story, tag_ids in rows})
+        return self.matrix[1]
+
+    @traced
+    def build_snapshot(self, versions, previous, user_id=None):
+        version = sum(versions)
+        old_stories = {} if previous is None else {story['id']: story for story in previous['stories']}
+        removed = {} if previous is None else dict(previous['removed'])
+        # The oldest version we can list the removals since
+        removed_since = version if previous is None else previous['removed_since']
+
+        stories = []
+        for story in self.get_scored_articles(user_id, self.get_story_matrix(versions[0])):
+            old = old_stories.pop(story.id, None)
+            if old is not None and old.score == story.score and old.tags == story.tags:
+                story = story.replace(changed=old.changed)
+            else:
+                story = story.replace(changed=version)
+            removed.pop(story.id, None)
+            stories.append(story)
+
+        # Anything that dropped out (read or too old) needs to be reported to syncing clients
+        for story_id in old_stories:
+            removed[story_id] = version
+        while len(removed) > self.max_removed:
+            removed_since = max(removed_since, removed.pop(next(iter(removed))))
+
+        stories.sort(key=lambda x: (-x['score'], x['id']))
+        return {'version': version, 'versions': versions, 'stories': stories, 'removed': removed,
+                'removed_since': removed_since, 'keys': [(-story['score'], story['id']) for story in stories]}
+
+    def save_snapshot(self):
+        try:
+            snapshot.save(self.get_ranking_snapshot()['stories'])
+        except OSError as e:
+            log.warning(f'Could not save the snapshot: {e}')
+
+    @staticmethod
+    def encode_cursor(story):
+        raw = json.dumps([story['score'], story['id']]).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            score, story_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+            return -float(score), int(story_id)
+        except (ValueError, TypeError):
+            raise ValueError(f'Bad cursor: {cursor}')
+
+    #    ┌──────────────────────────────────────────────────────────┐
+    #    │    Search: the stories whose headlines have some words,  │
+    #    │    or that carry some tags, or both, found through the   │
+    #    │    database's indexes and ranked for the reader like     │
+    #    │    the home page (ties go to the better match).  Read    │
+    #    │    stories are included; you may be looking for one.     │
+    #    └──────────────────────────────────────────────────────────┘
+    @traced
+    def search(self, query='', tags=(), user_id=None, limit=50):
+        database = DataModel()
+        ids = database.search_stories(query) if query else None
+        if tags:
+            tagged = database.stories_with_tags(canonical.canonicalize_all(tags))
+            ids = sorted(tagged, reverse=True) if ids is None else [story_id for story_id in ids if story_id in tagged]
+        if not ids:
+            return []
+
+        versions = self.get_versions(user_id)
+        with self.snapshot_lock:
+            self.get_story_matrix(versions[0])
+            by_id = self.matrix[2]
+        weights, _ = self.reader_weights(user_id)
+
+        results = []
+        for story_id in ids:
+            if story_id in by_id:
+                story, tag_ids = by_id[story_id]
+                results.append(RankedStory(story, sum(weights.get(tag_id, 0) for tag_id in tag_ids)))
+        results.sort(key=lambda x: x.score, reverse=True)
+        return results[:limit]
+
+    # One page of the ranked feed.  The cursor is the (score, id) of the last story
+    # the client saw, so pages stay consistent even if the ranking shifts in between.
+    def get_stories_page(self, limit=25, cursor=None, tags=None, since=None, user_id=None):
+        snapshot = self.get_ranking_snapshot(user_id)
+        wanted = set(canonical.canonicalize_all(tags or []))
+
+        # Removals are only known from when this process started keeping track (they aren't shared
+        # between workers), so a client that's further behind than that gets everything again
+        resync = since is not None and since < snapshot['removed_since']
+        if resync:
+            since = None
+
+        start = 0
+        if cursor:
+            start = bisect.bisect_right(snapshot['keys'], self.decode_cursor(cursor))
+
+        page = []
+        next_cursor = None
+        for story in snapshot['stories'][start:]:
+            if since is not None and story['changed'] <= since:
+                continue
+            if wanted and not wanted.issubset(story['tags']):
+                continue
+            if len(page) == limit:
+                next_cursor = self.encode_cursor(page[-1])
+                break
+            page.append(story)
+
+        result = {'version': snapshot['version'], 'stories': [story.as_dict() for story in page],
+                  'next_cursor': next_cursor}
+        if since is not None and not resync:
+            result['removed'] = [story_id for story_id, version in snapshot['removed'].items() if version > since]
+        if resync:
+            result['resync'] = True
+        return result
@@ -0,0 +1,15 @@
+#   Shared fixtures for the tests: python -m pytest
+import pytest
+
+import datamodel
+from tags import Tags
+
+
+#   A fresh, empty database in a scratch directory, with no singletons left over from other tests
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(datamodel, 'database_file', str(tmp_path / 'tags-stories.db'))
+    monkeypatch.setattr(datamodel.DataModel, '_instance', {})
+    monkeypatch.setattr(Tags, '_instance', None)
+    return datamodel.DataModel()
@@ -0,0 +1,132 @@
+#    ┌────────────────────────────────────────────────────────────────────┐
+#    │                                                                    │
+#    │                            Coordinator                             │
+#    │                                                                    │
+#    │    When the app runs under a production server with several       │
+#    │    worker processes, we don't want every one of them pestering    │
+#    │    CNN and the LLM.  The workers hold an election through a       │
+#    │    lease row in the database: whoever holds the lease does the     │
+#    │    refreshing and tagging in the background, and everyone else     │
+#    │    just reads what it writes.                                      │
+#    │                                                                    │
+#    │    Leases expire, so if the leader dies another worker takes       │
+#    │    over within a minute or so.                                     │
+#    │                                                                    │
+#    └────────────────────────────────────────────────────────────────────┘
+import atexit
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import datamodel
+import logs
+
+log = logs.get_logger('coordinator')
+
+
+class Coordinator:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if "worker_id" not in self.__dict__:
+            self.worker_id = f'{socket.gethostname()}:{os.getpid()}'
+            self.lease_name = 'refresh'
+            self.lease_time = 60        # seconds before an unrenewed lease is up for grabs
+            self.refresh_check = 30     # seconds between the leader's looks at CNN
+
+            # Until start() is called, we're the only process and refresh on demand like always
+            self.managed = False
+            self.leader = False
+            self.threads = []
+
+    def start(self):
+        if self.managed:
+            return
+        self.managed = True
+
+        for target, name in ((self.heartbeat, 'lease-heartbeat'), (self.refresher, 'refresher')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+        atexit.register(self.release)
+
+    #    ┌──────────────────────────────────────────────────────────┐
+    #    │                        The Lease                         │
+    #    └──────────────────────────────────────────────────────────┘
+
+    @staticmethod
+    def connect():
+        conn = sqlite3.connect(datamodel.database_file, timeout=30, isolation_level=None)
+        conn.execute('CREATE TABLE IF NOT EXISTS "leases" (\n'
+                     '  "name"	TEXT NOT NULL UNIQUE,\n'
+                     '  "owner"	TEXT NOT NULL,\n'
+                     '  "expires"	REAL NOT NULL,\n'
+                     '   PRIMARY KEY("name"))')
+        return conn
+
+    def acquire(self, conn):
+        now = time.time()
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can't both win
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT owner, expires FROM leases WHERE name = ?", (self.lease_name,)).fetchone()
+            if row is None or row[0] == self.worker_id or row[1] < now:
+                conn.execute("INSERT OR REPLACE INTO leases (name, owner, expires) VALUES (?, ?, ?)",
+                             (self.lease_name, self.worker_id, now + self.lease_time))
+                won = True
+            else:
+                won = False
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        return won
+
+    def release(self):
+        if not self.leader:
+            return
+        self.leader = False
+        conn = self.connect()
+        conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (self.lease_name, self.worker_id))
+        conn.close()
+
+    def heartbeat(self):
+        conn = self.connect()
+        while True:
+            try:
+                was_leader = self.leader
+                self.leader = self.acquire(conn)
+                if self.leader and not was_leader:
+                    log.info(f'Worker {self.worker_id} is now in charge of refreshing')
+            except sqlite3.Error as e:
+                log.warning(f'Lease check failed: {e}')
+                self.leader = False
+            time.sleep(self.lease_time / 3)
+
+    #    ┌──────────────────────────────────────────────────────────┐
+    #    │    The leader refreshes in the background; CNNLite       │
+    #    │    itself decides whether enough time has passed to      │
+    #    │    go back to CNN.                                       │
+    #    └──────────────────────────────────────────────────────────┘
+    def refresher(self):
+        import cnnlite      # cnnlite imports us, so wait until we actually need it
+
+        while True:
+            if self.leader:
+                try:
+                    cnnlite.CNNLite().refresh_list(owner=True)
+                except Exception as e:
+                    log.exception(f'Background refresh failed: {e}')
+            time.sleep(self.refresh_check)
+
+    # Is this thread allowed to go fetch and tag?
+    def may_refresh(self, owner=False):
+        return not self.managed or (owner and self.leader)
@@ -1,6 +1,57 @@
 import datetime
+import hashlib
+import json
+import os
+import re
+import secrets
 import sqlite3
+import sys
 import threading
+import time
+
+import archive
+import canonical
+import logs
+import metrics
+from records import Record, Story, Tag
+from tracing import traced
+
+log = logs.get_logger('datamodel')
+
+
+# Every process and thread shares the one database file
+database_file = os.getenv('NEWSREADER_DB', 'tags-stories.db')
+
+retention = datetime.timedelta(days=2)     # how long stories stay in the database before being archived
+retention_check = 600                       # seconds between looks for stories to archive
+feedback_retention = 7 * 86400              # how long event ids are remembered, to spot a batch sent twice
+
+search_words = re.compile(r'\w+')
+
+statement_seconds = metrics.histogram('sqlite_statement_seconds', 'Time to run one SQL statement, by verb')
+
+
+#   A cursor that times every statement it runs, and otherwise acts like the real thing
+class TimedCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return self.cursor.execute(sql, parameters)
+        finally:
+            statement_seconds.observe(time.perf_counter() - start, statement=sql.split(None, 1)[0].upper())
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return self.cursor.executemany(sql, seq_of_parameters)
+        finally:
+            statement_seconds.observe(time.perf_counter() - start, statement=sql.split(None, 1)[0].upper())
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
 
 
 # For PyCharm:
@@ -19,9 +70,13 @@ class DataModel:
 
     def __init__(self):
         if "db" not in self.__dict__:
-            self.db = "tags-stories.db"
-            self.conn = sqlite3.connect(self.db)
-            self.cur = self.conn.cursor()
+            self.db = database_file
+            # Other workers may be writing, so wait for them rather than failing straight away
+            self.conn = sqlite3.connect(self.db, timeout=30)
+            self.cur = TimedCursor(self.conn.cursor())
+
+            # Write-ahead logging lets readers in other processes carry on while one process writes
+            self.cur.execute("PRAGMA journal_mode=WAL")
 
             # Check if the "stories" table exists
             self.cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='stories'")
@@ -43,23 +98,190 @@ class DataModel:
                                  '  "text"	TEXT NOT NULL UNIQUE,\n'
                                  '  "score"	REAL NOT NULL,\n'
                                  '  "count"	INTEGER NOT NULL,\n'
+                                 '  "id"	INTEGER,\n'
+                                 '  "updated"	REAL,\n'
+                                 '  "seen"	REAL,\n'
                                  '   PRIMARY KEY("text"))')
+                self.cur.execute('CREATE UNIQUE INDEX "tags_id" ON "tags" ("id")')
+
+            # Older databases don't have tag ids yet
+            self.cur.execute("SELECT COUNT(*) FROM pragma_table_info('tags') WHERE name = 'id'")
+            if self.cur.fetchone()[0] == 0:
+                self.cur.execute('ALTER TABLE "tags" ADD COLUMN "id" INTEGER')
+                self.cur.execute('UPDATE "tags" SET "id" = rowid')
+                self.cur.execute('CREATE UNIQUE INDEX "tags_id" ON "tags" ("id")')
+
+            # ... nor do they know when a tag was last scored (updated) or last seen on a story
+            for column in ('updated', 'seen'):
+                self.cur.execute("SELECT COUNT(*) FROM pragma_table_info('tags') WHERE name = ?", (column,))
+                if self.cur.fetchone()[0] == 0:
+                    self.cur.execute(f'ALTER TABLE "tags" ADD COLUMN "{column}" REAL')
+                    self.cur.execute(f'UPDATE "tags" SET "{column}" = ?', (time.time(),))
+
+            # Extra "this tag is really that tag" rules, on top of the ones in canonical.py
+            self.cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='tag_aliases'")
+            if self.cur.fetchone() is None:
+                self.cur.execute('CREATE TABLE "tag_aliases" (\n'
+                                 '  "alias"	TEXT NOT NULL UNIQUE,\n'
+                                 '  "canonical"	TEXT NOT NULL,\n'
+                                 '   PRIMARY KEY("alias"))')
+
+            # Per-reader tag scores: a sparse vector of (tag id -> score) for each user id.  The tags
+            # table itself is the profile of the default reader, who hasn't picked a name.
+            self.cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='profiles'")
+            if self.cur.fetchone() is None:
+                self.cur.execute('CREATE TABLE "profiles" (\n'
+                                 '  "user_id"	TEXT NOT NULL,\n'
+                                 '  "tag_id"	INTEGER NOT NULL,\n'
+                                 '  "score"	REAL NOT NULL,\n'
+                                 '  "count"	REAL NOT NULL,\n'
+                                 '  "updated"	REAL,\n'
+                                 '   PRIMARY KEY("user_id", "tag_id")) WITHOUT ROWID')
+
+            # ... and the stories each of them has read
+            self.cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='profile_reads'")
+            if self.cur.fetchone() is None:
+                self.cur.execute('CREATE TABLE "profile_reads" (\n'
+                                 '  "user_id"	TEXT NOT NULL,\n'
+                                 '  "story_id"	INTEGER NOT NULL,\n'
+                                 '   PRIMARY KEY("user_id", "story_id")) WITHOUT ROWID')
+
+            # The refresh looks each headline up as it reads the page
+            self.cur.execute('CREATE INDEX IF NOT EXISTS "stories_headline" ON "stories" ("headline", "url")')
+            # ... and picks up whatever the last one couldn't tag
+            self.cur.execute('CREATE INDEX IF NOT EXISTS "stories_untagged" ON "stories" ("id") '
+                             "WHERE tags IS NULL OR tags = ''")
+
+            # Which stories carry which tag, so "everything tagged ukraine" doesn't mean reading every story
+            self.cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='story_tags'")
+            rebuild = self.cur.fetchone() is None
+            if rebuild:
+                self.cur.execute('CREATE TABLE "story_tags" (\n'
+                                 '  "tag"	TEXT NOT NULL,\n'
+                                 '  "story_id"	INTEGER NOT NULL,\n'
+                                 '   PRIMARY KEY("tag", "story_id")) WITHOUT ROWID')
+                self.cur.execute('CREATE INDEX "story_tags_story" ON "story_tags" ("story_id")')
+                self.cur.execute('CREATE TRIGGER "story_tags_delete" AFTER DELETE ON "stories" BEGIN\n'
+                                 '  DELETE FROM "story_tags" WHERE "story_id" = old."id";\n'
+                                 'END')
+
+            # A full-text index of the headlines, if this SQLite has FTS5.  It reads the headlines from
+            # the stories table itself, and triggers keep it up to date however the stories change.
+            self.cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='stories_fts'")
+            self.fts = self.cur.fetchone() is not None
+            if not self.fts:
+                try:
+                    self.cur.execute("CREATE VIRTUAL TABLE stories_fts USING fts5(headline, content='stories', "
+                                     "content_rowid='id', tokenize='porter unicode61')")
+                    self.cur.execute('CREATE TRIGGER "stories_fts_insert" AFTER INSERT ON "stories" BEGIN\n'
+                                     '  INSERT INTO stories_fts (rowid, headline) VALUES (new.id, new.headline);\n'
+                                     'END')
+                    self.cur.execute('CREATE TRIGGER "stories_fts_delete" AFTER DELETE ON "stories" BEGIN\n'
+                                     '  INSERT INTO stories_fts (stories_fts, rowid, headline) '
+                                     "VALUES ('delete', old.id, old.headline);\n"
+                                     'END')
+                    self.cur.execute('CREATE TRIGGER "stories_fts_update" AFTER UPDATE OF "headline" ON "stories" '
+                                     'BEGIN\n'
+                                     '  INSERT INTO stories_fts (stories_fts, rowid, headline) '
+                                     "VALUES ('delete', old.id, old.headline);\n"
+                                     '  INSERT INTO stories_fts (rowid, headline) VALUES (new.id, new.headline);\n'
+                                     'END')
+                    self.fts = True
+                    rebuild = True
+                except sqlite3.OperationalError as e:
+                    log.warning(f'No full-text search, so searching will be slow: {e}')
+
+            # Likes, dislikes and reads sent in batches by the browser, by the id it gave each one, so a
+            # batch sent twice (say, a retry after a dropped connection) only counts once
+            self.cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='feedback_events'")
+            if self.cur.fetchone() is None:
+                self.cur.execute('CREATE TABLE "feedback_events" (\n'
+                                 '  "user_id"	TEXT NOT NULL,\n'
+                                 '  "event_id"	TEXT NOT NULL,\n'
+                                 '  "kind"	TEXT NOT NULL,\n'
+                                 '  "story_id"	INTEGER NOT NULL,\n'
+                                 '  "at"	REAL,\n'
+                                 '  "received"	REAL NOT NULL,\n'
+                                 '   PRIMARY KEY("user_id", "event_id")) WITHOUT ROWID')
+
+            # Version counters, bumped on every write, let other processes notice changes cheaply
+            self.cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='meta'")
+            if self.cur.fetchone() is None:
+                self.cur.execute('CREATE TABLE "meta" (\n'
+                                 '  "key"	TEXT NOT NULL UNIQUE,\n'
+                                 '  "value"	NUMERIC,\n'
+                                 '   PRIMARY KEY("key"))')
 
             self.conn.commit()
 
+            if rebuild:
+                self.rebuild_search_indexes()
+
+            self.load_aliases()
+            self.migrate_canonical_tags()
+
             self.tags = []
             self.stories = []
+            self.stories_version = None
+            self.last_retention = 0
             self.fetch_all_tags()
             self.fetch_all_stories()
 
+    #    ┌──────────────────────────────────────────────────────────┐
+    #    │                     Change Tracking                      │
+    #    └──────────────────────────────────────────────────────────┘
+
+    def get_version(self, name):
+        self.cur.execute("SELECT value FROM meta WHERE key = ?", (name + '_version',))
+        row = self.cur.fetchone()
+        return 0 if row is None else row[0]
+
+    # Callers are expected to commit along with the change being versioned
+    def bump_version(self, name):
+        self.cur.execute("INSERT INTO meta (key, value) VALUES (?, 1) "
+                         "ON CONFLICT(key) DO UPDATE SET value = value + 1", (name + '_version',))
+
+    # True (once) if it has been at least `interval` seconds since the job called `name` last ran in any process
+    def claim_job(self, name, interval):
+        now = time.time()
+        self.cur.execute("BEGIN IMMEDIATE")
+        self.cur.execute("SELECT value FROM meta WHERE key = ?", (name + '_ran',))
+        row = self.cur.fetchone()
+        if row is not None and now - float(row[0]) < interval:
+            self.conn.commit()
+            return False
+        self.cur.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (name + '_ran', now))
+        self.conn.commit()
+        return True
+
+    # A little JSON that has to survive restarts and be shared between workers, or None
+    def get_state(self, name):
+        self.cur.execute("SELECT value FROM meta WHERE key = ?", (name + '_state',))
+        row = self.cur.fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put_state(self, name, value):
+        self.cur.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (name + '_state', json.dumps(value)))
+        self.conn.commit()
+
+    # A random secret every worker shares: whichever asks first makes it, and everyone after reads that one.
+    # JSON, like the states, so the NUMERIC column leaves it alone.
+    def shared_secret(self, name):
+        self.cur.execute("INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)",
+                         (name + '_secret', json.dumps(secrets.token_hex(32))))
+        self.conn.commit()
+        self.cur.execute("SELECT value FROM meta WHERE key = ?", (name + '_secret',))
+        return json.loads(self.cur.fetchone()[0])
+
     #    ┌──────────────────────────────────────────────────────────┐
     #    │                      Tag Management                      │
     #    └──────────────────────────────────────────────────────────┘
 
+    @traced
     def fetch_all_tags(self):
-        self.cur.execute("SELECT * FROM tags")
+        self.cur.execute("SELECT text, score, count, id, updated, seen FROM tags")
         rows = self.cur.fetchall()
-        self.tags = [{'text': row[0], 'score': row[1], 'count': row[2]} for row in rows]
+        self.tags = [Tag(sys.intern(row[0]), row[1], row[2], row[3], row[4], row[5]) for row in rows]
 
     def get_tags(self):
         return self.tags
@@ -68,17 +290,23 @@ class DataModel:
         for tag in self.tags:
             if tag['text'] == tag_name:
                 return tag
-        return {'text': tag_name, 'score': 0, 'count': 0}
+        return Tag(tag_name, 0, 0)
 
+    @traced
     def upsert_tag(self, tag_dict):
+        now = time.time()
         self.cur.execute("SELECT * FROM tags WHERE text = ?", (tag_dict['text'],))
         row = self.cur.fetchone()
         if row is None:
-            self.cur.execute("INSERT INTO tags (text, score, count) VALUES (?, ?, ?)",
-                             (tag_dict['text'], tag_dict['score'], tag_dict['count']))
+            # New tags get the next integer id
+            self.cur.execute("INSERT INTO tags (text, score, count, id, updated, seen) "
+                             "VALUES (?, ?, ?, (SELECT COALESCE(MAX(id), 0) + 1 FROM tags), ?, ?)",
+                             (tag_dict['text'], tag_dict['score'], tag_dict['count'],
+                              tag_dict.get('updated', now), tag_dict.get('seen', now)))
         else:
-            self.cur.execute("UPDATE tags SET score = ?, count = ? WHERE text = ?",
-                             (tag_dict['score'], tag_dict['count'], tag_dict['text']))
+            self.cur.execute("UPDATE tags SET score = ?, count = ?, updated = ? WHERE text = ?",
+                             (tag_dict['score'], tag_dict['count'], tag_dict.get('updated', now), tag_dict['text']))
+        self.bump_version('tags')
         self.conn.commit()
         self.fetch_all_tags()  # Update the in-memory list of tags
 
@@ -88,6 +316,173 @@ class DataModel:
 
         self.fetch_all_tags()
 
+    # Note that these tags were just put on a story, adding any we haven't met before, all in one go
+    def touch_tags(self, tag_names):
+        now = time.time()
+        self.cur.executemany("INSERT INTO tags (text, score, count, id, updated, seen) "
+                             "VALUES (?, 0, 0, (SELECT COALESCE(MAX(id), 0) + 1 FROM tags), ?, ?) "
+                             "ON CONFLICT(text) DO UPDATE SET seen = excluded.seen",
+                             [(name, now, now) for name in set(tag_names)])
+        self.bump_version('tags')
+        self.conn.commit()
+
+    # Forget tags nobody has shown an opinion about lately and that aren't on any story we have
+    @traced
+    def delete_stale_tags(self, stale_names):
+        self.cur.execute("SELECT tags FROM stories")
+        in_use = set()
+        for (topics,) in self.cur.fetchall():
+            in_use.update(self.split_topics(topics))
+        # Nor are the ones some reader has an opinion about
+        self.cur.execute("SELECT DISTINCT text FROM tags JOIN profiles ON profiles.tag_id = tags.id")
+        in_use.update(row[0] for row in self.cur.fetchall())
+
+        doomed = [(name,) for name in stale_names if name not in in_use]
+        self.cur.executemany("DELETE FROM tags WHERE text = ?", doomed)
+        if doomed:
+            self.bump_version('tags')
+        self.conn.commit()
+        return len(doomed)
+
+    def load_aliases(self):
+        self.cur.execute("SELECT alias, canonical FROM tag_aliases")
+        canonical.custom_aliases = {canonical.normalize(alias): canonical.normalize(target)
+                                    for alias, target in self.cur.fetchall()}
+
+    def add_alias(self, alias, target):
+        self.cur.execute("INSERT OR REPLACE INTO tag_aliases (alias, canonical) VALUES (?, ?)",
+                         (canonical.normalize(alias), canonical.normalize(target)))
+        self.conn.commit()
+        self.load_aliases()
+        self.migrate_canonical_tags()
+
+    #    ┌──────────────────────────────────────────────────────────┐
+    #    │    Bring the tags and stories already in the database    │
+    #    │    in line with the current canonicalization rules:      │
+    #    │    tags that turn out to be the same are merged (their   │
+    #    │    scores averaged by count), and each story's tag       │
+    #    │    list is rewritten.  This only runs when the rules     │
+    #    │    (or the aliases) have changed.                        │
+    #    └──────────────────────────────────────────────────────────┘
+    def migrate_canonical_tags(self):
+        aliases = hashlib.sha1(repr(sorted(canonical.custom_aliases.items())).encode('utf-8')).hexdigest()[:12]
+        rules = f'{canonical.rules_version}:{aliases}'
+        self.cur.execute("SELECT value FROM meta WHERE key = 'canonical_rules'")
+        row = self.cur.fetchone()
+        if row is not None and str(row[0]) == rules:
+            return
+
+        # Take the write lock, then check again in case another thread or process beat us to it
+        self.cur.execute("BEGIN IMMEDIATE")
+        self.cur.execute("SELECT value FROM meta WHERE key = 'canonical_rules'")
+        row = self.cur.fetchone()
+        if row is not None and str(row[0]) == rules:
+            self.conn.commit()
+            return
+
+        merged = {}
+        merged_ids = {}     # old tag id -> canonical name
+        dropped_ids = []    # tags that canonicalize to nothing
+        self.cur.execute("SELECT text, score, count, id, updated, seen FROM tags")
+        for text, score, count, tag_id, updated, seen in self.cur.fetchall():
+            name = canonical.canonicalize(text)
+            if not name:
+                dropped_ids.append(tag_id)
+                continue
+            merged_ids[tag_id] = name
+            tag = merged.setdefault(name, {'total': 0.0, 'count': 0, 'id': tag_id, 'updated': updated, 'seen': seen})
+            tag['total'] += score * count
+            tag['count'] += count
+            tag['id'] = min(tag['id'], tag_id)
+            tag['updated'] = max(tag['updated'] or 0, updated or 0)
+            tag['seen'] = max(tag['seen'] or 0, seen or 0)
+
+        self.cur.execute("DELETE FROM tags")
+        self.cur.executemany("INSERT INTO tags (text, score, count, id, updated, seen) VALUES (?, ?, ?, ?, ?, ?)",
+                             [(name, tag['total'] / tag['count'] if tag['count'] else 0, tag['count'], tag['id'],
+                               tag['updated'], tag['seen'])
+                              for name, tag in merged.items()])
+        self.migrate_profile_tags({old: merged[name]['id'] for old, name in merged_ids.items()
+                                   if merged[name]['id'] != old})
+        self.drop_profile_tags(dropped_ids)
+
+        self.cur.execute("SELECT id, tags FROM stories")
+        updates = []
+        for story_id, topics in self.cur.fetchall():
+            tags = ','.join(canonical.canonicalize_all(self.split_topics(topics)))
+            if tags != (topics or ''):
+                updates.append((tags, story_id))
+        self.cur.executemany("UPDATE stories SET tags = ? WHERE id = ?", updates)
+        self.index_story_tags({story_id: self.split_topics(tags) for tags, story_id in updates})
+
+        self.cur.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('canonical_rules', ?)", (rules,))
+        self.bump_version('tags')
+        self.bump_version('stories')
+        self.conn.commit()
+
+    # A dropped tag's id may be handed out again (new tags get MAX(id)+1), so nobody's score for it
+    # can be left behind for the new tag to inherit (called mid-transaction)
+    def drop_profile_tags(self, tag_ids):
+        if not tag_ids:
+            return
+        marks = ','.join('?' * len(tag_ids))
+        self.cur.execute(f"SELECT DISTINCT user_id FROM profiles WHERE tag_id IN ({marks})", tag_ids)
+        users = [row[0] for row in self.cur.fetchall()]
+        self.cur.execute(f"DELETE FROM profiles WHERE tag_id IN ({marks})", tag_ids)
+        for user_id in users:
+            self.bump_version(f'profile_{user_id}')
+
+    # When tags are merged, each reader's scores for them are merged the same way (called mid-transaction)
+    def migrate_profile_tags(self, id_map):
+        if not id_map:
+            return
+        marks = ','.join('?' * len(id_map))
+        self.cur.execute(f"SELECT user_id, tag_id, score, count, updated FROM profiles WHERE tag_id IN ({marks})",
+                         list(id_map))
+        rows = self.cur.fetchall()
+        self.cur.execute(f"DELETE FROM profiles WHERE tag_id IN ({marks})", list(id_map))
+        for user_id, tag_id, score, count, updated in rows:
+            new_id = id_map[tag_id]
+            self.cur.execute("SELECT score, count, updated FROM profiles WHERE user_id = ? AND tag_id = ?",
+                             (user_id, new_id))
+            existing = self.cur.fetchone()
+            if existing is not None:
+                total = existing[1] + count
+                score = (existing[0] * existing[1] + score * count) / total if total else 0
+                count = total
+                updated = max(existing[2] or 0, updated or 0)
+            self.cur.execute("INSERT OR REPLACE INTO profiles (user_id, tag_id, score, count, updated) "
+                             "VALUES (?, ?, ?, ?, ?)", (user_id, new_id, score, count, updated))
+            self.bump_version(f'profile_{user_id}')
+
+    #    ┌──────────────────────────────────────────────────────────┐
+    #    │                     Reader Profiles                      │
+    #    └──────────────────────────────────────────────────────────┘
+
+    # tag id -> {'score', 'count', 'updated'} for one reader
+    @traced
+    def fetch_profile(self, user_id):
+        self.cur.execute("SELECT tag_id, score, count, updated FROM profiles WHERE user_id = ?", (user_id,))
+        return {row[0]: {'score': row[1], 'count': row[2], 'updated': row[3]} for row in self.cur.fetchall()}
+
+    def upsert_profile_tags(self, user_id, scores):
+        self.cur.executemany("INSERT OR REPLACE INTO profiles (user_id, tag_id, score, count, updated) "
+                             "VALUES (?, ?, ?, ?, ?)",
+                             [(user_id, tag_id, entry['score'], entry['count'], entry['updated'])
+                              for tag_id, entry in scores.items()])
+        self.bump_version(f'profile_{user_id}')
+        self.conn.commit()
+
+    def fetch_profile_reads(self, user_id):
+        self.cur.execute("SELECT story_id FROM profile_reads WHERE user_id = ?", (user_id,))
+        return {row[0] for row in self.cur.fetchall()}
+
+    def mark_story_as_read_by(self, user_id, story_id):
+        self.cur.execute("INSERT OR IGNORE INTO profile_reads (user_id, story_id) VALUES (?, ?)",
+                         (user_id, int(story_id)))
+        self.bump_version(f'profile_{user_id}')
+        self.conn.commit()
+
     #    ┌──────────────────────────────────────────────────────────┐
     #    │                Story (Article) Management                │
     #    └──────────────────────────────────────────────────────────┘
@@ -95,23 +490,68 @@ class DataModel:
     @staticmethod
     def split_topics(topics):
         if topics is None:
-            return []
+            return ()
         if topics == '':
-            return []
-        return topics.split(',')
+            return ()
+        return tuple(sys.intern(topic) for topic in topics.split(','))
 
+    @traced
     def fetch_all_stories(self):
         self.delete_old_stories()
+        self.stories_version = self.get_version('stories')
         self.cur.execute("SELECT * FROM stories")
         rows = self.cur.fetchall()
-        self.stories = [{'id': row[0], 'headline': row[1], 'url': row[2], 'read': row[3],
-                         'date': row[4], 'tags': self.split_topics(row[5])
-                         } for row in rows]
+        self.stories = [Story(row[0], row[1], row[2], row[3], row[4], self.split_topics(row[5])) for row in rows]
 
+    @traced
     def delete_old_stories(self):
-        two_days_ago = datetime.datetime.now() - datetime.timedelta(days=2)
-        self.cur.execute("DELETE FROM stories WHERE date < ?", (two_days_ago,))
-        self.conn.commit()
+        # This is called on every page view, but stories only expire by the hour, so don't look too often
+        now = time.time()
+        if now - self.last_retention < retention_check:
+            return
+        self.last_retention = now
+
+        cutoff = datetime.datetime.now() - retention
+        self.cur.execute("SELECT COUNT(*) FROM stories WHERE date < ?", (cutoff,))
+        if self.cur.fetchone()[0] == 0:
+            return
+
+        # Hold the write lock while the segment is written, so no other process archives the same stories
+        self.cur.execute("BEGIN IMMEDIATE")
+        expired = []
+        try:
+            self.cur.execute("SELECT id, headline, url, read, date, tags FROM stories WHERE date < ?", (cutoff,))
+            expired = [{'id': row[0], 'headline': row[1], 'url': row[2], 'read': row[3], 'date': row[4],
+                        'tags': self.split_topics(row[5])} for row in self.cur.fetchall()]
+            archive.Archive().append(expired)
+
+            self.cur.executemany("DELETE FROM stories WHERE id = ?", [(story['id'],) for story in expired])
+            self.cur.execute("DELETE FROM profile_reads WHERE story_id NOT IN (SELECT id FROM stories)")
+            self.bump_version('stories')
+            self.conn.commit()
+        except OSError as e:
+            # Better to keep them another little while than to lose them
+            log.warning(f'Could not archive {len(expired)} old stories: {e}')
+            self.conn.rollback()
+            return
+        except Exception:
+            # Never leave the write lock held, or every later transaction on this connection fails
+            log.exception(f'Could not archive {len(expired)} old stories')
+            self.conn.rollback()
+            return
+        log.info(f'Archived {len(expired)} old stories')
+
+        # Every run leaves a small segment behind; once a day, one process folds them together
+        if self.claim_job('archive_compaction', 86400):
+            try:
+                log.info(f'Compacting the archive removed {archive.Archive().compact()} segments')
+            except OSError as e:
+                log.warning(f'Could not compact the archive: {e}')
+
+    # Reload our copy of the stories if somebody (maybe another process) has changed them
+    def sync_stories(self):
+        if self.get_version('stories') != self.stories_version:
+            self.fetch_all_stories()
 
     def get_story_by_headline_url(self, headline, url):
         for story in self.stories:
@@ -120,6 +560,7 @@ class DataModel:
         return None
 
     def get_story_by_id(self, story_id):
+        self.sync_stories()
         for story in self.stories:
             if int(story['id']) == int(story_id):
                 return story
@@ -129,8 +570,12 @@ class DataModel:
         self.fetch_all_stories()
         return self.stories
 
+    @traced
     def upsert_story(self, story_dict):
-        if 'id' not in story_dict:
+        # Records can't be changed, so work on a copy
+        if isinstance(story_dict, Record):
+            story_dict = story_dict.as_dict()
+        if story_dict.get('id') is None:
             self.cur.execute("SELECT id FROM stories WHERE headline = ? AND url = ?",
                              (story_dict['headline'], story_dict['url']))
             row = self.cur.fetchone()
@@ -154,6 +599,8 @@ class DataModel:
                 "UPDATE stories SET headline = ?, url = ?, read = ?, date = ?, tags = ? WHERE id = ?",
                 (story_dict['headline'], story_dict['url'], story_dict['read'], datetime.datetime.now(),
                  ','.join(story_dict['tags']), story_dict['id']))
+        self.index_story_tags({story_dict['id']: story_dict['tags']})
+        self.bump_version('stories')
         self.conn.commit()
 
         return story_dict['id']
@@ -164,6 +611,60 @@ class DataModel:
 
         self.fetch_all_stories()  # Update the in-memory list of stories
 
+    # Set the tags on many stories at once, in one transaction (for backfills).  Unlike upsert_story,
+    # this leaves the dates alone, so old stories don't get a new lease on life.
+    @traced
+    def apply_story_tags(self, tags_by_id):
+        self.cur.execute("BEGIN IMMEDIATE")
+        self.cur.executemany("UPDATE stories SET tags = ? WHERE id = ?",
+                             [(','.join(tags), story_id) for story_id, tags in tags_by_id.items()])
+        self.index_story_tags(tags_by_id)
+        self.bump_version('stories')
+        self.conn.commit()
+
+    # Like story_exists, but asks the database (through an index) rather than our copy of the stories,
+    # so it needs no reload to see what was just written.  Returns the id or None.
+    def find_story(self, headline, url):
+        self.cur.execute("SELECT id FROM stories WHERE headline = ? AND url = ?", (headline, url))
+        row = self.cur.fetchone()
+        return None if row is None else row[0]
+
+    # The tags a story with this headline already has, if any (CNN sometimes moves a story to a new URL)
+    def known_tags(self, headline):
+        self.cur.execute("SELECT tags FROM stories WHERE headline = ? AND tags != '' LIMIT 1", (headline,))
+        row = self.cur.fetchone()
+        return None if row is None else self.split_topics(row[0])
+
+    def get_untagged_stories(self):
+        self.cur.execute("SELECT * FROM stories WHERE tags IS NULL OR tags = ''")
+        return [Story(row[0], row[1], row[2], row[3], row[4], ()) for row in self.cur.fetchall()]
+
+    # Write a batch of stories in one transaction, dated now, as upsert_story would.  Stories without an id
+    # are new: SQLite gives them one, unless another refresh has already stored the same headline and URL,
+    # in which case it's left alone.  Stories with an id (from get_untagged_stories) are updated in place.
+    # Returns the stories written, with their ids.
+    @traced
+    def write_stories(self, stories):
+        now = datetime.datetime.now()
+        written = []
+        self.cur.execute("BEGIN IMMEDIATE")
+        for story in stories:
+            tags = ','.join(story['tags'])
+            if story['id'] is None:
+                if self.find_story(story['headline'], story['url']) is not None:
+                    continue
+                self.cur.execute("INSERT INTO stories (headline, url, read, date, tags) VALUES (?, ?, ?, ?, ?)",
+                                 (story['headline'], story['url'], story['read'] or 0, now, tags))
+                story = story.replace(id=self.cur.lastrowid)
+            else:
+                self.cur.execute("UPDATE stories SET read = ?, date = ?, tags = ? WHERE id = ?",
+                                 (story['read'] or 0, now, tags, story['id']))
+            written.append(story)
+        self.index_story_tags({story['id']: story['tags'] for story in written})
+        self.bump_version('stories')
+        self.conn.commit()
+        return written
+
     def story_exists(self, headline, url):
         for story in self.stories:
             if story['headline'] == headline and story['url'] == url:
@@ -171,10 +672,12 @@ class DataModel:
         return -1
 
     def mark_story_as_read(self, story_i9d):
-        for story in self.stories:
+        self.sync_stories()
+        for i, story in enumerate(self.stories):
             if int(story['id']) == int(story_i9d):
-                story['read'] = 1
+                self.stories[i] = story.replace(read=1)
                 self.cur.execute("UPDATE stories SET read = ? WHERE id = ?", (1, story_i9d))
+                self.bump_version('stories')
                 self.conn.commit()
                 break
 
@@ -183,3 +686,146 @@ class DataModel:
         if story is not None:
             return story['tags']
         return []
+
+    #    ┌──────────────────────────────────────────────────────────┐
+    #    │                          Search                          │
+    #    └──────────────────────────────────────────────────────────┘
+
+    # Keep the tag -> story index in step with the stories' tags (called mid-transaction)
+    def index_story_tags(self, tags_by_id):
+        self.cur.executemany("DELETE FROM story_tags WHERE story_id = ?", [(story_id,) for story_id in tags_by_id])
+        self.cur.executemany("INSERT OR IGNORE INTO story_tags (tag, story_id) VALUES (?, ?)",
+                             [(tag, story_id) for story_id, tags in tags_by_id.items() for tag in tags if tag])
+
+    # Build both indexes from scratch, for a database that had stories before it had indexes
+    @traced
+    def rebuild_search_indexes(self):
+        self.cur.execute("BEGIN IMMEDIATE")
+        self.cur.execute("DELETE FROM story_tags")
+        self.cur.execute("SELECT id, tags FROM stories")
+        self.index_story_tags({story_id: self.split_topics(topics) for story_id, topics in self.cur.fetchall()})
+        if self.fts:
+            self.cur.execute("INSERT INTO stories_fts (stories_fts) VALUES ('rebuild')")
+        self.conn.commit()
+
+    # Ids of the stories whose headlines have all the words in `query`, best match first.  The last
+    # word can be the start of a word, so results show up while it's still being typed.
+    @traced
+    def search_stories(self, query, limit=500):
+        words = search_words.findall(query)
+        if not words:
+            return []
+        if self.fts:
+            match = ' '.join(f'"{word}"' for word in words) + '*'
+            self.cur.execute("SELECT rowid FROM stories_fts WHERE stories_fts MATCH ? ORDER BY rank LIMIT ?",
+                             (match, limit))
+        else:
+            self.cur.execute(f"SELECT id FROM stories WHERE {' AND '.join(['headline LIKE ?'] * len(words))} "
+                             f"ORDER BY id DESC LIMIT ?", [f'%{word}%' for word in words] + [limit])
+        return [row[0] for row in self.cur.fetchall()]
+
+    # Ids of the stories carrying every one of these (canonical) tags
+    @traced
+    def stories_with_tags(self, tags):
+        tags = list(set(tags))
+        if not tags:
+            return set()
+        self.cur.execute(f"SELECT story_id FROM story_tags WHERE tag IN ({','.join('?' * len(tags))}) "
+                         f"GROUP BY story_id HAVING COUNT(*) = ?", tags + [len(tags)])
+        return {row[0] for row in self.cur.fetchall()}
+
+    #    ┌──────────────────────────────────────────────────────────┐
+    #    │                         Feedback                         │
+    #    └──────────────────────────────────────────────────────────┘
+
+    # Apply a batch of likes, dislikes and reads from one reader (None for the default profile) in one
+    # transaction.  Each event is {'id', 'kind', 'story', 'at'}; ones already applied are skipped.
+    # rescore(entry, like, now) is Tags.rescore, passed in as tags.py imports us.  Returns how many were new.
+    @traced
+    def apply_feedback(self, user_id, events, rescore):
+        now = time.time()
+        owner = user_id or ''
+        self.cur.execute("BEGIN IMMEDIATE")
+        try:
+            self.cur.execute("DELETE FROM feedback_events WHERE received < ?", (now - feedback_retention,))
+            self.cur.execute(f"SELECT event_id FROM feedback_events WHERE user_id = ? "
+                             f"AND event_id IN ({','.join('?' * len(events))})",
+                             [owner] + [event['id'] for event in events])
+            seen = {row[0] for row in self.cur.fetchall()}
+            # An id repeated within the batch counts once too
+            fresh = []
+            for event in events:
+                if event['id'] not in seen:
+                    seen.add(event['id'])
+                    fresh.append(event)
+
+            # The current scores, read inside the transaction so another worker's changes aren't lost
+            scores = {}
+            reads = set()
+            for event in fresh:
+                if event['kind'] == 'read':
+                    reads.add(int(event['story']))
+                    continue
+                self.cur.execute("SELECT tags FROM stories WHERE id = ?", (int(event['story']),))
+                row = self.cur.fetchone()
+                if row is None:
+                    continue
+                like = 1 if event['kind'] == 'like' else -1
+                for text in canonical.canonicalize_all(self.split_topics(row[0])):
+                    if text not in scores:
+                        scores[text] = self.fetch_feedback_score(user_id, text)
+                    scores[text].update(rescore(scores[text], like, now))
+
+            for text, entry in scores.items():
+                if user_id is None:
+                    self.cur.execute("UPDATE tags SET score = ?, count = ?, updated = ? WHERE text = ?",
+                                     (entry['score'], entry['count'], entry['updated'], text))
+                else:
+                    self.cur.execute("INSERT OR REPLACE INTO profiles (user_id, tag_id, score, count, updated) "
+                                     "VALUES (?, ?, ?, ?, ?)",
+                                     (user_id, entry['id'], entry['score'], entry['count'], entry['updated']))
+            if user_id is None:
+                self.cur.executemany("UPDATE stories SET read = 1 WHERE id = ?", [(story_id,) for story_id in reads])
+            else:
+                self.cur.executemany("INSERT OR IGNORE INTO profile_reads (user_id, story_id) VALUES (?, ?)",
+                                     [(user_id, story_id) for story_id in reads])
+
+            self.cur.executemany("INSERT INTO feedback_events (user_id, event_id, kind, story_id, at, received) "
+                                 "VALUES (?, ?, ?, ?, ?, ?)",
+                                 [(owner, event['id'], event['kind'], int(event['story']), event.get('at'), now)
+                                  for event in fresh])
+            if user_id is None:
+                if scores:
+                    self.bump_version('tags')
+                if reads:
+                    self.bump_version('stories')
+            elif scores or reads:
+                self.bump_version(f'profile_{user_id}')
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        if user_id is None and scores:
+            self.fetch_all_tags()
+        return len(fresh)
+
+    # One tag's score as a reader has it, adding the tag if nobody has met it before (in a transaction)
+    def fetch_feedback_score(self, user_id, text):
+        self.cur.execute("SELECT score, count, id, updated FROM tags WHERE text = ?", (text,))
+        row = self.cur.fetchone()
+        if row is None:
+            self.cur.execute("INSERT INTO tags (text, score, count, id, updated, seen) "
+                             "VALUES (?, 0, 0, (SELECT COALESCE(MAX(id), 0) + 1 FROM tags), ?, ?)",
+                             (text, time.time(), time.time()))
+            self.bump_version('tags')
+            self.cur.execute("SELECT score, count, id, updated FROM tags WHERE text = ?", (text,))
+            row = self.cur.fetchone()
+        if user_id is None:
+            return {'score': row[0], 'count': row[1], 'id': row[2], 'updated': row[3]}
+        self.cur.execute("SELECT score, count, updated FROM profiles WHERE user_id = ? AND tag_id = ?",
+                         (user_id, row[2]))
+        entry = self.cur.fetchone()
+        if entry is None:
+            return {'score': 0, 'count': 0, 'id': row[2], 'updated': None}
+        return {'score': entry[0], 'count': entry[1], 'id': row[2], 'updated': entry[2]}
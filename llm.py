@@ -1,10 +1,118 @@
 import requests
 import json
 import os
+import random
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import badjson
-import utilities
+import canonical
+import logs
+import metrics
+from tracing import traced
 import time
 
+log = logs.get_logger('llm')
+
+request_seconds = metrics.histogram('llm_request_seconds', 'Time for one LLM call, by backend')
+retry_count = metrics.counter('llm_retries_total', 'LLM calls that failed and were retried, by backend')
+failure_count = metrics.counter('llm_failures_total', 'LLM calls that failed, by backend')
+rate_limit_count = metrics.counter('llm_rate_limited_total', 'Rate limit responses, by backend')
+hedge_count = metrics.counter('llm_hedged_total', 'Requests that were slow enough to send to a second backend, '
+                                                  'by the slow backend')
+hedge_wins = metrics.counter('llm_hedge_wins_total', 'Hedged requests, by the backend that answered first')
+backend_health = metrics.gauge('llm_backend_health', 'Recent success rate of each backend in the router (0 to 1)')
+response_formats = metrics.counter('llm_responses_total', 'LLM responses, by backend and how they were parsed '
+                                                          '(schema or badjson)')
+
+#    ┌──────────────────────────────────────────────────────────┐
+#    │    What a tagging response must look like.  Backends     │
+#    │    that can be held to a JSON schema are given this,     │
+#    │    so their output parses first time; the rest are       │
+#    │    asked nicely in the prompt and cleaned up with        │
+#    │    badjson.  The list is wrapped in an object because    │
+#    │    that's all some of the APIs accept at the top.        │
+#    │    LLM_STRUCTURED=0 turns the schemas off.               │
+#    └──────────────────────────────────────────────────────────┘
+tagging_schema = {
+    "type": "object",
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "id": {"type": "integer"},
+                    "tags": {"type": "array", "items": {"type": "string"}}
+                },
+                "required": ["id", "tags"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["results"],
+    "additionalProperties": False
+}
+
+structured_output = os.getenv('LLM_STRUCTURED', '1') != '0'
+
+# (connect, read) seconds for every backend call, so a hung request fails (and gets retried or hedged)
+# instead of holding up the refresh for good.  Local models on a CPU can take a while to answer.
+request_timeout = (10, float(os.getenv('LLM_TIMEOUT_SECONDS', '180')))
+
+#    ┌──────────────────────────────────────────────────────────┐
+#    │    Token estimates for packing batches.  We don't have   │
+#    │    the models' tokenizers, and don't need them: about    │
+#    │    four characters a token is close enough for English,  │
+#    │    and the budgets leave some room for error.            │
+#    └──────────────────────────────────────────────────────────┘
+chars_per_token = 4
+tokens_per_result = 40      # {"id": 1234, "tags": [up to five short tags]}
+request_overhead = 100      # role markers, the assistant's preamble, the schema wrapper
+budget_margin = 0.9
+
+
+def estimate_tokens(text):
+    return len(text) // chars_per_token + 1
+
+
+#   Schema-constrained responses come back as {"results": [...]}; callers just want the list
+def unwrap_results(parsed_response):
+    if type(parsed_response) is dict and type(parsed_response.get('results')) is list:
+        return parsed_response['results']
+    return parsed_response
+
+
+
+#   Pair up an LLM's results with the stories that were sent.  Results carry the story id we sent;
+#   ones from a model that left the ids off are matched up by position, as they used to be.
+def match_results(batch, results, max_tags=5):
+    # If there's just one article, it's likely to not be in an array
+    if type(results) is dict:
+        results = [results]
+
+    by_id = {story['id']: story for story in batch}
+    tagged = {}
+    position = 0
+    for result in results or []:
+        # Sometimes, an LLM will stick a "headline" in the mix or add extra keys.  This skips them
+        if type(result) is not dict or type(result.get('tags')) is not list:
+            continue
+        try:
+            story = by_id.get(int(result['id'])) if 'id' in result else None
+        except (TypeError, ValueError):
+            story = None
+        if story is None and 'id' not in result and position < len(batch):
+            story = batch[position]
+        position += 1
+        if story is None or story['id'] in tagged:
+            continue
+        # Some LLMs will generate way too many tags.  This is a fail-safe to limit the # of tags
+        tags = canonical.canonicalize_all(str(tag) for tag in result['tags'])[:max_tags]
+        if tags:
+            tagged[story['id']] = story.replace(tags=tuple(tags), read=0)
+
+    return list(tagged.values())
 
 #    ┌────────────────────────────────────────────────────────────────────┐
 #    │                                                                    │
@@ -22,6 +130,7 @@ class LLM:
         if model_name is None:
             model_name = os.getenv('LLM_MODEL', 'ollama')
         model_name = model_name.lower()
+        self.name = model_name
         if model_name == 'huggingface':
             self.llm = HuggingFace()
             self.retry_limit = 2
@@ -34,23 +143,67 @@ class LLM:
         else:
             self.llm = Ollama()
             self.retry_limit = 2
+            self.name = 'ollama'
+
+    # Pass a JSON schema (like tagging_schema) to have backends that can enforce one do so.  If every
+    # try fails, the last error is raised: the refresh records it and the stories wait for the next one.
+    @traced
+    def chat(self, system_prompt, user_prompt, history, schema=None):
+        return self.attempt(system_prompt, user_prompt, history, schema)
+
+    # The tries behind chat(), with the option of more or fewer of them
+    def attempt(self, system_prompt, user_prompt, history, schema=None, retry_limit=None):
+        if not structured_output:
+            schema = None
 
-    def chat(self, system_prompt, user_prompt, history):
         # It would be lovely if LLMs always worked perfectly, but they don't.
         # So we need to retry a few times if they fail.
-        retries = self.retry_limit
-        while retries >= 0:
+        retry_limit = self.retry_limit if retry_limit is None else retry_limit
+        retries = retry_limit
+        while True:
             try:
-                response = self.llm.chat(system_prompt, user_prompt, history, retries != self.retry_limit)
+                with request_seconds.time(backend=self.name):
+                    response = self.llm.chat(system_prompt, user_prompt, history, retries != retry_limit, schema)
                 return response
             except Exception as e:
-                print(f"Error: {e}", flush=True)
+                log.warning(f"Error: {e}")
+                failure_count.inc(backend=self.name)
                 retries -= 1
                 if retries < 0:
-                    utilities.Utilities().stop_process()                # If we can't get a response, we need to stop the program
-                print(f"Retrying LLM call", flush=True)
+                    raise
+                log.info("Retrying LLM call")
+                retry_count.inc(backend=self.name)
                 time.sleep(5)
 
+    #    ┌──────────────────────────────────────────────────────────┐
+    #    │    How many of these headlines (from the front) fit in   │
+    #    │    one request: the prompt, the headlines and the        │
+    #    │    answers all have to fit in the model's context, and   │
+    #    │    the answers in what it's allowed to write.  Never     │
+    #    │    more than get_batch_size(), and always at least one.  │
+    #    └──────────────────────────────────────────────────────────┘
+    def pack_batch(self, stories, system_prompt=None):
+        if system_prompt is None:
+            with open('revised_system_prompt.md', 'r') as f:
+                system_prompt = f.read()
+
+        context = self.llm.context_tokens * budget_margin
+        output = self.llm.output_tokens * budget_margin
+        used = estimate_tokens(system_prompt) + request_overhead
+        if structured_output:
+            used += estimate_tokens(json.dumps(tagging_schema))
+
+        answers = 0
+        count = 0
+        for story in stories[:self.get_batch_size()]:
+            prompt = estimate_tokens(json.dumps({"id": story['id'], "headline": story['headline']}))
+            if count > 0 and (used + prompt + tokens_per_result > context or answers + tokens_per_result > output):
+                break
+            used += prompt + tokens_per_result
+            answers += tokens_per_result
+            count += 1
+        return count
+
     #    ┌──────────────────────────────────────────────────────────┐
     #    │    Each LLM has a sweet-spot of how many articles it     │
     #    │    can tag in one call without starting to generate      │
@@ -58,11 +211,167 @@ class LLM:
     #    │    model. If you start seeing a lot of retries or        │
     #    │    even failures, you may need to decrease the batch     │
     #    │    size.  If you never see retries, maybe increase.      │
+    #    │    The token budgets in pack_batch() may send fewer.     │
     #    └──────────────────────────────────────────────────────────┘
     def get_batch_size(self):
         return self.llm.get_batch_size()
 
 
+#   The LLM to tag with: a Router if LLM_MODELS lists several backends, otherwise the one in LLM_MODEL
+def engine():
+    if os.getenv('LLM_MODELS'):
+        return Router()
+    return LLM()
+
+
+#    ┌────────────────────────────────────────────────────────────────────┐
+#    │                                                                    │
+#    │    Router                                                          │
+#    │                                                                    │
+#    │    With LLM_MODELS="groq:2,anthropic:1", batches are spread over   │
+#    │    several backends, twice as many to Groq as to Anthropic.  A     │
+#    │    backend that keeps failing is picked less and less (but never   │
+#    │    quite never, so it can show it's better).  If a request takes   │
+#    │    longer than 95% of that backend's recent requests, the same     │
+#    │    batch goes to a second backend as well, and whichever answers   │
+#    │    first wins (until a backend has a track record, "too long" is   │
+#    │    default_hedge seconds).  One slow provider can no longer hold   │
+#    │    up a whole refresh.                                             │
+#    │                                                                    │
+#    │    Each batch is packed for the backend picked to take it, so a    │
+#    │    small one doesn't shrink everyone's batches; hedges and         │
+#    │    retries only go to backends the batch also fits.                │
+#    │                                                                    │
+#    └────────────────────────────────────────────────────────────────────┘
+class Route:
+    def __init__(self, name, weight):
+        self.llm = LLM(name)
+        self.name = self.llm.name
+        self.weight = weight
+        self.health = 1.0               # moving average of successes (1) and failures (0)
+        self.latencies = deque(maxlen=100)
+        self.lock = threading.Lock()
+
+    def record(self, ok, seconds=None):
+        with self.lock:
+            self.health = 0.8 * self.health + 0.2 * (1.0 if ok else 0.0)
+            if ok:
+                self.latencies.append(seconds)
+        backend_health.set(self.health, backend=self.name)
+
+    # How long before we give up waiting and hedge, or None until we've seen enough requests to know
+    def p95(self, min_samples=10):
+        with self.lock:
+            if len(self.latencies) < min_samples:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[int(len(ordered) * 0.95)]
+
+
+class Router:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if "routes" not in self.__dict__:
+            self.routes = []
+            for entry in os.getenv('LLM_MODELS', '').split(','):
+                name, _, weight = entry.strip().partition(':')
+                if name:
+                    self.routes.append(Route(name, float(weight or 1)))
+            if not self.routes:
+                self.routes.append(Route(None, 1.0))
+            self.min_health = 0.05
+            self.default_hedge = 30.0   # seconds to wait before hedging, for a backend we don't know yet
+            # The backend pack_batch() picked, and the stories it packed, for the chat() that follows
+            self.planned = threading.local()
+            self.executor = ThreadPoolExecutor(max_workers=2 * len(self.routes), thread_name_prefix='llm')
+
+    # A weighted random pick, by weight and health, leaving out the ones we've already tried (and
+    # those the batch doesn't fit)
+    def choose(self, exclude=(), fits=None):
+        candidates = [route for route in self.routes if route not in exclude and (fits is None or fits(route))]
+        if not candidates:
+            return None
+        weights = [route.weight * max(route.health, self.min_health) for route in candidates]
+        return random.choices(candidates, weights=weights)[0]
+
+    def call(self, route, system_prompt, user_prompt, history, schema):
+        start = time.perf_counter()
+        try:
+            # No retries here: trying another backend is quicker than waiting to retry this one
+            response = route.llm.attempt(system_prompt, user_prompt, history, schema, retry_limit=0)
+        except Exception:
+            route.record(False)
+            raise
+        route.record(True, time.perf_counter() - start)
+        return response
+
+    @traced
+    def chat(self, system_prompt, user_prompt, history, schema=None):
+        first, stories = getattr(self.planned, 'route', None), getattr(self.planned, 'stories', None)
+        self.planned.route = self.planned.stories = None
+
+        def fits(route):
+            return stories is None or route.llm.pack_batch(stories, system_prompt) >= len(stories)
+
+        eligible = [route for route in self.routes if fits(route)]
+        tried = []
+        pending = {}
+        while True:
+            # Nothing in flight: start on the next backend, or give up if they've all failed
+            if not pending:
+                route = first if first is not None and not tried else self.choose(tried, fits)
+                if route is None:
+                    break
+                tried.append(route)
+                pending[self.executor.submit(self.call, route, system_prompt, user_prompt, history, schema)] = route
+
+            # Wait as long as the slowest in-flight backend usually takes, then hedge (with nothing
+            # left to hedge with, the requests' own timeouts see that this ends)
+            limits = [route.p95() or self.default_hedge for route in pending.values()]
+            timeout = None if len(tried) >= len(eligible) else max(limits)
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            if not done:
+                route = self.choose(tried, fits)
+                for slow in pending.values():
+                    hedge_count.inc(backend=slow.name)
+                    log.info(f'{slow.name} is slow; asking {route.name} too')
+                tried.append(route)
+                pending[self.executor.submit(self.call, route, system_prompt, user_prompt, history, schema)] = route
+                continue
+
+            for future in done:
+                route = pending.pop(future)
+                if future.exception() is None:
+                    if len(tried) > 1 and pending:
+                        hedge_wins.inc(backend=route.name)
+                    # The loser carries on in the background and its answer is dropped
+                    return future.result()
+
+        # Every backend failed once; give the healthiest one its usual retries before giving up (by raising,
+        # which leaves the stories for the next refresh rather than taking the server down)
+        best = max(eligible or self.routes, key=lambda r: r.health)
+        return best.llm.attempt(system_prompt, user_prompt, history, schema)
+
+    # Pick the backend for the next batch now, and pack it for that one
+    def pack_batch(self, stories, system_prompt=None):
+        route = self.choose()
+        size = route.llm.pack_batch(stories, system_prompt)
+        self.planned.route = route
+        self.planned.stories = list(stories[:size])
+        return size
+
+    # The most any backend takes, for callers that just want a rough size
+    def get_batch_size(self):
+        return max(route.llm.get_batch_size() for route in self.routes)
+
+
 #    ┌────────────────────────────────────────────────────────────────────┐
 #    │                                                                    │
 #    │    Hugging Face / Llama 8b                                         │
@@ -81,15 +390,17 @@ class HuggingFace:
         self.API_URL = "https://api-inference.huggingface.co/models/meta-llama/Llama-3.3-70B-Instruct"
         # This is how we get our API KEY -- from the environment
         self.headers = {"Authorization": f"Bearer {os.getenv('HF_API_KEY')}"}
+        self.context_tokens = 8192
+        self.output_tokens = 250        # I think this is the max we can ask for
 
     @staticmethod
     def get_batch_size():
-        # 5 starts generating weird errors
-        return 4
+        # More than 4 used to overflow max_new_tokens and come back cut off; pack_batch() now sees to that
+        return 8
 
     # This makes the actual call to the LLM and returns the response
     def llama_query(self, payload):
-        response = requests.post(self.API_URL, headers=self.headers, json=payload)
+        response = requests.post(self.API_URL, headers=self.headers, json=payload, timeout=request_timeout)
 
         # If not 200, throw an error
         if response.status_code != 200:
@@ -121,8 +432,9 @@ class HuggingFace:
         query += "<|start_header_id|>assistant<|end_header_id|>\n\n"
         return query
 
-    # This is the externally callable chat interface
-    def chat(self, system_prompt, user_prompt, history, retry):        # You might get warnings about history not being used. Ignore them
+    # This is the externally callable chat interface.  The inference API can't be held to a schema,
+    # so that's ignored and we rely on the prompt and badjson.
+    def chat(self, system_prompt, user_prompt, history, retry, schema=None):        # You might get warnings about history not being used. Ignore them
         if system_prompt is None:
             with open('revised_system_prompt.md', 'r') as f:
                 system_prompt = f.read()
@@ -131,11 +443,12 @@ class HuggingFace:
         temp = 0.1 + retry * 0.9
 
         raw_response = self.llama_query({"inputs": query, "parameters": {
-                "max_new_tokens": 250,          # I think this is the max we can ask for
+                "max_new_tokens": self.output_tokens,
                 "temperature": temp
             }})
-        print('Raw Response:\n', raw_response.replace('\n', ' '), flush=True)
+        log.debug('Raw Response: ' + raw_response.replace('\n', ' '))
         parsed_response = badjson.loads(raw_response)
+        response_formats.inc(backend='huggingface', format='badjson')
         if type(parsed_response).__name__ == 'dict':
             parsed_response = parsed_response[list(parsed_response.keys())[0]]
 
@@ -155,19 +468,29 @@ class HuggingFace:
 class Anthropic:
     def __init__(self):
         self.api_key = os.getenv('ANTHROPIC_API_KEY')
+        self.base_url = os.getenv('ANTHROPIC_BASE_URL', 'https://api.anthropic.com')
+        self.context_tokens = 200000
+        self.output_tokens = 2000
 
     @staticmethod
     def get_batch_size():
-        return 10           # Much more powerful than the others
+        return 25           # Much more powerful than the others
 
-    def chat(self, system_prompt, user_prompt, history, retry):
-        url = 'https://api.anthropic.com/v1/messages'
-        headers = {
+    def headers(self):
+        return {
             "Content-Type": "application/json",
             "x-api-key": self.api_key,
             "anthropic-version": "2023-06-01"
         }
 
+    def chat(self, system_prompt, user_prompt, history, retry, schema=None):
+        llm_input = self.build_request(system_prompt, user_prompt, history, retry, schema)
+        full_response = requests.post(f'{self.base_url}/v1/messages', headers=self.headers(),
+                                      data=json.dumps(llm_input), timeout=request_timeout).json()
+        return self.parse_response(full_response)
+
+    # The body of a Messages API call (also what goes in each request of a message batch)
+    def build_request(self, system_prompt, user_prompt, history, retry, schema=None):
         if system_prompt is None:
             with open('revised_system_prompt.md', 'r') as f:
                 system_prompt = f.read()
@@ -186,14 +509,32 @@ class Anthropic:
         llm_input = {
             "messages": messages,
             "model": "claude-3-haiku-20240307",
-            "max_tokens": 2000,
+            "max_tokens": self.output_tokens,
             "temperature": 0.1 + retry * 0.9
         }
 
-        full_response = requests.post(url, headers=headers, data=json.dumps(llm_input))
-        raw_response = full_response.json()['content'][0]['text']
+        # Claude can't be given a response schema as such, but it can be made to call a "tool" with
+        # arguments that match one, and the arguments are what we want
+        if schema is not None:
+            llm_input["tools"] = [{"name": "record_tags", "description": "Record the tags for each headline",
+                                   "input_schema": schema}]
+            llm_input["tool_choice"] = {"type": "tool", "name": "record_tags"}
+
+        return llm_input
 
-        print('Raw Response:\n', raw_response.replace('\n', ' '), flush=True)
+    # A Messages API response -> the list of results
+    @staticmethod
+    def parse_response(full_response):
+        for block in full_response['content']:
+            if block.get('type') == 'tool_use':
+                log.debug('Tool input: ' + json.dumps(block['input']))
+                response_formats.inc(backend='anthropic', format='schema')
+                return unwrap_results(block['input'])
+
+        raw_response = full_response['content'][0]['text']
+        response_formats.inc(backend='anthropic', format='badjson')
+
+        log.debug('Raw Response: ' + raw_response.replace('\n', ' '))
         parsed_response = badjson.loads(raw_response)
         if type(parsed_response).__name__ == 'dict':
             parsed_response = parsed_response[list(parsed_response.keys())[0]]
@@ -215,12 +556,14 @@ class Ollama:
         self.use_json = True
         self.url = 'http://localhost:11434/api/chat'
         self.model = model_name
+        self.context_tokens = 8192
+        self.output_tokens = 2048
 
     @staticmethod
     def get_batch_size():
         return 1
 
-    def chat(self, system_prompt, user_prompt, history, retry):
+    def chat(self, system_prompt, user_prompt, history, retry, schema=None):
         if system_prompt is None:
             with open('revised_system_prompt.md', 'r') as f:
                 system_prompt = f.read()
@@ -235,25 +578,32 @@ class Ollama:
             'model': self.model,
             'messages': messages,
             'stream': False,
-            'format': 'json',
-            'num_ctx': 8192,
+            # Ollama will hold the model to a JSON schema, or at least to JSON
+            'format': schema if schema is not None else 'json',
+            'num_ctx': self.context_tokens,
             'temperature': 0.1 + retry * 0.9,
         }
         headers = {
             "Content-Type": "application/json"
         }
 
-        full_response = requests.post(self.url, headers=headers, data=json.dumps(llm_input))
+        full_response = requests.post(self.url, headers=headers, data=json.dumps(llm_input), timeout=request_timeout)
         raw_response = full_response.json()['message']['content']
         parsed_response = None
         if self.use_json:
             try:
-                print('Raw Response:\n', raw_response.replace('\n', ' '), flush=True)
-                parsed_response = badjson.loads(raw_response)
+                log.debug('Raw Response: ' + raw_response.replace('\n', ' '))
+                if schema is not None:
+                    # The schema has been enforced, so it's proper JSON already
+                    parsed_response = unwrap_results(json.loads(raw_response))
+                    response_formats.inc(backend='ollama', format='schema')
+                else:
+                    parsed_response = badjson.loads(raw_response)
+                    response_formats.inc(backend='ollama', format='badjson')
 
             except json.JSONDecodeError as e:
-                print(f"Error parsing JSON: {e}", flush=True)
-                print(f"User prompt was: {user_prompt}", flush=True)
+                log.warning(f"Error parsing JSON: {e}")
+                log.debug(f"User prompt was: {user_prompt}")
                 raise
 
         return parsed_response
@@ -265,21 +615,28 @@ class Ollama:
 #    └──────────────────────────────────────────────────────────┘
 class Groq:
     def __init__(self):
-        self.url = 'https://api.groq.com/openai/v1/chat/completions'
+        self.base_url = os.getenv('GROQ_BASE_URL', 'https://api.groq.com/openai')
+        self.url = f'{self.base_url}/v1/chat/completions'
         self.api_key = os.getenv('GROQ_API_KEY')
         self.model = os.getenv('GROQ_MODEL', 'llama3-70b-8192')
+        # Only some Groq models take a json_schema response format; we find out on the first call
+        self.schema_supported = True
+        self.context_tokens = 8192
+        self.output_tokens = 2048
 
     def get_batch_size(self):
-        return 5
+        return 10
 
-    def query(self, query):
-        headers = {
+    def headers(self):
+        return {
             "Content-Type": "application/json",
             "Authorization": f'Bearer {self.api_key}'
         }
 
+    def query(self, query):
         while True:
-            full_response = requests.post(self.url, headers=headers, data=json.dumps(query))
+            full_response = requests.post(self.url, headers=self.headers(), data=json.dumps(query),
+                                          timeout=request_timeout)
             full_response = full_response.json()
             if 'error' in full_response:
                 if full_response['error']['code'] == "rate_limit_exceeded":
@@ -299,18 +656,47 @@ class Groq:
 
                     # Round up two seconds
                     d = int(m + 2)
-                    print(f"Rate limit exceeded.  Waiting {d} second{'s' * (d > 1)}", flush=True)
+                    log.info(f"Rate limit exceeded.  Waiting {d} second{'s' * (d > 1)}")
+                    rate_limit_count.inc(backend='groq')
                     time.sleep(d)
                     continue
             return full_response
 
-    def chat(self, system_prompt, user_prompt, history, isRetry):
+    def chat(self, system_prompt, user_prompt, history, isRetry, schema=None):
 
         # If we're retrying, wait because we may have a weird rate limit edge case where the
         # previous call's output was cut short because of rate limiting
         if isRetry:
             time.sleep(10)
 
+        use_schema = schema is not None and self.schema_supported
+        llm_input = self.build_request(system_prompt, user_prompt, history, isRetry, schema if use_schema else None)
+
+        full_response = self.query(llm_input)
+        if use_schema and self.schema_unsupported(full_response.get('error')):
+            # This model can't do schemas; remember that and ask again the old way
+            log.info(f"{self.model} doesn't support response schemas: {full_response['error'].get('message')}")
+            self.schema_supported = False
+            del llm_input['response_format']
+            use_schema = False
+            full_response = self.query(llm_input)
+        if 'error' in full_response:
+            # Over capacity, an answer that didn't fit the schema and so on: the caller tries again
+            raise RuntimeError(f"Groq error: {full_response['error'].get('message')}")
+        return self.parse_response(full_response, use_schema)
+
+    # Only an error about the response format itself means the model can't do schemas; a 5xx, or the
+    # model writing JSON that doesn't fit (json_validate_failed), is worth another go with the schema
+    @staticmethod
+    def schema_unsupported(error):
+        if not isinstance(error, dict) or error.get('code') == 'json_validate_failed':
+            return False
+        message = str(error.get('message', '')).lower()
+        about_format = 'response_format' in message or 'json_schema' in message
+        return about_format and any(word in message for word in ('not supported', 'unsupported', 'does not support'))
+
+    # The body of a chat completions call (also what goes in each line of a batch file)
+    def build_request(self, system_prompt, user_prompt, history, isRetry, schema=None):
         if system_prompt is None:
             with open('revised_system_prompt.md', 'r') as f:
                 system_prompt = f.read()
@@ -325,13 +711,26 @@ class Groq:
             'messages': messages,
             'model': self.model,
             'temperature': 0.1 + 0.9 * isRetry,
+            'max_tokens': self.output_tokens,
         }
 
-        full_response = self.query(llm_input)
+        if schema is not None:
+            llm_input['response_format'] = {'type': 'json_schema',
+                                            'json_schema': {'name': 'headline_tags', 'schema': schema}}
+        return llm_input
+
+    # A chat completions response -> the list of results
+    @staticmethod
+    def parse_response(full_response, use_schema):
         raw_response = full_response['choices'][0]['message']['content']
 
-        print('Raw Response:\n', raw_response.replace('\n',' '), flush=True)
+        log.debug('Raw Response: ' + raw_response.replace('\n', ' '))
+        if use_schema:
+            response_formats.inc(backend='groq', format='schema')
+            return unwrap_results(json.loads(raw_response))
+
         parsed_response = badjson.loads(raw_response)
+        response_formats.inc(backend='groq', format='badjson')
         if type(parsed_response).__name__ == 'dict':
             parsed_response = parsed_response[list(parsed_response.keys())[0]]
 
@@ -0,0 +1,452 @@
+#    ┌────────────────────────────────────────────────────────────────────┐
+#    │                                                                    │
+#    │                            Load Test                               │
+#    │                                                                    │
+#    │    How does the app hold up with a room full of readers?  This     │
+#    │    starts it in a scratch directory against a seeded database,     │
+#    │    with a stand-in for both CNN Lite and the LLM (so nothing       │
+#    │    leaves the machine and the numbers don't depend on Groq's       │
+#    │    mood), then has a number of simulated readers hit it at once    │
+#    │    with a mix of requests.  For each endpoint it reports           │
+#    │    throughput, p50/p95/p99 latency and errors, plus the            │
+#    │    server's memory, and saves it all as JSON to compare against    │
+#    │    next time:                                                      │
+#    │                                                                    │
+#    │        python loadtest.py --users 20 --duration 60 \               │
+#    │            --save baseline.json                                    │
+#    │        python loadtest.py --users 20 --duration 60 \               │
+#    │            --compare baseline.json                                 │
+#    │                                                                    │
+#    │    The mix is weights per endpoint, e.g. --mix home=5,like=2.      │
+#    │    --server runs something other than Flask's own server, e.g.     │
+#    │    --server "gunicorn -w 4 -b 127.0.0.1:{port} wsgi:app".          │
+#    │                                                                    │
+#    └────────────────────────────────────────────────────────────────────┘
+import argparse
+import json
+import os
+import random
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from http.server import ThreadingHTTPServer
+
+import requests
+
+import backfill
+import logs
+
+log = logs.get_logger('loadtest')
+
+here = os.path.dirname(os.path.abspath(__file__))
+results_dir = os.path.join('temp', 'loadtest')
+
+default_mix = 'home=5,status=3,like=2,open=1,stories=1,feedback=1'
+default_server = f'{shlex.quote(sys.executable)} -c ' \
+                 f'"from app import app; app.run(host=\'127.0.0.1\', port={{port}}, threaded=True)"'
+
+words = ['Senate', 'markets', 'storm', 'election', 'court', 'vaccine', 'rally', 'talks', 'strike', 'budget',
+         'wildfire', 'tariffs', 'summit', 'verdict', 'launch', 'merger', 'protest', 'drought', 'ceasefire',
+         'earnings', 'record', 'inquiry', 'flooding', 'shortage', 'deal', 'crisis', 'reform', 'heatwave']
+topics = ['politics', 'economy', 'weather', 'health', 'technology', 'sports', 'europe', 'asia', 'usa',
+          'climate', 'courts', 'energy', 'business', 'science', 'entertainment', 'middle east', 'africa',
+          'education', 'immigration', 'space']
+
+
+def make_headline(i):
+    rng = random.Random(i)
+    return f'{" ".join(rng.choice(words) for _ in range(6)).capitalize()} in story number {i}'
+
+
+def make_url(i):
+    return f'/2026/01/01/world/story-{i}/index.html'
+
+
+#   A fresh database with `count` tagged stories and a few opinions, so /home has something to rank
+def seed(path, count):
+    import datamodel
+    datamodel.database_file = path
+    d = datamodel.DataModel()
+    rng = random.Random(count)
+    for i in range(count):
+        d.upsert_story({"headline": make_headline(i), "url": make_url(i), "read": 0,
+                        "tags": rng.sample(topics, rng.randint(1, 4))})
+    d.touch_tags(topics)
+    for text in rng.sample(topics, 6):
+        d.upsert_tag({"text": text, "score": rng.choice([-1, 1]) * rng.random(), "count": 1})
+    d.conn.close()
+    del datamodel.DataModel._instance[threading.get_ident()]
+
+
+#    ┌──────────────────────────────────────────────────────────┐
+#    │                 Stand-in CNN Lite and LLM                │
+#    └──────────────────────────────────────────────────────────┘
+class StandInHandler(backfill.StandInHandler):
+    seeded = 0
+    page_size = 100
+    new_per_fetch = 5           # headlines the app hasn't seen before, on every fetch
+    fetches = 0
+    llm_latency = 0.0
+
+    # The front page: the newest seeded stories plus a few brand new ones to tag
+    def do_GET(self):
+        if self.path.strip('/') != '':
+            return super().do_GET()
+        with StandInHandler.lock:
+            StandInHandler.fetches += 1
+            first_new = self.seeded + (StandInHandler.fetches - 1) * self.new_per_fetch
+        numbers = list(range(first_new, first_new + self.new_per_fetch))
+        numbers += range(max(0, self.seeded - self.page_size), self.seeded)
+        links = '\n'.join(f'<li><a href="{make_url(i)}">{make_headline(i)}</a></li>' for i in numbers)
+        body = f'<html><body><ul>{links}</ul></body></html>'.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # The synchronous Groq endpoint, which is what the app uses for everyday tagging
+    def do_POST(self):
+        if self.path != '/openai/v1/chat/completions':
+            return super().do_POST()
+        body = json.loads(self.read_body())
+        time.sleep(self.llm_latency)
+        self.send_json(self.openai_completion(body))
+
+
+def start_stand_in(seeded, llm_latency):
+    StandInHandler.seeded = seeded
+    StandInHandler.llm_latency = llm_latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+#    ┌──────────────────────────────────────────────────────────┐
+#    │                     The App Under Test                   │
+#    └──────────────────────────────────────────────────────────┘
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_app(command, workdir, stand_in_url, port):
+    env = dict(os.environ,
+               NEWSREADER_DB=os.path.join(workdir, 'loadtest.db'),
+               CNN_URL=stand_in_url,
+               LLM_MODEL='groq',
+               GROQ_API_KEY='loadtest',
+               GROQ_BASE_URL=f'{stand_in_url}/openai',
+               SECRET_KEY='loadtest',
+               PYTHONPATH=os.pathsep.join(filter(None, [here, os.getenv('PYTHONPATH')])))
+    env.pop('LLM_MODELS', None)
+    server_log = open(os.path.join(workdir, 'server.log'), 'w')
+    process = subprocess.Popen(shlex.split(command.format(port=port)), cwd=workdir, env=env,
+                               stdout=server_log, stderr=subprocess.STDOUT)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'The app exited; see {server_log.name}')
+        try:
+            requests.get(f'{base_url}/api/status', timeout=1)
+            return process, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'The app did not start within a minute; see {server_log.name}')
+
+
+#   pid -> (parent pid, resident memory in bytes) for every process, from /proc on Linux or ps elsewhere
+#   (macOS, say).  None if neither is there (Windows).
+def process_table():
+    if os.path.isdir('/proc'):
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        table = {}
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    with open(f'/proc/{entry}/stat') as f:
+                        fields = f.read().rsplit(')', 1)[1].split()
+                    table[int(entry)] = (int(fields[1]), int(fields[21]) * page_size)
+                except (OSError, IndexError, ValueError):
+                    pass
+        return table
+    try:
+        output = subprocess.run(['ps', '-A', '-o', 'pid=,ppid=,rss='], capture_output=True, text=True,
+                                check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    table = {}
+    for line in output.splitlines():
+        pid, parent, rss = line.split()
+        table[int(pid)] = (int(parent), int(rss) * 1024)
+    return table
+
+
+#   Resident memory of the server and everything it started (gunicorn's workers, say), in bytes,
+#   or None if we can't tell on this platform
+def tree_rss(pid):
+    table = process_table()
+    if table is None:
+        return None
+    family = {pid}
+    for _ in range(3):
+        family |= {child for child, (parent, _) in table.items() if parent in family}
+    return sum(table[member][1] for member in family if member in table)
+
+
+class MemoryWatcher(threading.Thread):
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.running = True
+
+    def run(self):
+        while self.running:
+            rss = tree_rss(self.pid)
+            if rss is None:
+                log.warning('Can\'t measure the server\'s memory on this platform; leaving it out')
+                return
+            self.samples.append(rss)
+            time.sleep(self.interval)
+
+    # None if there's nothing to go on
+    def summary(self):
+        samples = [s for s in self.samples if s]
+        if not samples:
+            return None
+        return {'start_mb': round(samples[0] / 2 ** 20, 1), 'peak_mb': round(max(samples) / 2 ** 20, 1),
+                'end_mb': round(samples[-1] / 2 ** 20, 1)}
+
+
+#    ┌──────────────────────────────────────────────────────────┐
+#    │                    Simulated Readers                     │
+#    └──────────────────────────────────────────────────────────┘
+class Reader:
+    def __init__(self, base_url, number, story_count, named):
+        self.base_url = base_url
+        self.session = requests.Session()
+        self.rng = random.Random(number)
+        self.story_count = story_count
+        self.etag = None
+        if named:
+            self.session.post(f'{base_url}/user', data={'name': f'reader{number}'}, allow_redirects=False)
+
+    def story(self):
+        return self.rng.randrange(1, self.story_count + 1)
+
+    def home(self):
+        headers = {'If-None-Match': self.etag} if self.etag else {}
+        response = self.session.get(f'{self.base_url}/home', headers=headers)
+        self.etag = response.headers.get('ETag', self.etag)
+        return response
+
+    def status(self):
+        return self.session.get(f'{self.base_url}/api/status')
+
+    def like(self):
+        return self.session.get(f'{self.base_url}/api/like', params={'id': self.story()})
+
+    def dislike(self):
+        return self.session.get(f'{self.base_url}/api/dislike', params={'id': self.story()})
+
+    def open(self):
+        return self.session.get(f'{self.base_url}/open', params={'id': self.story()}, allow_redirects=False)
+
+    def stories(self):
+        return self.session.get(f'{self.base_url}/api/stories', params={'limit': 25})
+
+    def feedback(self):
+        events = [{'id': f'{id(self)}-{time.time_ns()}-{i}', 'kind': self.rng.choice(['like', 'dislike', 'read']),
+                   'story': self.story(), 'at': time.time() * 1000} for i in range(5)]
+        return self.session.post(f'{self.base_url}/api/feedback', json={'events': events})
+
+
+def parse_mix(text):
+    mix = {}
+    for entry in text.split(','):
+        name, _, weight = entry.strip().partition('=')
+        if not hasattr(Reader, name) or name.startswith('_') or name == 'story':
+            raise argparse.ArgumentTypeError(f'No such endpoint in the mix: {name}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def drive(reader, mix, until, record_after, think, results, lock):
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    while time.time() < until:
+        name = reader.rng.choices(names, weights=weights)[0]
+        start = time.perf_counter()
+        try:
+            ok = getattr(reader, name)().status_code < 400
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - start
+        if time.time() >= record_after:
+            with lock:
+                results[name].append((elapsed, ok))
+        if think:
+            time.sleep(reader.rng.expovariate(1 / think))
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(results, duration):
+    report = {}
+    for name, samples in sorted(results.items()):
+        latencies = sorted(elapsed for elapsed, _ in samples)
+        errors = sum(1 for _, ok in samples if not ok)
+        report[name] = {'requests': len(samples),
+                        'per_second': round(len(samples) / duration, 2),
+                        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+                        'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+                        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+                        'error_rate': round(errors / len(samples), 4)}
+    return report
+
+
+#    ┌──────────────────────────────────────────────────────────┐
+#    │                    Reports & Baselines                   │
+#    └──────────────────────────────────────────────────────────┘
+def print_report(result):
+    print(f'\n{result["users"]} readers for {result["duration"]}s against {result["stories"]} stories')
+    print(f'{"endpoint":<10} {"requests":>9} {"per sec":>9} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"errors":>8}')
+    for name, row in result['endpoints'].items():
+        print(f'{name:<10} {row["requests"]:>9} {row["per_second"]:>9} {row["p50_ms"]:>9} {row["p95_ms"]:>9} '
+              f'{row["p99_ms"]:>9} {row["error_rate"]:>8.1%}')
+    memory = result['memory']
+    if memory:
+        print(f'server memory: {memory["start_mb"]} MB at start, {memory["peak_mb"]} MB peak, '
+              f'{memory["end_mb"]} MB at end')
+    else:
+        print('server memory: not measured')
+
+
+#   Prints what got worse than the baseline by more than `tolerance`, and returns whether anything did
+def compare(result, baseline, tolerance):
+    regressed = False
+    for name, row in result['endpoints'].items():
+        before = baseline['endpoints'].get(name)
+        if before is None:
+            continue
+        problems = []
+        if row['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            problems.append(f'p95 {before["p95_ms"]} -> {row["p95_ms"]} ms')
+        if row['per_second'] < before['per_second'] * (1 - tolerance):
+            problems.append(f'throughput {before["per_second"]} -> {row["per_second"]}/s')
+        if row['error_rate'] > before['error_rate'] + 0.01:
+            problems.append(f'errors {before["error_rate"]:.1%} -> {row["error_rate"]:.1%}')
+        if problems:
+            regressed = True
+            print(f'REGRESSION {name}: {", ".join(problems)}')
+    # Either run may have been somewhere memory couldn't be measured
+    peak_before = (baseline.get('memory') or {}).get('peak_mb')
+    peak_now = (result['memory'] or {}).get('peak_mb')
+    if peak_before and peak_now and peak_now > peak_before * (1 + tolerance):
+        regressed = True
+        print(f'REGRESSION memory: peak {peak_before} -> {peak_now} MB')
+    if not regressed:
+        print(f'No regressions beyond {tolerance:.0%} of {baseline.get("commit") or "the baseline"}')
+    return regressed
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=here, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='newsreader-loadtest-')
+    for name in ('revised_system_prompt.md', 'system_prompt.md'):
+        shutil.copy(os.path.join(here, name), workdir)
+    log.info(f'Seeding {args.stories} stories in {workdir}')
+    seed(os.path.join(workdir, 'loadtest.db'), args.stories)
+
+    stand_in = start_stand_in(args.stories, args.llm_latency)
+    stand_in_url = f'http://127.0.0.1:{stand_in.server_address[1]}'
+    process, base_url = start_app(args.server, workdir, stand_in_url, free_port())
+    watcher = MemoryWatcher(process.pid)
+    watcher.start()
+    try:
+        readers = [Reader(base_url, i, args.stories, args.named) for i in range(args.users)]
+        results = defaultdict(list)
+        lock = threading.Lock()
+        record_after = time.time() + args.warmup
+        until = record_after + args.duration
+        log.info(f'{args.users} readers for {args.warmup}s of warm-up and {args.duration}s of measuring')
+        threads = [threading.Thread(target=drive, args=(reader, args.mix, until, record_after, args.think,
+                                                        results, lock)) for reader in readers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        watcher.running = False
+        watcher.join()
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            # Busy workers can take a while to wind down; don't lose the results (or leave it running)
+            log.warning('The app did not stop within 10s of being asked; killing it')
+            process.kill()
+            process.wait()
+        stand_in.shutdown()
+
+    result = {'commit': git_commit(), 'time': time.time(), 'users': args.users, 'duration': args.duration,
+              'stories': args.stories, 'mix': args.mix, 'named': args.named, 'server': args.server,
+              'llm_latency': args.llm_latency, 'endpoints': summarize(results, args.duration),
+              'memory': watcher.summary(), 'workdir': workdir}
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the news reader against a stand-in CNN and LLM')
+    parser.add_argument('--users', type=int, default=10, help='simulated readers at once')
+    parser.add_argument('--duration', type=int, default=30, help='seconds to measure for')
+    parser.add_argument('--warmup', type=int, default=5, help='seconds of requests before measuring')
+    parser.add_argument('--stories', type=int, default=500, help='stories to seed the database with')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(default_mix),
+                        help=f'endpoint weights (default {default_mix})')
+    parser.add_argument('--named', action='store_true', help='each reader signs in with their own name')
+    parser.add_argument('--think', type=float, default=0, help='average seconds between a reader\'s requests')
+    parser.add_argument('--llm-latency', type=float, default=0.2, help='seconds the stand-in LLM takes to answer')
+    parser.add_argument('--server', default=default_server, help='command to start the app, with {port}')
+    parser.add_argument('--save', help='write the results here (default temp/loadtest/<time>.json)')
+    parser.add_argument('--compare', help='a saved result to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='how much worse counts as a regression')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory (database, server.log)')
+    args = parser.parse_args()
+
+    result = run(args)
+    print_report(result)
+
+    save = args.save or os.path.join(results_dir, f'{time.strftime("%Y%m%d-%H%M%S")}.json')
+    os.makedirs(os.path.dirname(save) or '.', exist_ok=True)
+    with open(save, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f'Saved to {save}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            sys.exit(1 if compare(result, json.load(f), args.tolerance) else 0)
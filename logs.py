@@ -0,0 +1,139 @@
+#    ┌────────────────────────────────────────────────────────────────────┐
+#    │                                                                    │
+#    │                              Logging                               │
+#    │                                                                    │
+#    │    Everything that used to be a print() goes through here.  Each   │
+#    │    module gets its own logger, and its level can be set from the   │
+#    │    environment:                                                    │
+#    │                                                                    │
+#    │        LOG_LEVEL=INFO          the default for every module        │
+#    │        LOG_LEVEL_LLM=DEBUG     just the llm module, say            │
+#    │                                                                    │
+#    │    The actual writing is done by a background thread, so a slow    │
+#    │    console or disk never holds up the tagging.                     │
+#    │                                                                    │
+#    │    There's also an audit log of every headline and the tags it     │
+#    │    was given, in case something looks suspicious in the UI.  It    │
+#    │    is JSON lines in temp/articles.jsonl, rotated by size, and it   │
+#    │    is kept across restarts.                                        │
+#    │                                                                    │
+#    └────────────────────────────────────────────────────────────────────┘
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+import metrics
+
+audit_file = os.path.join('temp', 'articles.jsonl')
+audit_max_bytes = 5 * 1024 * 1024
+audit_backups = 5
+audit_buffer = 50       # records held in memory before they are written out
+
+_lock = threading.Lock()
+_listener = None
+_audit_buffer_handler = None
+_queue = queue.Queue(-1)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)),
+                 'event': record.getMessage()}
+        entry.update(getattr(record, 'audit', {}))
+        return json.dumps(entry)
+
+
+# Route records to the console or the audit file once they come off the queue
+class AuditFilter(logging.Filter):
+    def __init__(self, want_audit):
+        super().__init__()
+        self.want_audit = want_audit
+
+    def filter(self, record):
+        return hasattr(record, 'audit') == self.want_audit and not hasattr(record, 'flushed')
+
+
+# Holds audit records until it has a batch, or a flush marker comes through the queue behind them
+class AuditBuffer(logging.handlers.MemoryHandler):
+    def handle(self, record):
+        flushed = getattr(record, 'flushed', None)
+        if flushed is None:
+            return super().handle(record)
+        self.flush()
+        flushed.set()
+        return True
+
+
+def setup():
+    global _listener, _audit_buffer_handler
+
+    with _lock:
+        if _listener is not None:
+            return
+
+        console = logging.StreamHandler()
+        console.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s', '%H:%M:%S'))
+        console.addFilter(AuditFilter(False))
+
+        if not os.path.exists(os.path.dirname(audit_file)):
+            os.mkdir(os.path.dirname(audit_file))
+        audit = logging.handlers.RotatingFileHandler(audit_file, maxBytes=audit_max_bytes,
+                                                     backupCount=audit_backups, encoding='utf-8')
+        audit.setFormatter(JsonLinesFormatter())
+        _audit_buffer_handler = AuditBuffer(audit_buffer, target=audit)
+        _audit_buffer_handler.addFilter(AuditFilter(True))
+
+        root = logging.getLogger('newsreader')
+        root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+        root.addHandler(logging.handlers.QueueHandler(_queue))
+        root.propagate = False
+        logging.getLogger('newsreader.audit').setLevel(logging.INFO)
+
+        _listener = logging.handlers.QueueListener(_queue, console, _audit_buffer_handler,
+                                                   respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown)
+
+        metrics.gauge('log_queue_depth', 'Log records waiting for the writer thread', _queue.qsize)
+
+
+def get_logger(name):
+    setup()
+    logger = logging.getLogger(f'newsreader.{name}')
+    level = os.getenv(f'LOG_LEVEL_{name.upper()}')
+    if level is not None:
+        logger.setLevel(level.upper())
+    return logger
+
+
+#   Record a headline (or anything else worth keeping) in the audit log
+def audit(event, **fields):
+    get_logger('audit').info(event, extra={'audit': fields})
+
+
+#   Push whatever audit records are sitting in memory out to disk (e.g., at the end of a refresh).
+#   The marker goes through the queue behind everything logged so far, and the writer thread
+#   flushes when it gets to it.
+def flush(timeout=5):
+    if _listener is None:
+        return
+    marker = logging.makeLogRecord({'flushed': threading.Event(), 'levelno': logging.CRITICAL})
+    _queue.put_nowait(marker)
+    marker.flushed.wait(timeout)
+
+
+def shutdown():
+    global _listener
+    with _lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        audit_file_handler = _audit_buffer_handler.target
+        _audit_buffer_handler.close()
+        audit_file_handler.close()
+        _listener = None
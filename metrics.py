@@ -0,0 +1,178 @@
+#    ┌────────────────────────────────────────────────────────────────────┐
+#    │                                                                    │
+#    │                              Metrics                               │
+#    │                                                                    │
+#    │    A small in-process registry of counters, gauges and latency     │
+#    │    histograms, rendered in the Prometheus text format on           │
+#    │    /metrics.  It's not the official client library, just enough    │
+#    │    of one that dashboards and alerts have real numbers to use.     │
+#    │                                                                    │
+#    │    Metrics are created once, at module level, where they are       │
+#    │    used:                                                           │
+#    │                                                                    │
+#    │        fetch_seconds = metrics.histogram('cnn_fetch_seconds',      │
+#    │                                          'Time to download CNN')   │
+#    │        with fetch_seconds.time():                                  │
+#    │            ...                                                     │
+#    │                                                                    │
+#    │    Each process keeps its own numbers, so every sample carries a   │
+#    │    `worker` label (the process id).  Under a server with several   │
+#    │    workers, /metrics shows only the one that answered; sum by      │
+#    │    the other labels to add up the workers you've seen.             │
+#    │                                                                    │
+#    └────────────────────────────────────────────────────────────────────┘
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+prefix = 'newsreader_'
+default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Registry:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if "metrics" not in self.__dict__:
+            self.metrics = {}
+            self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            # Modules can be imported more than once (e.g., by the load tester), so reuse what's there
+            if metric.name in self.metrics:
+                return self.metrics[metric.name]
+            self.metrics[metric.name] = metric
+            return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        worker = (('worker', str(os.getpid())),)
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples(worker))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help_text):
+        self.name = prefix + name
+        self.help = help_text
+        self.values = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(labels):
+        return tuple(sorted(labels.items()))
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self, worker=()):
+        with self.lock:
+            return [f'{self.name}{format_labels(worker + k)} {format_value(v)}' for k, v in self.values.items()]
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, function=None):
+        super().__init__(name, help_text)
+        self.function = function    # Called at scrape time, for things like queue sizes
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def samples(self, worker=()):
+        if self.function is not None:
+            return [f'{self.name}{format_labels(worker)} {format_value(self.function())}']
+        with self.lock:
+            return [f'{self.name}{format_labels(worker + k)} {format_value(v)}' for k, v in self.values.items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=default_buckets):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self, worker=()):
+        lines = []
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                key = worker + key
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{format_labels(key + (("le", format_value(bound)),))} '
+                                 f'{cumulative}')
+                lines.append(f'{self.name}_sum{format_labels(key)} {format_value(total)}')
+                lines.append(f'{self.name}_count{format_labels(key)} {cumulative}')
+        return lines
+
+
+def counter(name, help_text):
+    return Registry().register(Counter(name, help_text))
+
+
+def gauge(name, help_text, function=None):
+    return Registry().register(Gauge(name, help_text, function))
+
+
+def histogram(name, help_text, buckets=default_buckets):
+    return Registry().register(Histogram(name, help_text, buckets))
+
+
+def render():
+    return Registry().render()
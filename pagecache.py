@@ -0,0 +1,69 @@
+#    ┌────────────────────────────────────────────────────────────────────┐
+#    │                                                                    │
+#    │                             Page Cache                             │
+#    │                                                                    │
+#    │    The home page only changes when the stories or the tag          │
+#    │    scores do, so there's no point running Jinja on every hit.      │
+#    │    Rendered pages are kept here, keyed by the versions they were   │
+#    │    built from, along with a gzipped copy and an ETag so browsers   │
+#    │    can be told "304, you already have it".                         │
+#    │                                                                    │
+#    └────────────────────────────────────────────────────────────────────┘
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+import metrics
+
+cache_requests = metrics.counter('cache_requests_total', 'Cache lookups, by cache and result (hit or miss)')
+
+
+class CachedPage:
+    def __init__(self, html: str):
+        self.body = html.encode('utf-8')
+        self.gzipped = gzip.compress(self.body, compresslevel=6)
+        self.etag = hashlib.sha1(self.body).hexdigest()
+        # A strong ETag names the exact bytes, so the gzipped copy needs its own
+        self.gzip_etag = self.etag + '-gz'
+
+
+class PageCache:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if "pages" not in self.__dict__:
+            self.pages = OrderedDict()
+            self.max_pages = 16
+            self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            page = self.pages.get(key)
+            if page is not None:
+                self.pages.move_to_end(key)
+            return page
+
+    def put(self, key, html: str):
+        page = CachedPage(html)
+        with self.lock:
+            self.pages[key] = page
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+        return page
+
+    # Render only if we don't already have this version of the page
+    def get_or_render(self, key, render):
+        page = self.get(key)
+        if page is None:
+            cache_requests.inc(cache='page', result='miss')
+            page = self.put(key, render())
+        else:
+            cache_requests.inc(cache='page', result='hit')
+        return page
@@ -0,0 +1,113 @@
+#    ┌────────────────────────────────────────────────────────────────────┐
+#    │                                                                    │
+#    │                             Pipeline                               │
+#    │                                                                    │
+#    │    A few stages, each in its own thread, passing work along        │
+#    │    through bounded queues, so a slow stage holds the ones before   │
+#    │    it back instead of letting work pile up in memory, and every    │
+#    │    stage is busy at once.  A refresh uses it so the LLM starts     │
+#    │    tagging the first headlines while the rest of the page is       │
+#    │    still being read, and the database gets a few big writes       │
+#    │    rather than one per story.                                      │
+#    │                                                                    │
+#    │    A stage is a function that takes an iterable (what arrives in   │
+#    │    its inbox) and yields what goes into its outboxes.  If one      │
+#    │    fails, it carries on emptying its inbox so the stages before    │
+#    │    it don't wait forever, and join() raises the error.             │
+#    │                                                                    │
+#    │    The stage threads are kept between runs, so what they set up    │
+#    │    for themselves (a DataModel, with its own connection and copy   │
+#    │    of the stories) is only set up once.                            │
+#    │                                                                    │
+#    └────────────────────────────────────────────────────────────────────┘
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import logs
+from tracing import Profiler
+
+log = logs.get_logger('pipeline')
+
+# Enough for every stage of a refresh, with room to spare
+workers = ThreadPoolExecutor(max_workers=4, thread_name_prefix='pipeline')
+
+# Put in a queue by each producer when it has nothing more to send
+finished = object()
+
+
+#   Everything in `inbox` until all `producers` have finished
+def drain(inbox, producers=1):
+    while producers > 0:
+        item = inbox.get()
+        if item is finished:
+            producers -= 1
+        else:
+            yield item
+
+
+#   Lists of up to `size` items from `inbox`, each sent on as soon as it's full or `wait` seconds
+#   after its first item arrived, whichever comes first.  `size` can be a function of what's waiting.
+def batches(inbox, size, wait, producers=1):
+    pending = []
+    started = None
+    while True:
+        limit = size(pending) if callable(size) else size
+        if pending and (len(pending) >= limit or time.monotonic() - started >= wait):
+            yield pending
+            pending = []
+            continue
+        timeout = None if not pending else max(0.0, wait - (time.monotonic() - started))
+        try:
+            item = inbox.get(timeout=timeout)
+        except queue.Empty:
+            continue
+        if item is finished:
+            producers -= 1
+            if producers == 0:
+                break
+            continue
+        if not pending:
+            started = time.monotonic()
+        pending.append(item)
+    if pending:
+        yield pending
+
+
+class Pipeline:
+    # `profile` is the Profiler handle of the work the pipeline is part of, if that's being profiled
+    def __init__(self, name, queue_size=50, profile=None):
+        self.name = name
+        self.profile = profile
+        self.queue_size = queue_size
+        self.running = []
+        self.errors = []
+
+    def queue(self):
+        return queue.Queue(maxsize=self.queue_size)
+
+    # Run `function(source)` in a worker thread, putting what it yields into each outbox.  The source is
+    # drain() or batches() of the stage's inbox.
+    def stage(self, name, function, source, outboxes=()):
+        def run():
+            profile = Profiler().follow(self.profile)
+            try:
+                for result in function(source):
+                    for outbox in outboxes:
+                        outbox.put(result)
+            except Exception as e:
+                log.exception(f'{self.name} {name} failed: {e}')
+                self.errors.append(e)
+                for _ in source:    # keep the queue moving, so whoever feeds us isn't stuck
+                    pass
+            finally:
+                for outbox in outboxes:
+                    outbox.put(finished)
+                Profiler().stop(profile)
+
+        self.running.append(workers.submit(run))
+
+    def join(self):
+        wait(self.running)
+        if self.errors:
+            raise self.errors[0]
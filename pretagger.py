@@ -0,0 +1,199 @@
+#    ┌────────────────────────────────────────────────────────────────────┐
+#    │                                                                    │
+#    │                             Pre-Tagger                             │
+#    │                                                                    │
+#    │    Most of what the LLM tags a headline with is people, places     │
+#    │    and topics we've already seen.  So before bothering an LLM,     │
+#    │    we look for those ourselves: an Aho-Corasick matcher runs       │
+#    │    over the headline looking for every known tag and place name    │
+#    │    in a single pass.  Anything left over that looks important      │
+#    │    gets picked up by a TF-IDF keyword score.                       │
+#    │                                                                    │
+#    │    If we found the names in the headline and at least a couple     │
+#    │    of tags, we're confident enough to skip the LLM.  Otherwise,    │
+#    │    it goes to the LLM like before.                                 │
+#    │                                                                    │
+#    │    Set PRETAG_CONFIDENCE above 1 to send everything to the LLM.    │
+#    │                                                                    │
+#    └────────────────────────────────────────────────────────────────────┘
+import math
+import os
+import re
+from collections import Counter, deque
+
+import canonical
+
+stopwords = frozenset("""
+a about above after again against all am an and any are as at be because been before being below between both
+but by can could did do does doing down during each few for from further had has have having he her here hers
+herself him himself his how i if in into is it its itself just me more most my myself no nor not now of off on
+once only or other our ours out over own same she should so some such than that the their theirs them then there
+these they this those through to too under until up very was we were what when where which while who whom why
+will with would you your new says said say could may might must one two first last year years day days week
+""".split())
+
+geography = (
+    # Countries
+    "afghanistan", "albania", "algeria", "argentina", "armenia", "australia", "austria", "azerbaijan", "bahrain",
+    "bangladesh", "belarus", "belgium", "bolivia", "bosnia", "brazil", "bulgaria", "cambodia", "cameroon", "canada",
+    "chile", "china", "colombia", "congo", "costa rica", "croatia", "cuba", "cyprus", "czech republic", "denmark",
+    "ecuador", "egypt", "el salvador", "estonia", "ethiopia", "finland", "france", "gaza", "georgia", "germany",
+    "ghana", "greece", "greenland", "guatemala", "haiti", "honduras", "hungary", "iceland", "india", "indonesia",
+    "iran", "iraq", "ireland", "israel", "italy", "jamaica", "japan", "jordan", "kazakhstan", "kenya", "kosovo",
+    "kuwait", "latvia", "lebanon", "libya", "lithuania", "luxembourg", "madagascar", "malaysia", "mali", "mexico",
+    "moldova", "mongolia", "morocco", "mozambique", "myanmar", "nepal", "netherlands", "new zealand", "nicaragua",
+    "niger", "nigeria", "north korea", "norway", "oman", "pakistan", "palestine", "panama", "paraguay", "peru",
+    "philippines", "poland", "portugal", "qatar", "romania", "russia", "rwanda", "saudi arabia", "senegal",
+    "serbia", "singapore", "slovakia", "slovenia", "somalia", "south africa", "south korea", "spain", "sri lanka",
+    "sudan", "sweden", "switzerland", "syria", "taiwan", "tanzania", "thailand", "tunisia", "turkey", "uganda",
+    "ukraine", "united arab emirates", "united kingdom", "uk", "united states", "usa", "uruguay", "venezuela",
+    "vietnam", "west bank", "yemen", "zambia", "zimbabwe",
+    # US states
+    "alabama", "alaska", "arizona", "arkansas", "california", "colorado", "connecticut", "delaware", "florida",
+    "hawaii", "idaho", "illinois", "indiana", "iowa", "kansas", "kentucky", "louisiana", "maine", "maryland",
+    "massachusetts", "michigan", "minnesota", "mississippi", "missouri", "montana", "nebraska", "nevada",
+    "new hampshire", "new jersey", "new mexico", "new york", "north carolina", "north dakota", "ohio", "oklahoma",
+    "oregon", "pennsylvania", "rhode island", "south carolina", "south dakota", "tennessee", "texas", "utah",
+    "vermont", "virginia", "washington", "west virginia", "wisconsin", "wyoming",
+    # Cities and regions that show up a lot in the news
+    "atlanta", "baltimore", "beijing", "berlin", "boston", "brussels", "chicago", "dallas", "detroit", "dubai",
+    "hong kong", "houston", "istanbul", "jerusalem", "kyiv", "las vegas", "london", "los angeles", "miami",
+    "moscow", "new orleans", "paris", "philadelphia", "phoenix", "rome", "san francisco", "seattle", "seoul",
+    "tel aviv", "tokyo", "toronto", "europe", "africa", "asia", "middle east", "latin america",
+)
+
+token_pattern = re.compile(r"[\w'-]+")
+
+# Aliases that are also everyday words ("tell us"), so they only count when written in capitals ("US")
+capitals_only = frozenset(('us', 'u.s', 'u.s.', 'uk', 'u.k', 'u.k.'))
+
+
+#    ┌──────────────────────────────────────────────────────────┐
+#    │    Aho-Corasick: a trie of all the phrases, with         │
+#    │    "failure" links so that one left-to-right walk        │
+#    │    over the text finds every phrase, however many        │
+#    │    thousands of them there are.                          │
+#    └──────────────────────────────────────────────────────────┘
+class Matcher:
+    def __init__(self, phrases):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+        for phrase in phrases:
+            state = 0
+            for ch in phrase:
+                if ch not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][ch] = len(self.goto) - 1
+                state = self.goto[state][ch]
+            self.output[state].append(phrase)
+
+        # Breadth-first, so every node's failure link points at something already finished
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, child in self.goto[state].items():
+                queue.append(child)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[child] = self.goto[f].get(ch, 0) if state != 0 else 0
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    # Yields (start, end, phrase) for every match that starts and ends on a word boundary
+    def find(self, text):
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(ch, 0)
+            for phrase in self.output[state]:
+                start = i - len(phrase) + 1
+                end = i + 1
+                if (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum()):
+                    yield start, end, phrase
+
+
+class Pretagger:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if "matcher" not in self.__dict__:
+            self.threshold = float(os.getenv('PRETAG_CONFIDENCE', '0.75'))
+            self.max_tags = 5
+            self.min_matches = 2
+            self.vocabulary = frozenset()
+            self.matcher = Matcher(geography)
+            self.document_count = 0
+            self.document_frequency = Counter()
+
+    # Bring the vocabulary and word statistics up to date.  The matcher is only rebuilt if the vocabulary changed.
+    def refresh(self, known_tags, headlines):
+        vocabulary = frozenset(tag for tag in (t.lower().strip() for t in known_tags)
+                               if len(tag) > 2 and tag not in stopwords)
+        if vocabulary != self.vocabulary:
+            self.vocabulary = vocabulary
+            # Look for the aliases too, so "U.K." in a headline finds the "united kingdom" tag
+            aliases = set(canonical.aliases).union(canonical.custom_aliases)
+            self.matcher = Matcher(sorted(vocabulary.union(geography, aliases)))
+
+        self.document_count = len(headlines)
+        self.document_frequency = Counter()
+        for headline in headlines:
+            self.document_frequency.update(set(token_pattern.findall(headline.lower())))
+
+    def keywords(self, tokens, skip):
+        scores = {}
+        counts = Counter(tokens)
+        for token, count in counts.items():
+            if token in stopwords or token in skip or len(token) < 4 or token.isdigit():
+                continue
+            idf = math.log((1 + self.document_count) / (1 + self.document_frequency[token])) + 1
+            scores[token] = count * idf
+        return sorted(scores, key=lambda t: scores[t], reverse=True)
+
+    # Returns (tags, confidence), where confidence runs from 0 to 1
+    def tag(self, headline):
+        text = headline.lower()
+
+        # Prefer the longest match where matches overlap ("new york" over "york")
+        matches = sorted(self.matcher.find(text), key=lambda m: (m[0], -(m[1] - m[0])))
+        tags = []
+        covered = set()
+        last_end = -1
+        for start, end, phrase in matches:
+            if start < last_end:
+                continue
+            # Lowercasing can change the length of some (rare) letters, and then the positions don't line up
+            if phrase in capitals_only and (len(text) != len(headline) or not headline[start:end].isupper()):
+                continue
+            last_end = end
+            covered.update(token_pattern.findall(phrase))
+            phrase = canonical.canonicalize(phrase)
+            if phrase not in tags:
+                tags.append(phrase)
+
+        # The LLM's most important tags are people and places, which are the capitalized words
+        # (other than the first one, which is capitalized anyway).  Did we find them all?  A headline
+        # with none (and CNN's are in sentence case) tells us nothing either way, so it only gets half.
+        words = token_pattern.findall(headline)
+        proper = [w.lower() for w in words[1:] if w[0].isupper() and w.lower() not in stopwords]
+        proper_coverage = 0.5 if not proper else sum(w in covered for w in proper) / len(proper)
+
+        confidence = 0.5 * min(1.0, len(tags) / self.min_matches) + 0.5 * proper_coverage
+        # Whatever the names look like, too few real matches (the keyword below doesn't count) is a job for the LLM
+        if len(tags) < self.min_matches:
+            confidence = min(confidence, 0.5)
+
+        if len(tags) < self.max_tags:
+            tags.extend(self.keywords(token_pattern.findall(text), covered)[:1])
+
+        return tags[:self.max_tags], confidence
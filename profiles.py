@@ -0,0 +1,119 @@
+#    ┌────────────────────────────────────────────────────────────────────┐
+#    │                                                                    │
+#    │                          Reader Profiles                           │
+#    │                                                                    │
+#    │    One deployment, many readers.  The stories and their tags are   │
+#    │    shared by everybody; all that's kept per reader is a sparse     │
+#    │    vector of tag id -> score (just the tags they've liked or       │
+#    │    disliked) and the stories they've read.  Ranking for a          │
+#    │    reader is a dot product of their vector with each story's       │
+#    │    tag ids.                                                        │
+#    │                                                                    │
+#    │    A reader who hasn't picked a name gets the default profile,     │
+#    │    which is the scores in the tags table, same as always.          │
+#    │                                                                    │
+#    └────────────────────────────────────────────────────────────────────┘
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import canonical
+import datamodel
+from tags import Tags
+from tracing import traced
+
+user_id_pattern = re.compile(r'^[a-z0-9][a-z0-9_.-]{0,39}$')
+
+
+#   The user id for a name typed in by a reader, or None if it won't do
+def user_id_for(name):
+    name = (name or '').strip().lower()
+    return name if user_id_pattern.match(name) else None
+
+
+class Profile:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.version = None
+        self.scores = {}        # tag id -> {'score', 'count', 'updated'}, same shape as a tag
+        self.read = set()       # story ids
+        self.lock = threading.Lock()
+        self.load()
+
+    @traced
+    def load(self):
+        d = datamodel.DataModel()
+        self.version = d.get_version(f'profile_{self.user_id}')
+        self.scores = d.fetch_profile(self.user_id)
+        self.read = d.fetch_profile_reads(self.user_id)
+
+    # This reader may have been busy in another worker process
+    def refresh(self):
+        d = datamodel.DataModel()
+        if d.get_version(f'profile_{self.user_id}') != self.version:
+            with self.lock:
+                self.load()
+
+    # Same arithmetic as the default profile in Tags, decay included
+    def like_or_dislike_tags(self, tags, like: int):
+        tag_hist = Tags()
+        now = time.time()
+        changed = {}
+        with self.lock:
+            for tag in canonical.canonicalize_all(tags):
+                tag_id = tag_hist.get_tag_id(tag)
+                if tag_id is None:
+                    tag_hist.add_tag(tag)
+                    tag_id = tag_hist.get_tag_id(tag)
+                entry = self.scores.get(tag_id, {'score': 0, 'count': 0, 'updated': now})
+                self.scores[tag_id] = changed[tag_id] = tag_hist.rescore(entry, like, now)
+        if changed:
+            datamodel.DataModel().upsert_profile_tags(self.user_id, changed)
+
+    def like_tags(self, tags):
+        self.like_or_dislike_tags(tags, 1)
+
+    def dislike_tags(self, tags):
+        self.like_or_dislike_tags(tags, -1)
+
+    def mark_read(self, story_id):
+        with self.lock:
+            self.read.add(int(story_id))
+        datamodel.DataModel().mark_story_as_read_by(self.user_id, story_id)
+
+    # tag id -> score as of now, for ranking
+    def weights(self, now=None):
+        tag_hist = Tags()
+        now = now or time.time()
+        with self.lock:
+            return {tag_id: tag_hist.effective_score(entry, now) for tag_id, entry in self.scores.items()}
+
+
+class Profiles:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if "profiles" not in self.__dict__:
+            self.profiles = OrderedDict()
+            self.lock = threading.Lock()
+            self.max_profiles = 500     # readers kept in memory; the rest are reloaded when they come back
+
+    def get(self, user_id):
+        with self.lock:
+            profile = self.profiles.get(user_id)
+            if profile is not None:
+                self.profiles.move_to_end(user_id)
+        if profile is None:
+            profile = Profile(user_id)
+            with self.lock:
+                profile = self.profiles.setdefault(user_id, profile)
+                while len(self.profiles) > self.max_profiles:
+                    self.profiles.popitem(last=False)
+        profile.refresh()
+        return profile
@@ -0,0 +1,96 @@
+#    ┌────────────────────────────────────────────────────────────────────┐
+#    │                                                                    │
+#    │                              Records                               │
+#    │                                                                    │
+#    │    Stories and tags as they come out of the database.  They use    │
+#    │    __slots__, so each one is a fraction of the size of a dict,     │
+#    │    and they can't be changed once made: to change one, make a      │
+#    │    new one with replace().  That way the same story can be         │
+#    │    shared by every request and every reader's ranking without      │
+#    │    anybody scribbling on it.                                       │
+#    │                                                                    │
+#    │    They still answer to story['headline'] as well as               │
+#    │    story.headline, so code (and templates) that treated them as    │
+#    │    dicts keep working for reading.                                 │
+#    │                                                                    │
+#    └────────────────────────────────────────────────────────────────────┘
+
+
+class Record:
+    __slots__ = ()
+
+    def __init__(self, *values, **fields):
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+        for name in self.__slots__[len(values):]:
+            object.__setattr__(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError(f'{type(self).__name__} has no field {next(iter(fields))}')
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} records can\'t be changed; use replace()')
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    # Like a dict, a field that was never given (None) isn't "in" the record
+    def __contains__(self, name):
+        return getattr(self, name, None) is not None
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    # A copy with some fields changed
+    def replace(self, **changes):
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        return type(self)(**values)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{type(self).__name__}({fields})'
+
+
+class Story(Record):
+    # tags is a tuple of interned strings
+    __slots__ = ('id', 'headline', 'url', 'read', 'date', 'tags')
+
+
+class Tag(Record):
+    __slots__ = ('text', 'score', 'count', 'id', 'updated', 'seen')
+
+
+#   A story as one reader's ranking sees it: the shared story plus a score, and the
+#   ranking version at which it last appeared or moved
+class RankedStory(Record):
+    __slots__ = ('story', 'score', 'changed')
+
+    @property
+    def id(self):
+        return self.story.id
+
+    @property
+    def headline(self):
+        return self.story.headline
+
+    @property
+    def url(self):
+        return self.story.url
+
+    @property
+    def tags(self):
+        return self.story.tags
+
+    @property
+    def read(self):
+        return self.story.read
+
+    def as_dict(self):
+        return {'id': self.story.id, 'headline': self.story.headline, 'url': self.story.url,
+                'tags': list(self.story.tags), 'score': self.score, 'changed': self.changed}
@@ -0,0 +1,119 @@
+#    ┌────────────────────────────────────────────────────────────────────┐
+#    │                                                                    │
+#    │                        Refresh Scheduler                           │
+#    │                                                                    │
+#    │    How often to go back to CNN.  A fixed five minutes is too       │
+#    │    often at 3am, when nothing changes, and not often enough when   │
+#    │    a big story is breaking.  So the scheduler watches how many     │
+#    │    new headlines each fetch turns up, keeps a running rate         │
+#    │    (overall, and for each hour of the day), and waits about as     │
+#    │    long as it takes for target_new headlines to appear, within     │
+#    │    REFRESH_MIN_SECONDS and REFRESH_MAX_SECONDS.  The rate jumps    │
+#    │    up as soon as news picks up and drifts down slowly after.       │
+#    │                                                                    │
+#    │    If a fetch fails, the wait doubles each time (with a random     │
+#    │    wobble, so a fleet of readers doesn't all come back at once)    │
+#    │    until a fetch works again.                                      │
+#    │                                                                    │
+#    │    What it has learned is kept in the database, so a restart (or   │
+#    │    another worker taking over) doesn't start from scratch.         │
+#    │                                                                    │
+#    └────────────────────────────────────────────────────────────────────┘
+import os
+import random
+import threading
+import time
+
+import datamodel
+import logs
+import metrics
+
+log = logs.get_logger('scheduler')
+
+interval_gauge = metrics.gauge('refresh_interval_seconds', 'Seconds until the next look at CNN')
+fetch_errors = metrics.counter('refresh_errors_total', 'Failed fetches from CNN')
+
+
+class RefreshScheduler:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if "interval" not in self.__dict__:
+            self.min_interval = float(os.getenv('REFRESH_MIN_SECONDS', '120'))
+            self.max_interval = max(float(os.getenv('REFRESH_MAX_SECONDS', '1800')), self.min_interval)
+            self.target_new = 3         # new headlines worth a trip to CNN
+            self.decay = 0.2            # how quickly a quieter rate is believed (a busier one is believed at once)
+            self.interval = min(max(300.0, self.min_interval), self.max_interval)
+            self.rate = None            # new headlines per second, all day
+            self.hourly = [None] * 24   # ... and for each hour of the day
+            self.last_fetch = None
+            self.failures = 0
+            self.lock = threading.Lock()
+            self.load()
+
+    def load(self):
+        state = datamodel.DataModel().get_state('refresh_schedule')
+        if state:
+            self.rate = state.get('rate')
+            self.hourly = state.get('hourly', self.hourly)
+            self.last_fetch = state.get('last_fetch')
+            self.interval = self.clamp(state.get('interval', self.interval))
+
+    def save(self):
+        datamodel.DataModel().put_state('refresh_schedule', {'rate': self.rate, 'hourly': self.hourly,
+                                                             'last_fetch': self.last_fetch,
+                                                             'interval': self.interval})
+
+    def clamp(self, interval):
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    # Fast attack, slow decay: a burst of news shows at once, a lull takes a few fetches to believe
+    def blend(self, old, observed):
+        if old is None or observed >= old:
+            return observed
+        return old + self.decay * (observed - old)
+
+    # A fetch worked and found `new_count` new headlines.  Returns how long to wait before the next one.
+    def record(self, new_count, now=None):
+        now = now or time.time()
+        with self.lock:
+            self.failures = 0
+            elapsed = None if self.last_fetch is None else now - self.last_fetch
+            # Only learn from sensible gaps: not the first fetch after a long shutdown, say
+            if elapsed is not None and self.min_interval / 2 <= elapsed <= self.max_interval * 4:
+                observed = new_count / elapsed
+                self.rate = self.blend(self.rate, observed)
+                hour = time.localtime(now).tm_hour
+                self.hourly[hour] = self.blend(self.hourly[hour], observed)
+            self.last_fetch = now
+            self.interval = self.plan(now)
+            log.info(f'{new_count} new headlines; next look at CNN in {self.interval:.0f}s')
+            interval_gauge.set(self.interval)
+        self.save()
+        return self.interval
+
+    # A fetch failed: back off, doubling each time, with jitter
+    def record_error(self):
+        with self.lock:
+            self.failures += 1
+            backoff = self.min_interval * 2 ** min(self.failures - 1, 10)
+            self.interval = self.clamp(backoff * random.uniform(0.5, 1.5))
+            fetch_errors.inc()
+            log.warning(f'Fetch failed {self.failures} time(s) running; trying again in {self.interval:.0f}s')
+            interval_gauge.set(self.interval)
+        return self.interval
+
+    # Long enough to expect target_new headlines, going by the rate now and the usual rate for the coming hour
+    def plan(self, now):
+        if self.rate is None:
+            return self.interval
+        upcoming = self.hourly[time.localtime(now + self.interval).tm_hour]
+        rate = self.rate if upcoming is None else (self.rate + upcoming) / 2
+        if rate <= 0:
+            return self.max_interval
+        return self.clamp(self.target_new / rate)
@@ -0,0 +1,55 @@
+#    ┌────────────────────────────────────────────────────────────────────┐
+#    │                                                                    │
+#    │                              Snapshot                              │
+#    │                                                                    │
+#    │    At the end of each refresh, the ranked feed (each story with    │
+#    │    its score) is saved to a small gzipped JSON file.  On the next  │
+#    │    launch, the home page is served straight from it while the      │
+#    │    llamas catch up in the background, instead of making the        │
+#    │    reader wait for a full fetch and tagging run.                   │
+#    │                                                                    │
+#    │    This module is deliberately light: no Flask, no                 │
+#    │    BeautifulSoup, no LLM code, so loading it costs next to         │
+#    │    nothing.                                                        │
+#    │                                                                    │
+#    └────────────────────────────────────────────────────────────────────┘
+import gzip
+import json
+import os
+import threading
+import time
+
+snapshot_file = os.path.join('temp', 'snapshot.json.gz')
+
+_lock = threading.Lock()
+_loaded = None
+
+
+def save(stories):
+    data = {
+        'saved': time.time(),
+        'stories': [{'id': s['id'], 'headline': s['headline'], 'url': s['url'], 'tags': s['tags'],
+                     'score': s['score']} for s in stories]
+    }
+
+    if not os.path.exists(os.path.dirname(snapshot_file)):
+        os.mkdir(os.path.dirname(snapshot_file))
+
+    # Write to the side and swap it in, so a crash never leaves half a snapshot behind
+    temp_file = f'{snapshot_file}.{os.getpid()}.tmp'
+    with gzip.open(temp_file, 'wt', encoding='utf-8', compresslevel=6) as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(temp_file, snapshot_file)
+
+
+# Returns the saved snapshot, or None if there isn't a usable one.  It's only read once per process.
+def load():
+    global _loaded
+    with _lock:
+        if _loaded is None:
+            try:
+                with gzip.open(snapshot_file, 'rt', encoding='utf-8') as f:
+                    _loaded = json.load(f)
+            except (OSError, ValueError):
+                _loaded = False
+        return _loaded or None
@@ -1,25 +1,94 @@
-function likeStory(storyId) {
+// Likes and dislikes are queued up and sent to /api/feedback in batches, so going through
+// the page quickly costs a few requests rather than one per click.  Only the last vote for
+// a story counts, and the batch goes out once the clicking stops (or the page is left).
+const feedback = {
+    queue: new Map(),       // story id -> event, so a second click on the same story replaces the first
+    timer: null,
+    idleDelay: 2000,
+    maxQueued: 20,
+};
 
-    fetch(`/api/like?id=${storyId}`)
-        .then(response => response.json())
-        .then(data => {
-            if (data.status === "success") {
-                // Optionally, update UI
-            }
-        });
+function newEventId() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return Date.now().toString(36) + Math.random().toString(36).slice(2);
 }
 
-function dislikeStory(storyId) {
+function queueFeedback(storyId, kind) {
+    feedback.queue.set(storyId, {id: newEventId(), kind: kind, story: storyId, at: Date.now()});
+    clearTimeout(feedback.timer);
+    if (feedback.queue.size >= feedback.maxQueued) {
+        flushFeedback();
+    } else {
+        feedback.timer = setTimeout(flushFeedback, feedback.idleDelay);
+    }
+}
 
-    fetch(`/api/dislike?id=${storyId}`)
-        .then(response => response.json())
-        .then(data => {
-            if (data.status === "success") {
-                event.target.closest('.list-group-item').remove();
+function flushFeedback() {
+    clearTimeout(feedback.timer);
+    if (feedback.queue.size === 0) {
+        return;
+    }
+    const events = Array.from(feedback.queue.values());
+    feedback.queue.clear();
+
+    fetch('/api/feedback', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({events: events}),
+    })
+        .then(response => {
+            // A 4xx will be refused just the same next time, so only a server error is worth retrying
+            if (response.status >= 500) {
+                throw new Error(response.statusText);
+            }
+            if (!response.ok) {
+                console.warn(`Feedback was refused (${response.status}); dropping ${events.length} events`);
             }
+        })
+        .catch(() => {
+            // The network or the server let us down: put them back (unless newer votes came in) and try
+            // again later.  The ids stay the same, so if the first try did get through the server won't
+            // count them twice.
+            events.forEach(event => {
+                if (!feedback.queue.has(event.story)) {
+                    feedback.queue.set(event.story, event);
+                }
+            });
+            feedback.timer = setTimeout(flushFeedback, feedback.idleDelay * 5);
         });
 }
 
+// A fetch may not finish once the page goes away, but a beacon will
+function sendFeedbackBeacon() {
+    if (feedback.queue.size === 0 || !navigator.sendBeacon) {
+        return;
+    }
+    const body = new Blob([JSON.stringify({events: Array.from(feedback.queue.values())})],
+        {type: 'application/json'});
+    if (navigator.sendBeacon('/api/feedback', body)) {
+        feedback.queue.clear();
+        clearTimeout(feedback.timer);
+    }
+}
+
+document.addEventListener('visibilitychange', () => {
+    if (document.visibilityState === 'hidden') {
+        sendFeedbackBeacon();
+    }
+});
+window.addEventListener('pagehide', sendFeedbackBeacon);
+
+function likeStory(storyId) {
+    queueFeedback(storyId, 'like');
+}
+
+function dislikeStory(storyId) {
+    queueFeedback(storyId, 'dislike');
+    event.target.closest('.list-group-item').remove();
+}
+
 function selectTag(tagId) {
     fetch(`/api/tagselect?id=${tagId}`)
         .then(response => response.json())
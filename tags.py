@@ -4,9 +4,26 @@
 #    │    This manages the tags which are used in conjunction with the    │
 #    │    stories.  We CRUD 'em, we like 'em, we dislike 'em.             │
 #    │                                                                    │
+#    │    Tastes change, so likes and dislikes fade: a score loses half   │
+#    │    its strength every TAG_HALF_LIFE_DAYS.  Nothing is rewritten    │
+#    │    as time passes; the fading is worked out whenever a score is    │
+#    │    read, from when the tag was last liked or disliked.             │
+#    │                                                                    │
+#    │    Once a day the tags are compacted: anything whose score has     │
+#    │    faded to nothing and that no story has carried in a long time   │
+#    │    is forgotten, and the vocabulary is capped at max_vocabulary.   │
+#    │                                                                    │
 #    └────────────────────────────────────────────────────────────────────┘
+import os
+import threading
+import time
 
+import canonical
 import datamodel
+import logs
+from tracing import traced
+
+log = logs.get_logger('tags')
 
 
 class Tags:
@@ -19,50 +36,102 @@ class Tags:
 
     def __init__(self):
         if "tags" not in self.__dict__:
-            self.tags = {}
+            self.tags = []
+            self.index = {}         # tag text -> tag
+            self.ids = {}           # tag id -> tag
+            self.positions = {}     # tag text -> where it is in self.tags
+            self.lock = threading.RLock()       # requests like and dislike at the same time
+            self.version = None
+            self.half_life = float(os.getenv('TAG_HALF_LIFE_DAYS', '30')) * 86400
+            self.compact_interval = 86400
+            self.unused_time = 30 * 86400       # how long since a story carried a tag before it can go
+            self.min_weight = 0.05              # opinions weaker than this have faded away
+            self.max_vocabulary = 5000
             self.read_tags()
 
+    @traced
     def read_tags(self):
         d = datamodel.DataModel()
-        d.fetch_all_tags()
-        self.tags = d.get_tags()
+        with self.lock:
+            self.version = d.get_version('tags')
+            d.fetch_all_tags()
+            tags = d.get_tags()
+            self.tags = tags
+            self.index = {tag["text"]: tag for tag in tags}
+            self.ids = {tag["id"]: tag for tag in tags}
+            self.positions = {tag["text"]: position for position, tag in enumerate(tags)}
+
+    # Other processes may have liked or disliked things since we last looked
+    def refresh(self):
+        d = datamodel.DataModel()
+        if d.get_version('tags') != self.version:
+            self.read_tags()
 
     def write_tags(self):
         d = datamodel.DataModel()
         d.upsert_tags(self.tags)
 
     def get_tag(self, tag):
-        tag = tag.lower()
-        # Yeah, yeah, yeah, I know this is O(n) and could be O(1) with a dict
-        # Improving it is an exercise left for the reader
-        for known_tag in self.tags:
-            if known_tag["text"] == tag:
-                return known_tag
+        return self.index.get(canonical.canonicalize(tag))
 
-        return None
+    # The interned integer id for a tag, or None if we've never seen it
+    def get_tag_id(self, tag):
+        full_tag = self.get_tag(tag)
+        return None if full_tag is None else full_tag["id"]
 
     def add_tag(self, tag: str):
         d = datamodel.DataModel()
-        tag = tag.lower()
-        if self.get_tag(tag) is None:
-            d.upsert_tag({"text": tag, "score": 0, "count": 0})
-            self.read_tags()
+        tag = canonical.canonicalize(tag)
+        with self.lock:
+            if self.get_tag(tag) is None:
+                d.upsert_tag({"text": tag, "score": 0, "count": 0})
+                self.read_tags()
+
+    # How much of a tag's score is left, given how long ago it was last liked or disliked
+    def decay(self, tag, now=None):
+        if not tag.get("updated") or self.half_life <= 0:
+            return 1.0
+        age = max(0.0, (now or time.time()) - tag["updated"])
+        return 0.5 ** (age / self.half_life)
+
+    # The score as of now, which is what ranking should use
+    def effective_score(self, tag, now=None):
+        return tag["score"] * self.decay(tag, now)
+
+    # tag id -> score as of now, for ranking
+    def weights(self, now=None):
+        now = now or time.time()
+        return {tag["id"]: self.effective_score(tag, now) for tag in self.tags}
+
+    # The new score, count and updated time after one more like (1) or dislike (-1).  Old opinions count
+    # for less: their weight is faded before the new one is averaged in.
+    def rescore(self, entry, like, now=None):
+        now = now or time.time()
+        weight = entry["count"] * self.decay(entry, now)
+        return {"score": (like + entry["score"] * weight) / (weight + 1), "count": weight + 1, "updated": now}
 
     def like_or_dislike_tag(self, tag: str, like: int):
         d = datamodel.DataModel()
-        tag = tag.lower()
-        full_tag = self.get_tag(tag)
-        if full_tag is None:
-            self.add_tag(tag)
+        tag = canonical.canonicalize(tag)
+        # Another request may be rescoring the same tag, so read, rescore and swap in one go
+        with self.lock:
             full_tag = self.get_tag(tag)
-        full_tag["score"] = (like + full_tag["score"] * full_tag["count"]) / (full_tag["count"] + 1)
-        full_tag["count"] += 1
-        d.upsert_tag(full_tag)
+            if full_tag is None:
+                self.add_tag(tag)
+                full_tag = self.get_tag(tag)
+            new_tag = full_tag.replace(**self.rescore(full_tag, like))
+            d.upsert_tag(new_tag)
+            # Tag records can't be changed, so swap in the new one
+            self.tags[self.positions[tag]] = new_tag
+            self.index[tag] = new_tag
+            self.ids[new_tag["id"]] = new_tag
 
+    @traced
     def like_tags(self, tags):
         for tag in tags:
             self.like_or_dislike_tag(tag, 1)
 
+    @traced
     def dislike_tags(self, tags):
         for tag in tags:
             self.like_or_dislike_tag(tag, -1)
@@ -70,9 +139,54 @@ class Tags:
     def get_score(self, tag):
         if type(tag) is dict:
             tag = tag["text"]
-        tag = tag.lower()
+        tag = canonical.canonicalize(tag)
         full_tag = self.get_tag(tag)
         if full_tag is None:
             self.add_tag(tag)
             full_tag = self.get_tag(tag)
-        return full_tag["score"]
+        return self.effective_score(full_tag)
+
+    # These tags were just put on stories; remember that they're still in use
+    def touch_tags(self, tags):
+        d = datamodel.DataModel()
+        d.touch_tags(canonical.canonicalize_all(tags))
+        self.refresh()
+
+    #    ┌──────────────────────────────────────────────────────────┐
+    #    │                        Compaction                        │
+    #    └──────────────────────────────────────────────────────────┘
+
+    # Only one process does this, at most once a day
+    def compact_if_due(self):
+        d = datamodel.DataModel()
+        if d.claim_job('tags_compaction', self.compact_interval):
+            self.compact()
+
+    @traced
+    def compact(self):
+        d = datamodel.DataModel()
+        # Picks up any aliases added since the last start
+        d.migrate_canonical_tags()
+        self.refresh()
+
+        now = time.time()
+        stale = []
+        keep = []
+        for tag in self.tags:
+            weight = tag["count"] * self.decay(tag, now)
+            unused = now - (tag.get("seen") or now) > self.unused_time
+            if unused and weight < self.min_weight:
+                stale.append(tag["text"])
+            else:
+                keep.append((weight, tag.get("seen") or now, tag["text"]))
+
+        # Still too many?  Let the weakest, longest unseen ones go
+        if len(keep) > self.max_vocabulary:
+            keep.sort(reverse=True)
+            stale.extend(text for _, _, text in keep[self.max_vocabulary:])
+
+        # Tags on a story we still have are never removed, whatever their score
+        removed = d.delete_stale_tags(stale) if stale else 0
+        log.info(f'Compacted tags: {removed} removed, {len(self.tags) - removed} left')
+        self.refresh()
+        return removed
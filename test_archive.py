@@ -0,0 +1,63 @@
+#   python -m pytest test_archive.py
+import datetime
+
+import pytest
+
+import archive
+from records import Story
+
+day = 86400 * 20000
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(archive.Archive, '_instance', None)
+    return archive.Archive()
+
+
+def make_story(story_id, date, tags=('economy',)):
+    return {'id': story_id, 'date': date, 'read': 0, 'headline': f'Story {story_id}',
+            'url': f'https://example.com/{story_id}', 'tags': list(tags)}
+
+
+def test_compact_folds_a_day_into_one_segment(store):
+    for i in range(4):
+        store.append([make_story(i, day + i * 1000)])
+    store.append([make_story(9, day + 86400 * 3)])
+
+    assert store.compact(now=day + 86400 * 3 + 60) == 4
+    assert len(store.segment_paths()) == 2
+    assert sorted(story['id'] for story in store.stories()) == [0, 1, 2, 3, 9]
+
+
+def test_interrupted_compaction_counts_once(store):
+    for i in range(3):
+        store.append([make_story(i, day + i * 1000)])
+    paths = store.segment_paths()
+    # The merged segment was written, then the process died before removing the old ones
+    store.append([story for path in paths for story in archive.Segment(path).stories()], replaces=paths)
+
+    assert store.tag_trends(['economy'], days=100000, bucket_days=100000) == {'economy': [[0, 3]]}
+    store.compact(now=day + 86400 * 3)
+    assert len(store.segment_paths()) == 1
+    assert sorted(story['id'] for story in store.stories()) == [0, 1, 2]
+
+
+def test_failed_archive_releases_the_write_lock(database, monkeypatch):
+    database.upsert_story(Story(None, 'Old news', 'https://example.com/old', 0, None, ('economy',)))
+    old = datetime.datetime.now() - datetime.timedelta(days=3)
+    database.cur.execute("UPDATE stories SET date = ?", (old,))
+    database.conn.commit()
+
+    def fail(self, stories):
+        raise ValueError('odd date')
+    monkeypatch.setattr(archive.Archive, 'append', fail)
+    database.delete_old_stories()
+
+    # Still there, and the next write transaction can start
+    assert not database.conn.in_transaction
+    database.cur.execute("SELECT COUNT(*) FROM stories")
+    assert database.cur.fetchone()[0] == 1
+    database.cur.execute("BEGIN IMMEDIATE")
+    database.conn.rollback()
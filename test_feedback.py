@@ -0,0 +1,29 @@
+#   python -m pytest test_feedback.py
+from records import Story
+from tags import Tags
+
+
+def test_same_batch_twice_is_applied_once(database):
+    story_id = database.upsert_story(Story(None, 'Markets rally', 'https://example.com/1', 0, None, ('economy',)))
+    events = [{'id': 'a1', 'kind': 'like', 'story': story_id, 'at': 1.0},
+              {'id': 'a1', 'kind': 'like', 'story': story_id, 'at': 1.0},      # repeated within the batch
+              {'id': 'a2', 'kind': 'read', 'story': story_id, 'at': 2.0}]
+
+    assert database.apply_feedback(None, events, Tags().rescore) == 2
+    database.fetch_all_tags()
+    once = database.get_tag('economy')
+    assert once['count'] == 1 and once['score'] == 1
+
+    # The browser didn't hear back and sends it all again
+    assert database.apply_feedback(None, events, Tags().rescore) == 0
+    database.fetch_all_tags()
+    assert database.get_tag('economy').as_dict() == once.as_dict()
+
+
+def test_named_reader_has_own_events(database):
+    story_id = database.upsert_story(Story(None, 'Markets rally', 'https://example.com/1', 0, None, ('economy',)))
+    events = [{'id': 'b1', 'kind': 'dislike', 'story': story_id, 'at': 1.0}]
+    assert database.apply_feedback('alice', events, Tags().rescore) == 1
+    assert database.apply_feedback('alice', events, Tags().rescore) == 0
+    # The same event id from another reader is a different event
+    assert database.apply_feedback('bob', events, Tags().rescore) == 1
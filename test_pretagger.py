@@ -0,0 +1,41 @@
+#   python -m pytest test_pretagger.py
+import pytest
+
+from pretagger import Pretagger
+
+
+@pytest.fixture
+def pretagger():
+    pretagger = Pretagger()
+    pretagger.refresh(['biden', 'debate', 'economy', 'election'], [])
+    return pretagger
+
+
+def test_pronoun_us_is_not_a_country(pretagger):
+    tags, confidence = pretagger.tag('Tell us what you think of the debate')
+    assert 'usa' not in tags
+    assert confidence < pretagger.threshold
+
+
+def test_capitalized_us_is_a_country(pretagger):
+    tags, _ = pretagger.tag('US economy grows faster than expected')
+    assert tags[:2] == ['usa', 'economy']
+
+
+def test_sentence_case_is_not_full_coverage(pretagger):
+    # One match and one keyword used to clear the threshold
+    tags, confidence = pretagger.tag('What the economy means for your retirement savings')
+    assert 'economy' in tags
+    assert confidence < pretagger.threshold
+
+
+def test_needs_min_matches(pretagger):
+    # Every name is found, but one match isn't enough to skip the LLM
+    _, confidence = pretagger.tag('Why Ohio matters more than ever')
+    assert confidence < pretagger.threshold
+
+
+def test_enough_matches_skip_the_llm(pretagger):
+    tags, confidence = pretagger.tag('Biden talks economy in Ohio ahead of the election')
+    assert {'biden', 'economy', 'ohio', 'election'} <= set(tags)
+    assert confidence >= pretagger.threshold
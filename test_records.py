@@ -0,0 +1,15 @@
+#   python -m pytest test_records.py
+from records import Story
+
+
+def test_missing_field_is_not_in_record():
+    assert 'id' not in Story(None, 'Headline', 'https://example.com/a', 0, None, ())
+    assert 'id' in Story(7, 'Headline', 'https://example.com/a', 0, None, ())
+
+
+def test_upsert_story_assigns_ids_to_records(database):
+    first = database.upsert_story(Story(None, 'One', 'https://example.com/1', 0, None, ('economy',)))
+    second = database.upsert_story(Story(None, 'Two', 'https://example.com/2', 0, None, ('weather',)))
+    again = database.upsert_story(Story(None, 'One', 'https://example.com/1', 1, None, ('economy',)))
+    assert first != second
+    assert again == first
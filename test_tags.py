@@ -0,0 +1,31 @@
+#   python -m pytest test_tags.py
+import threading
+
+from tags import Tags
+
+
+def test_concurrent_likes(database):
+    tags = Tags()
+    errors = []
+
+    def like():
+        try:
+            for _ in range(25):
+                tags.like_tags(['economy', 'ukraine'])
+                tags.dislike_tags(['weather'])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=like) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    # Every like was counted, and the list, index and ids all hold the same records
+    assert round(tags.get_tag('economy')['count']) == 200
+    assert tags.get_tag('weather')['score'] < 0
+    for tag in tags.tags:
+        assert tags.index[tag['text']] is tag
+        assert tags.ids[tag['id']] is tag
@@ -0,0 +1,202 @@
+#    ┌────────────────────────────────────────────────────────────────────┐
+#    │                                                                    │
+#    │                       Tracing and Profiling                        │
+#    │                                                                    │
+#    │    When a page or a refresh is slow, this is how we find out       │
+#    │    where the time went, without redeploying anything.              │
+#    │                                                                    │
+#    │    Tracing: the interesting functions are wrapped with @traced.    │
+#    │    While tracing is switched on (TRACE=1, or via /admin/trace),    │
+#    │    every call records how long it took, nested under whoever       │
+#    │    called it.  The totals come out as "collapsed stacks", the      │
+#    │    format flamegraph.pl and speedscope read.  When tracing is      │
+#    │    off, a traced call costs one if statement.                      │
+#    │                                                                    │
+#    │    Profiling: /admin/profile arms cProfile or tracemalloc for      │
+#    │    the next N requests or the next refresh.  The results can be    │
+#    │    downloaded when it's done.                                      │
+#    │                                                                    │
+#    └────────────────────────────────────────────────────────────────────┘
+import cProfile
+import functools
+import io
+import marshal
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+
+class Tracer:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if "enabled" not in self.__dict__:
+            self.enabled = os.getenv('TRACE', '0') == '1'
+            self.local = threading.local()
+            self.lock = threading.Lock()
+            self.stacks = Counter()     # "a;b;c" -> microseconds spent in c itself
+
+    def begin(self, name):
+        if not self.enabled:
+            return
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        # [name, start time, time spent in children]
+        stack.append([name, time.perf_counter(), 0.0])
+
+    def end(self):
+        stack = getattr(self.local, 'stack', None)
+        if not stack:
+            return
+        path = ';'.join(frame[0] for frame in stack)
+        name, start, children = stack.pop()
+        elapsed = time.perf_counter() - start
+        if stack:
+            stack[-1][2] += elapsed
+        with self.lock:
+            self.stacks[path] += int((elapsed - children) * 1_000_000)
+
+    def collapsed(self):
+        with self.lock:
+            return ''.join(f'{path} {micros}\n' for path, micros in sorted(self.stacks.items()))
+
+    def reset(self):
+        with self.lock:
+            self.stacks.clear()
+
+
+def traced(function):
+    name = f'{function.__module__}.{function.__qualname__}'
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        tracer = Tracer()
+        if not tracer.enabled:
+            return function(*args, **kwargs)
+        tracer.begin(name)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            tracer.end()
+
+    return wrapper
+
+
+class Profiler:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if "mode" not in self.__dict__:
+            self.lock = threading.Lock()
+            self.mode = None            # 'cprofile' or 'tracemalloc' while armed
+            self.target = None          # 'requests' or 'refresh'
+            self.remaining = 0
+            self.active = 0
+            self.stats = None
+            self.memory_report = None
+            self.finished = None
+
+    def arm(self, mode, requests=0, refresh=False):
+        if mode not in ('cprofile', 'tracemalloc'):
+            raise ValueError(f'Unknown profiling mode: {mode}')
+        if not refresh and requests <= 0:
+            raise ValueError('Say how many requests to profile, or ask for the next refresh')
+        with self.lock:
+            if self.mode is not None:
+                raise ValueError(f'Already profiling ({self.mode})')
+            self.mode = mode
+            self.target = 'refresh' if refresh else 'requests'
+            self.remaining = 1 if refresh else requests
+            self.stats = None
+            self.memory_report = None
+            self.finished = None
+            if mode == 'tracemalloc':
+                tracemalloc.start(25)
+
+    def status(self):
+        with self.lock:
+            return {'mode': self.mode, 'target': self.target, 'remaining': self.remaining,
+                    'finished': self.finished, 'has_profile': self.stats is not None,
+                    'has_memory_report': self.memory_report is not None}
+
+    # Returns a cProfile.Profile if this unit of work should be profiled, True for
+    # tracemalloc, or None if nobody asked
+    def start(self, target):
+        with self.lock:
+            if self.mode is None or self.target != target or self.remaining <= 0:
+                return None
+            self.remaining -= 1
+            self.active += 1
+            mode = self.mode
+        if mode == 'cprofile':
+            profile = cProfile.Profile()
+            profile.enable()
+            return profile
+        return True
+
+    # cProfile only sees the thread it was started in, so another thread doing part of the same work
+    # (a refresh's pipeline stages) runs its own, which stop() adds in.  `handle` is what start() gave.
+    def follow(self, handle):
+        if not isinstance(handle, cProfile.Profile):
+            return None
+        with self.lock:
+            self.active += 1
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, handle):
+        if handle is None:
+            return
+        if isinstance(handle, cProfile.Profile):
+            handle.disable()
+        with self.lock:
+            if isinstance(handle, cProfile.Profile):
+                if self.stats is None:
+                    self.stats = pstats.Stats(handle)
+                else:
+                    self.stats.add(handle)
+            self.active -= 1
+            if self.remaining == 0 and self.active == 0:
+                self.finish()
+
+    # Called with the lock held
+    def finish(self):
+        if self.mode == 'tracemalloc':
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            lines = [str(stat) for stat in snapshot.statistics('lineno')[:50]]
+            self.memory_report = '\n'.join(lines) + '\n'
+        self.mode = None
+        self.target = None
+        self.finished = time.time()
+
+    # The raw pstats data, loadable with pstats, snakeviz, or flameprof
+    def profile_bytes(self):
+        with self.lock:
+            if self.stats is None:
+                return None
+            return marshal.dumps(self.stats.stats)
+
+    def profile_text(self, limit=40):
+        with self.lock:
+            if self.stats is None:
+                return None
+            out = io.StringIO()
+            self.stats.stream = out
+            self.stats.sort_stats('cumulative').print_stats(limit)
+            return out.getvalue()
@@ -7,6 +7,12 @@
 #    │                                                          │
 #    └──────────────────────────────────────────────────────────┘
 import os
+import queue
+import threading
+import logs
+import metrics
+
+log = logs.get_logger('status')
 
 
 class Utilities:
@@ -21,16 +27,54 @@ class Utilities:
         if "callback" not in self.__dict__:
             self.callback = self.default_status_callback
 
+            # Anybody who wants to hear about progress (e.g., a browser on /api/events)
+            # gets their own queue.  A slow listener only loses its own events.
+            self.subscribers = []
+            self.subscriber_lock = threading.Lock()
+            self.subscriber_queue_size = 100
+
+            metrics.gauge('event_subscribers', 'Clients listening on /api/events',
+                          lambda: len(self.subscribers))
+            metrics.gauge('event_queue_depth', 'Events waiting to be sent to /api/events clients',
+                          lambda: sum(q.qsize() for q in list(self.subscribers)))
+
     @staticmethod
     def default_status_callback(state, message):
-        print(f"State: {state}, Message: {message}", flush=True)
+        log.info(f"State: {state}, Message: {message}")
 
     def set_callback(self, callback):
         self.callback = callback
 
     def update_status(self, state, message):
         self.callback(state, message)
+        self.publish("status", {"status": state, "message": message})
+
+    #    ┌──────────────────────────────────────────────────────────┐
+    #    │    A tiny publish/subscribe broadcaster.  Publishing     │
+    #    │    never blocks: if a subscriber's queue is full, the    │
+    #    │    event is dropped for that subscriber only.            │
+    #    └──────────────────────────────────────────────────────────┘
+    def subscribe(self):
+        q = queue.Queue(maxsize=self.subscriber_queue_size)
+        with self.subscriber_lock:
+            self.subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self.subscriber_lock:
+            if q in self.subscribers:
+                self.subscribers.remove(q)
+
+    def publish(self, event, data):
+        with self.subscriber_lock:
+            subscribers = list(self.subscribers)
+
+        for q in subscribers:
+            try:
+                q.put_nowait((event, data))
+            except queue.Full:
+                pass
 
     @staticmethod
     def stop_process():
-        os.kill(os.getpid(), 15)
\ No newline at end of file
+        os.kill(os.getpid(), 15)
@@ -0,0 +1,16 @@
+#    ┌──────────────────────────────────────────────────────────┐
+#    │                                                          │
+#    │    Entry point for production servers, e.g.:             │
+#    │                                                          │
+#    │        gunicorn -w 4 wsgi:app                            │
+#    │        waitress-serve --port=8080 wsgi:app               │
+#    │                                                          │
+#    │    Each worker joins the election for who refreshes      │
+#    │    CNN.  Don't use gunicorn's --preload: the             │
+#    │    coordinator's threads must start in every worker.     │
+#    │                                                          │
+#    └──────────────────────────────────────────────────────────┘
+import coordinator
+from app import app
+
+coordinator.Coordinator().start()